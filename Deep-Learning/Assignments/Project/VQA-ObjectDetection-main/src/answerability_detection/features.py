@@ -0,0 +1,178 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+import os
+import sys
+import json
+import math
+import hashlib
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import torch
+import clip
+from loguru import logger
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.text import normalize_questions
+from common.images import ImageDataset
+
+FEATS_FILE = "feats.npy"
+MANIFEST_FILE = "manifest.json"
+
+
+def encode_rows(image_paths, questions, clip_model, transform, device='cpu', batch_size=64, num_workers=4):
+    """[image, text] CLIP features of every row, each distinct image is encoded once"""
+    unique_paths = list(dict.fromkeys(image_paths))
+    image_index = {path: idx for idx, path in enumerate(unique_paths)}
+    feat_dim = clip_model.visual.output_dim
+
+    loader = DataLoader(ImageDataset(unique_paths, transform),
+                        batch_size=batch_size,
+                        shuffle=False,
+                        num_workers=num_workers)
+    img_feats = torch.empty((len(unique_paths), feat_dim), dtype=torch.float32)
+    text_feats = torch.empty((len(questions), feat_dim), dtype=torch.float32)
+    with torch.no_grad():
+        for indices, images in loader:
+            img_feats[indices] = clip_model.encode_image(images.to(device)).float().cpu()
+        for start in range(0, len(questions), batch_size):
+            tokens = clip.tokenize(questions[start:start + batch_size], truncate=True).to(device)
+            text_feats[start:start + batch_size] = clip_model.encode_text(tokens).float().cpu()
+
+    rows = torch.as_tensor([image_index[path] for path in image_paths])
+    return torch.cat((img_feats[rows], text_feats), 1).numpy()
+
+
+def fingerprint(image_paths, questions, clip_model_name):
+    """Identifies the rows a feature cache was built for, independent of where the images are stored"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(clip_model_name.encode())
+    for image_path, question in zip(image_paths, questions):
+        digest.update(f"\n{os.path.basename(image_path)}\t{question}".encode())
+    return digest.hexdigest()
+
+
+def shard_path(cache_dir, shard_id):
+    return os.path.join(cache_dir, f"shard_{shard_id:05d}.npy")
+
+
+def save_manifest(cache_dir, manifest):
+    # written to a temporary file first so that an interruption never leaves a truncated manifest
+    tmp_path = os.path.join(cache_dir, MANIFEST_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(cache_dir, MANIFEST_FILE))
+
+
+def load_manifest(cache_dir):
+    path = os.path.join(cache_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def features_ready(cache_dir, image_paths, questions, clip_model_name="RN50"):
+    """True if cache_dir holds the merged features of exactly these rows"""
+    manifest = load_manifest(cache_dir) if cache_dir is not None else None
+    return (manifest is not None and manifest["merged"]
+            and manifest["fingerprint"] == fingerprint(image_paths, questions, clip_model_name))
+
+
+def load_features(cache_dir):
+    """(N, D) float32 feature matrix, memory mapped copy-on-write so torch.from_numpy does not copy"""
+    return np.load(os.path.join(cache_dir, FEATS_FILE), mmap_mode="c")
+
+
+def build_features(image_paths, questions, cache_dir, clip_model=None, transform=None, clip_model_name="RN50",
+                   device='cpu', shard_size=2048, batch_size=64, num_workers=4):
+    """Encodes the rows shard by shard into cache_dir and merges the shards into one matrix.
+
+    Every finished shard is recorded in the manifest, so an interrupted build resumes from the
+    first missing shard. A cache built for other rows or another shard size is rebuilt.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = fingerprint(image_paths, questions, clip_model_name)
+    manifest = load_manifest(cache_dir)
+    if manifest is not None and (manifest["fingerprint"] != key or manifest["shard_size"] != shard_size):
+        logger.warning(f"{cache_dir} was built for different data, rebuilding")
+        manifest = None
+    if manifest is None:
+        manifest = {"fingerprint": key, "clip_model": clip_model_name, "num_rows": len(questions),
+                    "shard_size": shard_size, "completed": [], "merged": False}
+        save_manifest(cache_dir, manifest)
+    if manifest["merged"]:
+        logger.info(f"Loading cached features from {cache_dir}")
+        return load_features(cache_dir)
+
+    assert clip_model is not None and transform is not None, f"features in {cache_dir} are incomplete, a clip model is needed to build them"
+    num_shards = math.ceil(len(questions) / shard_size)
+    completed = set(manifest["completed"])
+    if len(completed) > 0:
+        logger.info(f"Resuming feature build, {len(completed)}/{num_shards} shards done")
+
+    start_time = time.perf_counter()
+    for shard_id in tqdm(range(num_shards)):
+        if shard_id in completed:
+            continue
+        start, end = shard_id * shard_size, min((shard_id + 1) * shard_size, len(questions))
+        feats = encode_rows(image_paths[start:end], questions[start:end], clip_model, transform,
+                            device=device, batch_size=batch_size, num_workers=num_workers)
+        tmp_path = os.path.join(cache_dir, f"shard_{shard_id:05d}.tmp.npy")
+        np.save(tmp_path, feats)
+        os.replace(tmp_path, shard_path(cache_dir, shard_id))
+        manifest["completed"].append(shard_id)
+        save_manifest(cache_dir, manifest)
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"Encoded {len(questions)} rows in {elapsed:.1f}s")
+
+    # [image, text] features, also the width of the empty matrix of an empty split
+    feat_dim = 2 * clip_model.visual.output_dim
+    tmp_path = os.path.join(cache_dir, "feats.tmp.npy")
+    matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(questions), feat_dim))
+    for shard_id in range(num_shards):
+        matrix[shard_id * shard_size:(shard_id + 1) * shard_size] = np.load(shard_path(cache_dir, shard_id))
+    matrix.flush()
+    del matrix
+    os.replace(tmp_path, os.path.join(cache_dir, FEATS_FILE))
+    manifest["merged"] = True
+    save_manifest(cache_dir, manifest)
+    for shard_id in range(num_shards):
+        os.remove(shard_path(cache_dir, shard_id))
+    logger.info(f"Features of {len(questions)} rows written to {cache_dir}")
+    return load_features(cache_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file-path", type=str)
+    parser.add_argument("--image-dir", type=str)
+    parser.add_argument("--cache-dir", type=str)
+    parser.add_argument("--clip-model", type=str, default="RN50")
+    parser.add_argument("--device", type=str, default="cuda:0")
+    parser.add_argument("--shard-size", type=int, default=2048)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--normalize-questions", action="store_true", help="clean the questions as the web UI does before inference")
+    args = parser.parse_args()
+
+    assert os.path.exists(args.file_path), f"{args.file_path} does not exists"
+    df = pd.read_csv(args.file_path)
+    if args.normalize_questions:
+        df = normalize_questions(df)
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    clip_model, preprocess = clip.load(args.clip_model, device=device)
+    build_features(image_paths=[os.path.join(args.image_dir, image) for image in df["image"]],
+                   questions=df["question"].tolist(),
+                   cache_dir=args.cache_dir,
+                   clip_model=clip_model,
+                   transform=preprocess,
+                   clip_model_name=args.clip_model,
+                   device=device,
+                   shard_size=args.shard_size,
+                   batch_size=args.batch_size,
+                   num_workers=args.num_workers)
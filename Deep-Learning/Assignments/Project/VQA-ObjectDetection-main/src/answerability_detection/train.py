@@ -1,7 +1,7 @@
 import argparse
 import torch
 from network import AnsModelV1
-from utils import load_clip, get_dataloader, get_optimizer
+from utils import load_clip, get_dataloader, get_optimizer, is_cached
 import numpy as np 
 from sklearn.metrics import average_precision_score
 import torch.nn as nn
@@ -10,7 +10,11 @@ import time
 import os
 from loguru import logger
 import json
-from tqdm import tqdm 
+import sys
+from functools import partial
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.trainer import Trainer
 
 
 def parse_arguments():
@@ -30,75 +34,44 @@ def parse_arguments():
     parser.add_argument("--device", type=str, default="cuda:0")
     parser.add_argument("--hidden-dim", type=int, default=2048)
     parser.add_argument("--patience", type=int, default=10)
+    parser.add_argument("--precision", type=str, default="fp32", help="fp32, bf16 (cpu/cuda) or fp16 (cuda)")
+    parser.add_argument("--grad-accum-steps", type=int, default=1)
+
+    # Feature Cache
+    parser.add_argument("--feature-cache-dir", type=str, default=None, help="build clip features once in resumable shards and reuse them")
+    parser.add_argument("--shard-size", type=int, default=2048)
+    parser.add_argument("--feature-batch-size", type=int, default=64)
+    parser.add_argument("--num-workers", type=int, default=4)
     args = parser.parse_args()
     return args
 
 
-def train_ans(model, data_loader, criterion, optimizer, device):
-    model.train()
-    train_loss = 0
-    train_scores = []
-    train_targets = []
-
-    for i, (_, x, _, targets) in enumerate(data_loader):
-        x = x.to(device)
-        targets = targets.to(device)
-        
-        # Forward Pass
-        outputs = model(x).squeeze(1)
-        loss = criterion(outputs, targets.float())
-        
-        # Backward Pass
-        optimizer.zero_grad()
-        loss.backward()
-        
-        # Update Weights
-        optimizer.step()
-
-        # Loss and Accuracy Calculations
-        train_loss += loss.item()
-        train_scores.append(outputs.detach().cpu().numpy())
-        train_targets.append(targets.cpu().numpy())
-    
-    train_loss /= len(data_loader.dataset)
-    
-    train_targets = np.concatenate(train_targets)
-    train_scores = np.concatenate(train_scores)
-    accuracy = average_precision_score(train_targets, train_scores)
-    
-    return train_loss, accuracy
-
-def validate_ans(model, data_loader, criterion, device):
-    model.eval()
-    val_loss = 0
-    val_scores = []
-    val_targets = []
-    
-    with torch.no_grad():
-        for i, (_, x, _, targets) in enumerate(data_loader):
-            x = x.to(device)
-            targets = targets.to(device)
-            
-            # Forward Pass
-            outputs = model(x).squeeze(1)
-            loss = criterion(outputs, targets.float())
-            
-            # Loss and Accuracy Calculations
-            val_loss += loss.item()
-            val_scores.append(outputs.cpu().numpy())
-            val_targets.append(targets.cpu().numpy())            
+def ans_step(model, batch, device, criterion):
+    _, x, _, targets = batch
+    x = x.to(device)
+    targets = targets.to(device)
 
-    val_loss /= len(data_loader.dataset)
-    
-    val_targets = np.concatenate(val_targets)
-    val_scores = np.concatenate(val_scores)
-    accuracy = average_precision_score(val_targets, val_scores)
+    # Forward Pass
+    outputs = model(x).squeeze(1)
+    loss = criterion(outputs, targets.float())
+    return {"loss": loss, "num_samples": len(targets), "outputs": {"scores": outputs, "targets": targets}}
 
-    return val_loss, accuracy
+def average_precision(results):
+    outputs = results["outputs"]
+    return average_precision_score(outputs["targets"].numpy(), outputs["scores"].numpy())
 
 def main(cfg):
     device = torch.device(cfg.device if torch.cuda.is_available() else "cpu")
-    clip_model, clip_preprocess = load_clip(model_name=cfg.clip_model, device=device)
+    train_cache_dir = os.path.join(cfg.feature_cache_dir, "train") if cfg.feature_cache_dir is not None else None
+    val_cache_dir = os.path.join(cfg.feature_cache_dir, "val") if cfg.feature_cache_dir is not None else None
+
+    # CLIP is only needed when some features are not cached yet
+    splits = [(train_cache_dir, cfg.train_file_path, cfg.train_image_dir), (val_cache_dir, cfg.val_file_path, cfg.val_image_dir)]
+    if all(is_cached(*split, clip_model_name=cfg.clip_model) for split in splits):
+        logger.info("Using cached CLIP features")
+        clip_model, clip_preprocess = None, None
+    else:
+        clip_model, clip_preprocess = load_clip(model_name=cfg.clip_model, device=device)
 
     logger.info("Creating Dataloaders")
     train_dataset, train_loader = get_dataloader(
@@ -108,7 +81,12 @@ def main(cfg):
         device=device,
         batch_size=cfg.batch_size,
         shuffle=True,
-        transform=clip_preprocess
+        transform=clip_preprocess,
+        cache_dir=train_cache_dir,
+        clip_model_name=cfg.clip_model,
+        shard_size=cfg.shard_size,
+        feature_batch_size=cfg.feature_batch_size,
+        num_workers=cfg.num_workers
     )
     val_dataset, val_loader = get_dataloader(
         df_path=cfg.val_file_path,
@@ -117,12 +95,23 @@ def main(cfg):
         device=device,
         batch_size=cfg.batch_size,
         shuffle=False,
-        transform=clip_preprocess
+        transform=clip_preprocess,
+        cache_dir=val_cache_dir,
+        clip_model_name=cfg.clip_model,
+        shard_size=cfg.shard_size,
+        feature_batch_size=cfg.feature_batch_size,
+        num_workers=cfg.num_workers
     )
     network = AnsModelV1(input_dim=2048, hidden_dim=cfg.hidden_dim, output_dim=1).to(device)
     criterion = nn.BCEWithLogitsLoss()
     optimizer = get_optimizer(network=network, learning_rate=cfg.lr, optim_name=cfg.optimizer)
     lr_scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=4, verbose=False)
+    trainer = Trainer(network, 
+                      partial(ans_step, criterion=criterion), 
+                      optimizer=optimizer, 
+                      device=device,
+                      precision=cfg.precision,
+                      grad_accum_steps=cfg.grad_accum_steps)
 
     train_ans_acc_history = []
     train_ans_loss_history = []
@@ -136,8 +125,10 @@ def main(cfg):
         logger.info(f"Epoch [{epoch + 1}/{cfg.num_epochs}]:")
         start_time = time.perf_counter()
         
-        train_loss, train_acc = train_ans(network, train_loader, criterion, optimizer, device)
-        val_loss, val_acc = validate_ans(network, val_loader, criterion, device)
+        train_results = trainer.train_epoch(train_loader)
+        val_results = trainer.evaluate(val_loader)
+        train_loss, train_acc = train_results["loss"], average_precision(train_results)
+        val_loss, val_acc = val_results["loss"], average_precision(val_results)
         
         epoch_time = time.perf_counter() - start_time
         avg_step_time = epoch_time / (len(train_loader) + len(val_loader))
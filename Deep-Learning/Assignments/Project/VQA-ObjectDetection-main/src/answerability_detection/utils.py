@@ -1,5 +1,8 @@
 import clip
 from dataset import VizWizDataset
+from features import features_ready
+import pandas as pd
+import os
 from torch.utils.data import DataLoader
 import torch 
 from loguru import logger
@@ -24,10 +27,21 @@ def load_clip(model_name='RN50', device='cpu'):
     return clip_model, preprocess
 
 
-def get_dataloader(df_path, image_dir,clip_model, device, batch_size, shuffle=True, transform=None):
+def is_cached(cache_dir, df_path, image_dir, clip_model_name="RN50"):
+    """True if the features of df_path are already built in cache_dir"""
+    if cache_dir is None:
+        return False
+    df = pd.read_csv(df_path)
+    image_paths = [os.path.join(image_dir, image) for image in df["image"]]
+    return features_ready(cache_dir, image_paths, df["question"].tolist(), clip_model_name)
+
+
+def get_dataloader(df_path, image_dir,clip_model, device, batch_size, shuffle=True, transform=None,
+                   cache_dir=None, clip_model_name="RN50", shard_size=2048, feature_batch_size=64, num_workers=4):
     dataset = VizWizDataset(df_path=df_path, 
                             image_dir=image_dir, 
-                            clip_model=clip_model,device=device, transform=transform, batch_size=batch_size)
+                            clip_model=clip_model,device=device, transform=transform, batch_size=feature_batch_size,
+                            cache_dir=cache_dir, clip_model_name=clip_model_name, shard_size=shard_size, num_workers=num_workers)
 
     data_loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle)
     return dataset, data_loader
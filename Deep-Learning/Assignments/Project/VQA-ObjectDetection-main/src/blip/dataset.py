@@ -1,7 +1,12 @@
+import os
+import sys
 import torch 
 import pandas as pd 
 from PIL import Image 
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.batching import pad_to_longest, token_lengths
+
 class VQADataset(torch.utils.data.Dataset):
     def __init__(self, data_path ,text_processor, image_processor):
         self.data = pd.read_json(data_path)
@@ -15,6 +20,7 @@ class VQADataset(torch.utils.data.Dataset):
         self.max_length = 20
         self.image_height = 128
         self.image_width = 128
+        self.lengths = token_lengths(self.text_processor.tokenizer, self.questions, max_length=self.max_length)
 
     def __len__(self):
         return len(self.data)
@@ -28,7 +34,8 @@ class VQADataset(torch.utils.data.Dataset):
                                   do_resize=True,
                                   size=(self.image_height,self.image_width),
                                   return_tensors="pt")
-        encoding = self.text_processor(text=text,padding="max_length",truncation=True,max_length = self.max_length,return_tensors="pt")
+        # questions and answers are padded per batch in collate_fn
+        encoding = self.text_processor(text=text,padding=False,truncation=True,max_length = self.max_length,return_tensors="pt")
         # # remove batch dimension
         for k,v in encoding.items():
             encoding[k] = v.squeeze()
@@ -37,7 +44,7 @@ class VQADataset(torch.utils.data.Dataset):
         labels = self.text_processor.tokenizer.encode(
             answers,
             max_length= self.max_length,
-            padding="max_length",
+            padding=False,
             truncation=True,
             return_tensors='pt'
         )[0]
@@ -45,16 +52,24 @@ class VQADataset(torch.utils.data.Dataset):
 
         return encoding
 
-def collate_fn(batch):
+def collate_fn(batch, pad_token_id=0):
     input_ids = [item['input_ids'] for item in batch]
     pixel_values = [item['pixel_values'] for item in batch]
     attention_mask = [item['attention_mask'] for item in batch]
     labels = [item['labels'] for item in batch]
+    # pad questions and answers only up to the longest one in the batch
+    lengths = [int(mask.sum()) for mask in attention_mask]
+    label_lengths = [int((label != pad_token_id).sum()) for label in labels]
     # create new batch
     batch = {}
-    batch['input_ids'] = torch.stack(input_ids)
-    batch['attention_mask'] = torch.stack(attention_mask)
+    batch['input_ids'] = pad_to_longest(input_ids, lengths, pad_token_id)
+    batch['attention_mask'] = pad_to_longest(attention_mask, lengths)
     batch['pixel_values'] = torch.stack(pixel_values)
-    batch['labels'] = torch.stack(labels)
+    # the answers are the decoder inputs too, padding is masked out of the attention and of the loss
+    answer_ids = pad_to_longest(labels, label_lengths, pad_token_id)
+    answer_mask = pad_to_longest([torch.ones_like(label) for label in labels], label_lengths)
+    batch['decoder_input_ids'] = answer_ids
+    batch['decoder_attention_mask'] = answer_mask
+    batch['labels'] = answer_ids.masked_fill(answer_mask == 0, -100)
 
     return batch
\ No newline at end of file
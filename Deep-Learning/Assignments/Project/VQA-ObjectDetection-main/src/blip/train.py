@@ -4,7 +4,6 @@ warnings.filterwarnings("ignore")
 import logging
 logging.disable(logging.WARNING)
 
-from tqdm import tqdm 
 import torch 
 from dataset import VQADataset, collate_fn
 
@@ -19,44 +18,21 @@ import numpy as np
 import sys 
 import yaml
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.batching import LengthBucketBatchSampler
+from common.trainer import Trainer
+
 
 class Config:
     def __init__(self, config):
         for key, value in config.items():
             setattr(self, key, value)
 
-def train_one_epoch(model, train_dataloader, optimizer, scheduler, device):
-    model.train()
-    epoch_loss = 0.0
-    for batch in tqdm(train_dataloader):
-        # get the inputs;
-        batch = {k:v.to(device) for k,v in batch.items()}
-
-        # zero the parameter gradients
-        optimizer.zero_grad()
-        # forward + backward + optimize
-        outputs = model(**batch)
-        loss = outputs.loss
-        epoch_loss+= loss.item()
-        loss.backward()
-        optimizer.step()
-        scheduler.step()
-    
-    epoch_loss_avg = epoch_loss / len(train_dataloader.dataset)
-    return epoch_loss_avg
-
-def validate_model(model, test_dataloader, device):
-    model.eval()
-    valid_loss = 0.0
-    with torch.no_grad():
-        for batch in tqdm(test_dataloader):
-            batch = {k:v.to(device) for k,v in batch.items()}
-            outputs = model(**batch)
-            loss = outputs.loss
-            valid_loss+= loss.item()
-    
-    valid_loss_avg = valid_loss / len(test_dataloader.dataset)
-    return valid_loss_avg
+def vqa_step(model, batch, device):
+    # get the inputs;
+    batch = {k:v.to(device) for k,v in batch.items()}
+    outputs = model(**batch)
+    return {"loss": outputs.loss, "num_samples": len(batch["input_ids"])}
 
 
 def main(cfg):
@@ -68,14 +44,30 @@ def main(cfg):
     train_vqa_dataset = VQADataset(cfg.train_data_path, text_processor,image_processor)
     val_vqa_dataset = VQADataset(cfg.val_data_path, text_processor,image_processor)
 
-    train_dataloader = DataLoader(train_vqa_dataset,
-                                  collate_fn=collate_fn,
-                                  batch_size=cfg.batch_size,
-                                  shuffle=False)
-    val_dataloader = DataLoader(val_vqa_dataset,
-                                collate_fn=collate_fn,
-                                batch_size=cfg.batch_size,
-                                shuffle=False)
+    collate = lambda x : collate_fn(x, text_processor.tokenizer.pad_token_id)
+    if getattr(cfg, 'bucket_batching', False):
+        # batches of questions with similar token length, padded to the longest one
+        train_dataloader = DataLoader(train_vqa_dataset,
+                                      collate_fn=collate,
+                                      batch_sampler=LengthBucketBatchSampler(train_vqa_dataset.lengths,
+                                                                             batch_size=cfg.batch_size,
+                                                                             bucket_size=cfg.bucket_size,
+                                                                             shuffle=True))
+        val_dataloader = DataLoader(val_vqa_dataset,
+                                    collate_fn=collate,
+                                    batch_sampler=LengthBucketBatchSampler(val_vqa_dataset.lengths,
+                                                                           batch_size=cfg.batch_size,
+                                                                           bucket_size=cfg.bucket_size,
+                                                                           shuffle=False))
+    else:
+        train_dataloader = DataLoader(train_vqa_dataset,
+                                      collate_fn=collate,
+                                      batch_size=cfg.batch_size,
+                                      shuffle=False)
+        val_dataloader = DataLoader(val_vqa_dataset,
+                                    collate_fn=collate,
+                                    batch_size=cfg.batch_size,
+                                    shuffle=False)
 
     model = BlipForQuestionAnswering.from_pretrained("Salesforce/blip-vqa-base" )
     device = torch.device(cfg.device if torch.cuda.is_available() else 'cpu')
@@ -83,7 +75,17 @@ def main(cfg):
     model.to(device)
     #optimizer = torch.optim.AdamW(model.parameters(), lr=cfg.learning_rate)
     optimizer = torch.optim.SGD(model.parameters(), lr=cfg.learning_rate, momentum=cfg.momentum)
-    scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=cfg.learning_rate, steps_per_epoch=len(train_dataloader), epochs= cfg.num_epochs)
+    # one scheduler step per optimizer step
+    grad_accum_steps = getattr(cfg, 'grad_accum_steps', 1)
+    steps_per_epoch = (len(train_dataloader) + grad_accum_steps - 1) // grad_accum_steps
+    scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=cfg.learning_rate, steps_per_epoch=steps_per_epoch, epochs= cfg.num_epochs)
+    trainer = Trainer(model, 
+                      vqa_step, 
+                      optimizer=optimizer, 
+                      device=device, 
+                      scheduler=scheduler,
+                      precision=getattr(cfg, 'precision', 'fp32'),
+                      grad_accum_steps=grad_accum_steps)
     image_mean = image_processor.image_mean
     image_std = image_processor.image_std
 
@@ -93,8 +95,8 @@ def main(cfg):
         print(f"Epoch [{epoch + 1}/{NUM_EPOCHS}]:")
         start_time = time.perf_counter()
         
-        train_loss = train_one_epoch(model, train_dataloader, optimizer, scheduler, device)
-        val_loss = validate_model(model, val_dataloader, device)
+        train_loss = trainer.train_epoch(train_dataloader)["loss"]
+        val_loss = trainer.evaluate(val_dataloader)["loss"]
         
         epoch_time = time.perf_counter() - start_time
         avg_step_time = epoch_time / (len(train_dataloader) + len(val_dataloader))
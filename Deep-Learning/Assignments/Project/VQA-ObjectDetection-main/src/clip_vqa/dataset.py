@@ -6,11 +6,14 @@ import os
 import pandas as pd
 from loguru import logger 
 import numpy as np 
+from feature_store import FeatureStore
+from utils import build_answer_table
 
 class VizWizDataset(Dataset):
     def __init__(self, 
                 df_path, 
-                filter_answerable=True):
+                filter_answerable=True,
+                feature_store=None):
         assert os.path.exists(df_path), f"{df_path} does not exists"
         self.df = pd.read_json(df_path)
 
@@ -25,14 +28,34 @@ class VizWizDataset(Dataset):
         self.answers = self.df.final_answer
         self.anserable = self.df
 
+        # features are served from the memory mapped store instead of per sample .pt files
+        self.store = None
+        if feature_store is not None:
+            logger.info(f"Using Feature Store {feature_store}")
+            self.store = FeatureStore(feature_store)
+            self.rows = self.store.rows(self.df.image)
+
+        # filled by encode_answers
+        self.labels = None
+        self.answer_table = None
+
+    def encode_answers(self, enc):
+        """Encodes final answers to class ids and the human answers to an answer table once per split,
+        so that training only handles integer tensors"""
+        self.labels = torch.as_tensor(enc.transform(np.array(self.df.final_answer).reshape(-1, 1)).astype(np.int64).reshape(-1))
+        self.answer_table = build_answer_table(self.df, enc)
+
     def __len__(self):
         return len(self.df)
                 
     def __getitem__(self, index):
-        img_feat = torch.load(self.df.img_feat.iloc[index])
-        text_feat = torch.load(self.df.text_feat.iloc[index])
-        feat = torch.cat((img_feat, text_feat), 1).to(torch.float32)
+        if self.store is not None:
+            feat = torch.from_numpy(self.store[self.rows[index]]).unsqueeze(0).to(torch.float32)
+        else:
+            img_feat = torch.load(self.df.img_feat.iloc[index])
+            text_feat = torch.load(self.df.text_feat.iloc[index])
+            feat = torch.cat((img_feat, text_feat), 1).to(torch.float32)
 
-        answer = self.df.final_answer.iloc[index]
+        answer = self.labels[index] if self.labels is not None else self.df.final_answer.iloc[index]
         answerability = self.df.answerable.iloc[index]       
         return index, feat, answer, answerability
\ No newline at end of file
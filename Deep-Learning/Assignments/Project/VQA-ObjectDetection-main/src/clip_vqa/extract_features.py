@@ -4,11 +4,20 @@ warnings.filterwarnings('ignore')
 import clip 
 import numpy as np 
 import os
+import sys
 import pandas as pd
 from PIL import Image
 import torch
 import argparse
+import time
 from loguru import logger
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from feature_store import write_feature_store, SUPPORTED_DTYPES
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.text import normalize_questions
+from common.images import ImageDataset
 
 def load_clip(model_name='RN50', device='cpu'):
     """Load Clip Model and Preprocessor"""
@@ -30,6 +39,47 @@ def extract_features(image_path, question, clip_model, transform, device='cpu'):
         text_features = clip_model.encode_text(question)
     return image_features.detach().cpu(), text_features.detach().cpu()
 
+
+def extract_features_batched(data, clip_model, transform, device='cpu', batch_size=64, text_batch_size=256, num_workers=4):
+    """Extracts clip features for the whole dataframe in batches.
+
+    Every unique image is decoded and encoded only once, questions are tokenized and 
+    encoded in chunks of text_batch_size. Returns the unique image paths, their image 
+    features, the row -> unique image index and the per row text features.
+    """
+    image_paths = data['image_path'].unique()
+    image_index = {path: idx for idx, path in enumerate(image_paths)}
+    feat_dim = clip_model.visual.output_dim
+
+    loader = DataLoader(ImageDataset(image_paths, transform),
+                        batch_size=batch_size,
+                        shuffle=False,
+                        num_workers=num_workers)
+
+    logger.info(f"Encoding {len(image_paths)} unique images for {len(data)} questions")
+    img_feats = torch.empty((len(image_paths), feat_dim), dtype=torch.float32)
+    start_time = time.perf_counter()
+    with torch.no_grad():
+        for indices, images in tqdm(loader):
+            img_feats[indices] = clip_model.encode_image(images.to(device)).float().cpu()
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"Encoded {len(image_paths)} images in {elapsed:.1f}s ({len(image_paths) / elapsed:.2f} images/s)")
+
+    questions = data['question'].tolist()
+    text_feats = torch.empty((len(questions), feat_dim), dtype=torch.float32)
+    start_time = time.perf_counter()
+    with torch.no_grad():
+        for start in tqdm(range(0, len(questions), text_batch_size)):
+            end = start + text_batch_size
+            tokens = clip.tokenize(questions[start:end], truncate=True).to(device)
+            text_feats[start:end] = clip_model.encode_text(tokens).float().cpu()
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"Encoded {len(questions)} questions in {elapsed:.1f}s ({len(questions) / elapsed:.2f} questions/s)")
+
+    rows = torch.as_tensor(data['image_path'].map(image_index).to_numpy())
+    return image_paths, img_feats, rows, text_feats
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--data-path",type=str)
@@ -37,6 +87,14 @@ if __name__ == "__main__":
     parser.add_argument("--clip-model", type=str, default='RN50')
     parser.add_argument("--device", type=str, default='cuda:0')
     parser.add_argument("--save-path",type=str)
+    parser.add_argument("--batched", action="store_true", help="deduplicate images and encode in batches")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--text-batch-size", type=int, default=256)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--num-threads", type=int, default=None, help="torch intra-op threads for cpu extraction")
+    parser.add_argument("--feature-store", type=str, default=None, help="write a memory mapped feature store instead of .pt files")
+    parser.add_argument("--store-dtype", type=str, default="float16", choices=SUPPORTED_DTYPES)
+    parser.add_argument("--normalize-questions", action="store_true", help="clean the questions as the web UI does before inference")
 
     args = parser.parse_args()
 
@@ -48,9 +106,14 @@ if __name__ == "__main__":
     clip_model_name = args.clip_model
     save_path = args.save_path
 
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
     clip_model, preprocess = load_clip(model_name='RN50', device=device)
 
     data = pd.read_json(args.data_path)
+    if args.normalize_questions:
+        data = normalize_questions(data)
     #data = data.iloc[:501]
     img_feat_list = []
     text_feat_list = []
@@ -58,29 +121,66 @@ if __name__ == "__main__":
     total = len(data)
     done = 0
     logger.info("Extracting Features ......")
-    for idx,row in data.iterrows():
-        image_path = row['image_path']
-        question = row['question']
-        text_feat_name = row['image'].split('.')[0] + '_text.pt'
-        img_feat_name = row['image'].split('.')[0] + '_img.pt'
+    if args.feature_store is not None:
+        image_paths, img_feats, rows, text_feats = extract_features_batched(data=data,
+                                                                            clip_model=clip_model,
+                                                                            transform=preprocess,
+                                                                            device=device,
+                                                                            batch_size=args.batch_size,
+                                                                            text_batch_size=args.text_batch_size,
+                                                                            num_workers=args.num_workers)
+        feats = torch.cat((img_feats[rows], text_feats), 1).numpy()
+        write_feature_store(store_dir=args.feature_store,
+                            feats=feats,
+                            question_ids=data['image'].tolist(),
+                            dtype=args.store_dtype)
+        img_feat_list = [None] * len(data)
+        text_feat_list = [None] * len(data)
+    elif args.batched:
+        image_paths, img_feats, rows, text_feats = extract_features_batched(data=data,
+                                                                            clip_model=clip_model,
+                                                                            transform=preprocess,
+                                                                            device=device,
+                                                                            batch_size=args.batch_size,
+                                                                            text_batch_size=args.text_batch_size,
+                                                                            num_workers=args.num_workers)
+        # one feature file per unique image, one text feature file per question
+        img_paths_saved = {}
+        for idx, (_, row) in enumerate(data.iterrows()):
+            image_row = int(rows[idx])
+            if image_row not in img_paths_saved:
+                img_feat_path = os.path.join(feat_save_dir, row['image'].split('.')[0] + '_img.pt')
+                torch.save(img_feats[image_row:image_row+1].clone(), img_feat_path)
+                img_paths_saved[image_row] = img_feat_path
+            text_feat_path = os.path.join(feat_save_dir, row['image'].split('.')[0] + '_text.pt')
+            torch.save(text_feats[idx:idx+1].clone(), text_feat_path)
+
+            img_feat_list.append(img_paths_saved[image_row])
+            text_feat_list.append(text_feat_path)
+    else:
+        for idx,row in data.iterrows():
+            image_path = row['image_path']
+            question = row['question']
+            text_feat_name = row['image'].split('.')[0] + '_text.pt'
+            img_feat_name = row['image'].split('.')[0] + '_img.pt'
         
-        img_feat, text_feat = extract_features(image_path=image_path,
-                                       question=question,
-                                       clip_model=clip_model,
-                                       transform=preprocess,
-                                       device=device
-                                    )
-        img_feat_path = os.path.join(feat_save_dir,img_feat_name)
-        text_feat_path = os.path.join(feat_save_dir,text_feat_name)
-        torch.save(img_feat, img_feat_path)
-        torch.save(text_feat, text_feat_path)
-
-        img_feat_list.append(img_feat_path)
-        text_feat_list.append(text_feat_path)
-        done+=1
-
-        if done % 500 == 0:
-            logger.info(f"Total={total} Done={done}")
+            img_feat, text_feat = extract_features(image_path=image_path,
+                                           question=question,
+                                           clip_model=clip_model,
+                                           transform=preprocess,
+                                           device=device
+                                        )
+            img_feat_path = os.path.join(feat_save_dir,img_feat_name)
+            text_feat_path = os.path.join(feat_save_dir,text_feat_name)
+            torch.save(img_feat, img_feat_path)
+            torch.save(text_feat, text_feat_path)
+
+            img_feat_list.append(img_feat_path)
+            text_feat_list.append(text_feat_path)
+            done+=1
+
+            if done % 500 == 0:
+                logger.info(f"Total={total} Done={done}")
 
     data['img_feat'] = img_feat_list
     data['text_feat'] = text_feat_list
@@ -0,0 +1,50 @@
+import os
+import json
+import numpy as np
+from loguru import logger
+
+FEATS_FILE = "feats.npy"
+INDEX_FILE = "index.json"
+SUPPORTED_DTYPES = ["float16", "float32"]
+
+
+def write_feature_store(store_dir, feats, question_ids, dtype="float16"):
+    """Writes one contiguous (N, D) feature matrix and a row -> question id index to store_dir"""
+    assert dtype in SUPPORTED_DTYPES, f"dtype should be one of {SUPPORTED_DTYPES}"
+    assert len(feats) == len(question_ids), "every feature row needs a question id"
+    os.makedirs(store_dir, exist_ok=True)
+
+    feats = np.asarray(feats)
+    matrix = np.lib.format.open_memmap(os.path.join(store_dir, FEATS_FILE),
+                                       mode="w+",
+                                       dtype=dtype,
+                                       shape=feats.shape)
+    matrix[:] = feats
+    matrix.flush()
+    del matrix
+
+    with open(os.path.join(store_dir, INDEX_FILE), "w") as f:
+        json.dump({"question_ids": [str(qid) for qid in question_ids], "dtype": dtype}, f)
+    logger.info(f"Feature store with {feats.shape[0]} rows of dim {feats.shape[1]} ({dtype}) written to {store_dir}")
+
+
+class FeatureStore:
+    """Memory mapped view over a feature store written by write_feature_store"""
+    def __init__(self, store_dir):
+        assert os.path.exists(os.path.join(store_dir, FEATS_FILE)), f"{store_dir} is not a feature store"
+        # copy-on-write mapping so rows can be handed to torch.from_numpy without a copy
+        self.feats = np.load(os.path.join(store_dir, FEATS_FILE), mmap_mode="c")
+        with open(os.path.join(store_dir, INDEX_FILE), "r") as f:
+            index = json.load(f)
+        self.question_ids = index["question_ids"]
+        self.row_index = {qid: row for row, qid in enumerate(self.question_ids)}
+
+    def __len__(self):
+        return self.feats.shape[0]
+
+    def rows(self, question_ids):
+        """Maps question ids to their row in the feature matrix"""
+        return np.array([self.row_index[str(qid)] for qid in question_ids], dtype=np.int64)
+
+    def __getitem__(self, row):
+        return self.feats[row]
@@ -12,77 +12,43 @@ from torch.utils.data import DataLoader
 from sklearn.preprocessing import OrdinalEncoder
 import numpy as np 
 import pickle
-from tqdm import tqdm 
 import torch 
 from utils import get_optimizer, accuracy_vqa, Config
 import torch.nn as nn 
 import time 
 from torch.utils.tensorboard import SummaryWriter
+from functools import partial
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.trainer import Trainer
 
-def train_vqa(model, data_loader, criterion, optimizer, device, enc):
-    model.train()
-    train_loss = 0
-    accuracy = 0
-    for index, x, answers, _ in tqdm(data_loader):
-        x = x.to(device) 
-        answers = torch.as_tensor(enc.transform(np.array(answers).reshape(-1, 1)).astype(int)).to(device).squeeze(1)
-        
-        # Forward Pass
-        outputs = model(x).squeeze(1)
-        loss = criterion(outputs, answers)
-        
-        # Backward Pass
-        optimizer.zero_grad()
-        loss.backward()
-        
-        # Update Weights
-        optimizer.step()
-
-        # Loss and Accuracy Calculations
-        train_loss += loss.item()
-        _, predicted = outputs.max(1)
-        predicted = enc.inverse_transform(np.array(predicted.to('cpu')).reshape(-1,1))
-        for ip, idx in enumerate(index):
-            accuracy += accuracy_vqa(data_loader.dataset.df, int(idx), predicted[ip])
-
-    train_loss /= len(data_loader.dataset)
-    accuracy /= len(data_loader.dataset)
-    
-    return train_loss, accuracy
-
-def validate_vqa(model, data_loader, criterion, device, enc):
-    model.eval()
-    val_loss = 0
-    accuracy = 0
-    with torch.no_grad():
-        for index, x, answers, _ in tqdm(data_loader):
-            x = x.to(device)
-            answers = torch.as_tensor(enc.transform(np.array(answers).reshape(-1, 1)).astype(int)).to(device).squeeze(1)
-            
-            # Forward Pass
-            outputs = model(x).squeeze(1)
-            loss = criterion(outputs, answers)
-            
-            # Loss and Accuracy Calculations
-            val_loss += loss.item()
-            _, predicted = outputs.max(1)
-            predicted = enc.inverse_transform(np.array(predicted.to('cpu')).reshape(-1,1))
-            for ip, idx in enumerate(index):
-                accuracy += accuracy_vqa(data_loader.dataset.df, int(idx), predicted[ip])
 
-    val_loss /= len(data_loader.dataset)
-    accuracy /= len(data_loader.dataset)
+def vqa_step(model, batch, device, criterion, answer_table):
+    index, x, answers, _ = batch
+    x = x.to(device)
+    answers = answers.to(device)
+
+    # Forward Pass
+    outputs = model(x).squeeze(1)
+    loss = criterion(outputs, answers)
 
-    return val_loss, accuracy
+    # Accuracy, summed over the batch
+    _, predicted = outputs.max(1)
+    answer_ids, answer_counts, num_answers = [t[index.to(device)] for t in answer_table]
+    accuracy = accuracy_vqa(answer_ids, answer_counts, num_answers, predicted).sum()
+    return {"loss": loss, "num_samples": len(index), "metrics": {"accuracy": accuracy}}
 
 def main(model_config, data_config):
     writer = SummaryWriter(data_config.checkpoint_dir)
     os.makedirs(data_config.checkpoint_dir, exist_ok=True)
 
     # Creating Dataset and Dataloaders
-    train_dataset = VizWizDataset(df_path=data_config.train_data_path, filter_answerable=False)
-    valid_dataset = VizWizDataset(df_path=data_config.val_data_path, filter_answerable=False)
+    train_dataset = VizWizDataset(df_path=data_config.train_data_path, 
+                                  filter_answerable=False, 
+                                  feature_store=getattr(data_config, 'train_feature_store', None))
+    valid_dataset = VizWizDataset(df_path=data_config.val_data_path, 
+                                  filter_answerable=False,
+                                  feature_store=getattr(data_config, 'val_feature_store', None))
 
     train_loader = DataLoader(train_dataset, batch_size=model_config.batch_size, shuffle=True)
     val_loader = DataLoader(valid_dataset, batch_size=model_config.batch_size, shuffle=True)
@@ -101,11 +67,28 @@ def main(model_config, data_config):
 
     device = torch.device(model_config.device if torch.cuda.is_available() else 'cpu')
 
+    # Encoding final and human answers once per split, the training loop only sees integer ids
+    train_dataset.encode_answers(enc)
+    valid_dataset.encode_answers(enc)
+    train_answer_table = [t.to(device) for t in train_dataset.answer_table]
+    val_answer_table = [t.to(device) for t in valid_dataset.answer_table]
+
     model_vqa = VQAModelV3(model_config.input_dim, model_config.hidden_dim, output_dim).to(device)
 
     criterion = nn.CrossEntropyLoss()
     optimizer, lr_scheduler = get_optimizer(model_config, model_vqa)
 
+    train_trainer = Trainer(model_vqa, 
+                            partial(vqa_step, criterion=criterion, answer_table=train_answer_table), 
+                            optimizer=optimizer, 
+                            device=device,
+                            precision=getattr(model_config, 'precision', 'fp32'),
+                            grad_accum_steps=getattr(model_config, 'grad_accum_steps', 1))
+    val_trainer = Trainer(model_vqa, 
+                          partial(vqa_step, criterion=criterion, answer_table=val_answer_table), 
+                          device=device,
+                          precision=getattr(model_config, 'precision', 'fp32'))
+
 
     # Define the variables for saving the best checkpoint
     best_val_acc = 0.0
@@ -123,8 +106,10 @@ def main(model_config, data_config):
         print(f"Epoch [{epoch + 1}/{model_config.num_epochs}]:")
         start_time = time.perf_counter()
         
-        train_loss, train_acc = train_vqa(model_vqa, train_loader, criterion, optimizer, device, enc)
-        val_loss, val_acc = validate_vqa(model_vqa, val_loader, criterion, device, enc)
+        train_results = train_trainer.train_epoch(train_loader)
+        val_results = val_trainer.evaluate(val_loader)
+        train_loss, train_acc = train_results["loss"], train_results["accuracy"]
+        val_loss, val_acc = val_results["loss"], val_results["accuracy"]
         
         epoch_time = time.perf_counter() - start_time
         avg_step_time = epoch_time / (len(train_loader) + len(val_loader))
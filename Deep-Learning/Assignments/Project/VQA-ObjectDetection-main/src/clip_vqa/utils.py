@@ -1,7 +1,7 @@
 import torch 
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 import numpy as np 
-from itertools import combinations
+from collections import Counter
 
 
 def get_optimizer(model_config, model):
@@ -12,11 +12,37 @@ def get_optimizer(model_config, model):
     else:
         raise NotImplementedError(f"{model_config.optimizer} not implemented")
 
-def accuracy_vqa(df, index, value):
-    if value == None:
-        return 0
-    ans_list = [elem['answer'] for elem in df.iloc[index]['answers']]
-    return np.divide(np.sum(np.minimum(np.count_nonzero(np.array(list(combinations(ans_list, 9))) == value, axis=1), 1)), 10)
+def build_answer_table(df, enc):
+    """Encodes the human answers of every sample once per split.
+
+    Returns answer_ids (N, K) with the distinct answer ids of each sample, answer_counts (N, K)
+    with how many humans gave each of them and num_answers (N,). Answers outside the encoder
+    vocabulary and padding get id -1 so that they never match a prediction.
+    """
+    vocab = {answer: idx for idx, answer in enumerate(enc.categories_[0])}
+    answers = [Counter(elem['answer'] for elem in ans_list) for ans_list in df['answers']]
+    max_answers = max(len(counts) for counts in answers)
+
+    answer_ids = np.full((len(answers), max_answers), -1, dtype=np.int64)
+    answer_counts = np.zeros((len(answers), max_answers), dtype=np.float32)
+    for row, counts in enumerate(answers):
+        answer_ids[row, :len(counts)] = [vocab.get(answer, -1) for answer in counts]
+        answer_counts[row, :len(counts)] = list(counts.values())
+    num_answers = answer_counts.sum(1)
+    return torch.as_tensor(answer_ids), torch.as_tensor(answer_counts), torch.as_tensor(num_answers)
+
+
+def accuracy_vqa(answer_ids, answer_counts, num_answers, predicted):
+    """Per sample VQA accuracy of a batch of predicted answer ids.
+
+    Closed form of min(#humans/3, 1) averaged over all n choose n-1 subsets of the n human 
+    answers: dropping one of the m humans who gave the predicted answer leaves m-1 matches, 
+    dropping any of the other n-m humans leaves m matches.
+    """
+    matches = ((answer_ids == predicted.unsqueeze(1)) * answer_counts).sum(1)
+    acc_drop_match = torch.clamp((matches - 1) / 3, min=0, max=1)
+    acc_drop_other = torch.clamp(matches / 3, max=1)
+    return (matches * acc_drop_match + (num_answers - matches) * acc_drop_other) / num_answers
 
 
 class Config:
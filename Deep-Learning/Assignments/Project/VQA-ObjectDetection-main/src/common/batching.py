@@ -0,0 +1,93 @@
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+def token_lengths(tokenizer, texts, max_length=None):
+    """Number of tokens of every text after truncation, special tokens included"""
+    encoding = tokenizer(list(texts), truncation=True, max_length=max_length)
+    return [len(ids) for ids in encoding["input_ids"]]
+
+
+def pad_to_longest(sequences, lengths, padding_value=0):
+    """Stacks 1d sequences into a (batch, longest length) tensor.
+
+    Works for sequences that were already padded to a fixed max_length as well as for unpadded
+    ones, only the first lengths[i] values of sequence i are kept.
+    """
+    max_length = max(lengths)
+    padded = torch.full((len(sequences), max_length), padding_value, dtype=sequences[0].dtype)
+    for idx, (sequence, length) in enumerate(zip(sequences, lengths)):
+        padded[idx, :length] = sequence[:length]
+    return padded
+
+
+class LengthBucketBatchSampler(Sampler):
+    """Batch sampler that groups samples of similar length.
+
+    Indices are (optionally) shuffled and split into buckets of bucket_size batches. Every bucket is 
+    sorted by length and cut into batches, and the batch order is shuffled again so consecutive 
+    steps still see different lengths.
+
+    For distributed training every rank builds the same batches (same seed and epoch) and takes
+    every num_replicas-th one. All ranks get the same number of batches, the last ones are dropped
+    with drop_last and otherwise the first batches are repeated, like DistributedSampler. With
+    pad=False (evaluation) nothing is repeated, so every sample is seen exactly once and the
+    ranks can differ by one batch.
+    """
+    def __init__(self, lengths, batch_size, bucket_size=100, shuffle=True, drop_last=False, seed=0,
+                 num_replicas=1, rank=0, pad=True):
+        assert 0 <= rank < num_replicas, f"rank should be in [0, {num_replicas})"
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.pad = pad
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=generator).numpy()
+        else:
+            indices = np.arange(len(self.lengths))
+
+        batches = []
+        chunk = self.batch_size * self.bucket_size
+        for start in range(0, len(indices), chunk):
+            bucket = indices[start:start + chunk]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches.extend(bucket[i:i + self.batch_size].tolist() for i in range(0, len(bucket), self.batch_size))
+
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        if self.num_replicas > 1:
+            if self.drop_last or self.pad:
+                num_batches = len(self) * self.num_replicas
+                batches = batches[:num_batches] if self.drop_last else (batches * self.num_replicas)[:num_batches]
+            batches = batches[self.rank::self.num_replicas]
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        # a new order every epoch even if set_epoch is never called
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size // self.num_replicas
+        num_batches = (len(self.lengths) + self.batch_size - 1) // self.batch_size
+        if not self.pad:
+            return len(range(self.rank, num_batches, self.num_replicas))
+        return (num_batches + self.num_replicas - 1) // self.num_replicas
@@ -0,0 +1,79 @@
+import os
+import torch
+import torch.distributed as dist
+from loguru import logger
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def setup_distributed(backend="gloo", threads_per_process=None):
+    """Joins the process group when launched by torchrun (WORLD_SIZE > 1).
+
+    On CPU every process gets an equal share of the cores of its host unless threads_per_process
+    is given, otherwise all the processes would oversubscribe the machine.
+    Returns rank, world_size and local_rank.
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size > 1 and not is_distributed():
+        dist.init_process_group(backend=backend)
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+
+    if threads_per_process is None and local_world_size > 1 and "OMP_NUM_THREADS" not in os.environ:
+        threads_per_process = max(1, (os.cpu_count() or 1) // local_world_size)
+    if threads_per_process is not None:
+        torch.set_num_threads(threads_per_process)
+
+    if world_size > 1:
+        logger.info(f"rank {get_rank()}/{world_size} (local rank {local_rank}) using {torch.get_num_threads()} threads")
+    return get_rank(), world_size, local_rank
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    """obj of rank src on every rank, e.g. the run directory created by rank 0"""
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def all_reduce_sum(tensor):
+    """Sum of tensor over all the ranks, returned as a new tensor"""
+    tensor = tensor.clone()
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def all_gather_tensors(tensor):
+    """Concatenation of the (possibly differently sized) tensors of all the ranks, in rank order"""
+    if not is_distributed():
+        return tensor
+    tensors = [None] * get_world_size()
+    dist.all_gather_object(tensors, tensor.cpu())
+    return torch.cat(tensors)
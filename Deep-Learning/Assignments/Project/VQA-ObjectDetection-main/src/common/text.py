@@ -0,0 +1,15 @@
+import os
+import sys
+
+# TextNormalizer is defined once in webUI/text.py (re and functools only), so training and
+# serving normalize questions with the same code
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "webUI"))
+from text import CONTRACTIONS, TextNormalizer
+
+
+def normalize_questions(data, column="question", normalizer=None):
+    """Copy of the dataframe data with its question column normalized as the web UI does before inference"""
+    normalizer = TextNormalizer() if normalizer is None else normalizer
+    data = data.copy()
+    data[column] = normalizer.normalize_series(data[column])
+    return data
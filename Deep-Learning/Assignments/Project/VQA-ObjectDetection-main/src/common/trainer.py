@@ -0,0 +1,117 @@
+import time
+import contextlib
+import torch
+from torch.nn.parallel import DistributedDataParallel
+from loguru import logger
+from tqdm import tqdm
+from common.distributed import all_reduce_sum, all_gather_tensors, is_main_process
+
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+class Trainer:
+    """Training and validation loop shared by all the VQA training scripts.
+
+    Scripts only provide the model, optimizer and a step_fn(model, batch, device) returning a dict with
+        loss        : mean loss of the batch
+        num_samples : number of samples in the batch
+        metrics     : (optional) dict of per batch sums, e.g. number of correct answers
+        outputs     : (optional) dict of tensors gathered over the epoch, e.g. scores for average precision
+
+    Losses and metrics are accumulated on device and synced with the host once per epoch.
+    Supports autocast (bf16 on cpu, bf16/fp16 on cuda) and gradient accumulation.
+    With a DistributedDataParallel model, gradients are only all-reduced on optimizer steps and the
+    epoch results are summed over all the ranks.
+    """
+    def __init__(self, model, step_fn, optimizer=None, device='cpu', scheduler=None,
+                 precision='fp32', grad_accum_steps=1, log_every=50):
+        assert precision in PRECISIONS, f"precision should be one of {list(PRECISIONS)}"
+        self.model = model
+        self.step_fn = step_fn
+        self.optimizer = optimizer
+        self.device = torch.device(device)
+        # scheduler stepped after every optimizer step, epoch level schedulers stay in the scripts
+        self.scheduler = scheduler
+        self.amp_dtype = PRECISIONS[precision]
+        self.grad_accum_steps = grad_accum_steps
+        self.log_every = log_every
+        self.scaler = torch.cuda.amp.GradScaler(enabled=precision == 'fp16' and self.device.type == 'cuda')
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device.type,
+                              dtype=self.amp_dtype if self.amp_dtype is not None else torch.bfloat16,
+                              enabled=self.amp_dtype is not None)
+
+    def optimizer_step(self):
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.optimizer.zero_grad(set_to_none=True)
+        if self.scheduler is not None:
+            self.scheduler.step()
+
+    def run_epoch(self, data_loader, train=True):
+        self.model.train(train)
+        loss_sum = torch.zeros((), device=self.device)
+        metrics = {}
+        outputs = {}
+        num_samples = 0
+        num_steps = len(data_loader)
+
+        if train:
+            self.optimizer.zero_grad(set_to_none=True)
+        start_time = time.perf_counter()
+        progress = tqdm(data_loader, disable=not is_main_process())
+        with torch.set_grad_enabled(train):
+            for step, batch in enumerate(progress):
+                with self.autocast():
+                    result = self.step_fn(self.model, batch, self.device)
+                loss = result["loss"]
+
+                if train:
+                    sync_step = (step + 1) % self.grad_accum_steps == 0 or step + 1 == num_steps
+                    # the last group of the epoch can be shorter, its gradient is averaged over its own steps
+                    group_start = step - step % self.grad_accum_steps
+                    group_size = min(self.grad_accum_steps, num_steps - group_start)
+                    # skip the gradient all-reduce of accumulation steps
+                    no_sync = self.model.no_sync() if isinstance(self.model, DistributedDataParallel) and not sync_step else contextlib.nullcontext()
+                    with no_sync:
+                        self.scaler.scale(loss / group_size).backward()
+                    if sync_step:
+                        self.optimizer_step()
+
+                batch_size = result["num_samples"]
+                num_samples += batch_size
+                loss_sum += loss.detach().float() * batch_size
+                for name, value in result.get("metrics", {}).items():
+                    metrics[name] = metrics.get(name, 0) + value.detach().float()
+                for name, value in result.get("outputs", {}).items():
+                    outputs.setdefault(name, []).append(value.detach())
+
+                if (step + 1) % self.log_every == 0:
+                    progress.set_postfix(samples_per_sec=f"{num_samples / (time.perf_counter() - start_time):.1f}")
+
+        # single host sync for the whole epoch, summed over all the ranks when distributed
+        epoch_time = time.perf_counter() - start_time
+        names = sorted(metrics)
+        totals = torch.stack([loss_sum, torch.tensor(float(num_samples), device=self.device)]
+                             + [torch.as_tensor(metrics[name], device=self.device).float() for name in names])
+        totals = all_reduce_sum(totals).tolist()
+        num_samples = int(totals[1])
+        results = {"loss": totals[0] / max(num_samples, 1)}
+        for name, value in zip(names, totals[2:]):
+            results[name] = value / max(num_samples, 1)
+        results["outputs"] = {name: all_gather_tensors(torch.cat(values).float().cpu()) for name, values in outputs.items()}
+        results["epoch_time"] = epoch_time
+        results["samples_per_sec"] = num_samples / epoch_time
+        results["step_time"] = epoch_time / max(num_steps, 1)
+
+        mode = "train" if train else "valid"
+        if is_main_process():
+            logger.info(f"[{mode}] {num_samples} samples in {epoch_time:.1f}s - {results['samples_per_sec']:.1f} samples/s - {results['step_time']*1e3:.1f}ms/step")
+        return results
+
+    def train_epoch(self, data_loader):
+        return self.run_epoch(data_loader, train=True)
+
+    def evaluate(self, data_loader):
+        return self.run_epoch(data_loader, train=False)
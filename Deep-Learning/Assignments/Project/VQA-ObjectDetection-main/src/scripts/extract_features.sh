@@ -7,4 +7,8 @@ save_path=/nfs/home/scg1143/MLDS/Quarter3/DeepLearning/Project/VQA-ObjectDetecti
 python3 clip_vqa/extract_features.py \
 --data-path=$data_path \
 --feat-save-dir=$feat_save_dir \
---save-path=$save_path
\ No newline at end of file
+--save-path=$save_path \
+--device=cpu \
+--batched \
+--batch-size=64 \
+--num-workers=8
@@ -0,0 +1,14 @@
+# !/bin/bash
+
+data_dir=/nfs/home/scg1143/MLDS/Quarter3/DeepLearning/Project/VQA-ObjectDetection/vizviz/vqa
+cache_dir=/nfs/home/scg1143/MLDS/Quarter3/DeepLearning/Project/VQA-ObjectDetection/vizviz/vqa/vilt_cache
+
+python vilt_vqa/preprocess.py \
+    --data-path=$data_dir/train_df_RN50.json \
+    --cache-dir=$cache_dir/train \
+    --num-workers=8
+
+python vilt_vqa/preprocess.py \
+    --data-path=$data_dir/val_df_RN50.json \
+    --cache-dir=$cache_dir/val \
+    --num-workers=8
@@ -5,6 +5,7 @@ val_image_dir=/nfs/home/scg1143/MLDS/Quarter3/DeepLearning/Project/VQA-ObjectDet
 train_file_path=/nfs/home/scg1143/MLDS/Quarter3/DeepLearning/Project/VQA-ObjectDetection/vizviz/vqa/train_df.csv
 val_file_path=/nfs/home/scg1143/MLDS/Quarter3/DeepLearning/Project/VQA-ObjectDetection/vizviz/vqa/eval_df.csv
 save_dir=/nfs/home/scg1143/MLDS/Quarter3/DeepLearning/Project/VQA-ObjectDetection/runs/ans_model
+feature_cache_dir=/nfs/home/scg1143/MLDS/Quarter3/DeepLearning/Project/VQA-ObjectDetection/vizviz/vqa/ans_features
 
 # num_epochs=40
 # learning_rate=0.0001
@@ -20,6 +21,7 @@ python answerability_detection/train.py \
     --train-file-path=$train_file_path \
     --val-file-path=$val_file_path \
     --save-dir=$save_dir \
+    --feature-cache-dir=$feature_cache_dir \
     --num-epochs=$num_epochs \
     --lr=$learning_rate \
     --batch-size=$batch_size
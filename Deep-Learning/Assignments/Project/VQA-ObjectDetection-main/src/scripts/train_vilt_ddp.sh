@@ -0,0 +1,17 @@
+# !/bin/bash
+
+config_path=/nfs/home/scg1143/MLDS/Quarter3/DeepLearning/Project/VQA-ObjectDetection/src/vilt_vqa/config.yaml
+# processes per host, number of hosts, rank of this host and address of the rank 0 host
+nproc=${NPROC:-4}
+nnodes=${NNODES:-1}
+node_rank=${NODE_RANK:-0}
+master_addr=${MASTER_ADDR:-127.0.0.1}
+master_port=${MASTER_PORT:-29500}
+
+torchrun \
+    --nnodes=$nnodes \
+    --node_rank=$node_rank \
+    --nproc_per_node=$nproc \
+    --master_addr=$master_addr \
+    --master_port=$master_port \
+    vilt_vqa/train.py $config_path
@@ -0,0 +1,19 @@
+# !/bin/bash
+
+config_path=/nfs/home/scg1143/MLDS/Quarter3/DeepLearning/Project/VQA-ObjectDetection/src/vilt_vqa/config.yaml
+model_path=/nfs/home/scg1143/MLDS/Quarter3/DeepLearning/Project/VQA-ObjectDetection/runs/vilt_vqa/0/vilt_vqa_full.pth
+heads_path=/nfs/home/scg1143/MLDS/Quarter3/DeepLearning/Project/VQA-ObjectDetection/runs/vilt_vqa/vilt_exit_heads.pth
+
+python vilt_vqa/early_exit.py $config_path \
+    --mode=train \
+    --model-path=$model_path \
+    --heads-path=$heads_path \
+    --exit-layers 4 6 8 10 \
+    --epochs=3
+
+python vilt_vqa/early_exit.py $config_path \
+    --mode=curve \
+    --model-path=$model_path \
+    --heads-path=$heads_path \
+    --thresholds 0.5 0.6 0.7 0.8 0.9 0.95 0.99 \
+    --output=early_exit_curve.csv
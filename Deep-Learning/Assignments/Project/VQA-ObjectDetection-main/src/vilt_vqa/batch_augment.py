@@ -0,0 +1,221 @@
+import math
+import numpy as np
+import torch
+from dataset import collate_text, augment_list
+
+# ops of dataset.augment_list that move pixels, the others only change their values
+GEOMETRIC_OPS = {"Rotate", "ShearX", "ShearY", "TranslateXabs", "TranslateYabs"}
+
+
+def pad_uint8(pixels):
+    """Pads (C, H, W) uint8 images to the largest height and width at the bottom right, like the
+    ViLT image processor. Returns (B, C, H, W) uint8 pixels and the (B, H, W) pixel mask."""
+    height = max(p.shape[1] for p in pixels)
+    width = max(p.shape[2] for p in pixels)
+    batch = torch.zeros((len(pixels), pixels[0].shape[0], height, width), dtype=torch.uint8)
+    mask = torch.zeros((len(pixels), height, width), dtype=torch.long)
+    for i, p in enumerate(pixels):
+        batch[i, :, :p.shape[1], :p.shape[2]] = p
+        mask[i, :p.shape[1], :p.shape[2]] = 1
+    return batch, mask
+
+
+def apply_lut(x, lut):
+    """x (B, C, H, W) uint8 through a (256,) or per image and channel (B, C, 256) uint8 lookup table"""
+    if x.device.type != "cpu":
+        if lut.dim() == 1:
+            return lut[x.long()]
+        b, c = x.shape[:2]
+        return torch.gather(lut, 2, x.reshape(b, c, -1).long()).view_as(x)
+    # np.take on uint8 planes is several times faster than torch indexing on cpu
+    x, lut = x.contiguous().numpy(), lut.contiguous().numpy()
+    out = np.empty_like(x)
+    if lut.ndim == 1:
+        np.take(lut, x, out=out)
+    else:
+        for i in range(x.shape[0]):
+            for j in range(x.shape[1]):
+                np.take(lut[i, j], x[i, j], out=out[i, j])
+    return torch.from_numpy(out)
+
+
+def zero_padding(x, sizes):
+    for i, (height, width) in enumerate(sizes):
+        x[i, :, height:] = 0
+        x[i, :, :, width:] = 0
+    return x
+
+
+def to_uint8(x):
+    # PIL truncates blended values
+    return x.clamp_(0, 255).trunc_().to(torch.uint8)
+
+
+def grayscale(x):
+    """PIL convert("L") of (..., 3, H, W) uint8, as int32"""
+    x = x.int()
+    return (x[..., 0, :, :] * 19595 + x[..., 1, :, :] * 38470 + x[..., 2, :, :] * 7471 + 0x8000) >> 16
+
+
+def autocontrast(x, sizes, _):
+    # float64 and a true division as in PIL, float32 or torch's scalar / tensor (a reciprocal times
+    # the scalar) round some levels one below
+    ix = torch.arange(256, dtype=torch.float64)
+    luts = torch.empty((x.shape[0], x.shape[1], 256), dtype=torch.uint8)
+    for i, (height, width) in enumerate(sizes):
+        region = x[i, :, :height, :width]
+        lo, hi = region.amin((1, 2)).double(), region.amax((1, 2)).double()
+        scale = torch.full_like(hi, 255.0) / (hi - lo).clamp(min=1)
+        lut = to_uint8(ix * scale.unsqueeze(-1) - (lo * scale).unsqueeze(-1))
+        # constant channels are left unchanged
+        luts[i] = torch.where((hi > lo).unsqueeze(-1), lut, ix.to(torch.uint8))
+    return apply_lut(x, luts)
+
+
+def equalize(x, sizes, _):
+    ix = torch.arange(256, dtype=torch.long)
+    luts = torch.empty((x.shape[0], x.shape[1], 256), dtype=torch.uint8)
+    for i, (height, width) in enumerate(sizes):
+        for j in range(x.shape[1]):
+            hist = torch.bincount(x[i, j, :height, :width].reshape(-1), minlength=256)
+            used = hist.nonzero().view(-1)
+            # PIL: step = (number of pixels - count of the last used level) // 255, lut[i] = (step // 2 + pixels below i) // step
+            step = (hist.sum() - hist[used[-1]]).item() // 255 if len(used) > 1 else 0
+            if step == 0:
+                luts[i, j] = ix.to(torch.uint8)
+            else:
+                below = torch.cumsum(hist, 0) - hist
+                luts[i, j] = ((step // 2 + below) // step).clamp(max=255).to(torch.uint8)
+    return apply_lut(x, luts)
+
+
+def posterize(x, sizes, v):
+    bits = max(1, int(v))
+    return x & (~(2 ** (8 - bits) - 1) & 0xFF)
+
+
+def color(x, sizes, v):
+    # padding stays black since the gray level of black is 0
+    gray = grayscale(x).unsqueeze(1).float()
+    return to_uint8((x.float() - gray).mul_(v).add_(gray))
+
+
+def contrast(x, sizes, v):
+    # mean of the grayscale image over its own pixels, rounded as in PIL
+    ix = torch.arange(256, dtype=torch.float32)
+    luts = torch.empty((x.shape[0], 256), dtype=torch.uint8)
+    for i, (height, width) in enumerate(sizes):
+        mean = math.floor(grayscale(x[i, :, :height, :width]).float().mean().item() + 0.5)
+        luts[i] = to_uint8(mean + v * (ix - mean))
+    return apply_lut(x, luts.unsqueeze(1).expand(-1, x.shape[1], -1))
+
+
+def brightness(x, sizes, v):
+    return apply_lut(x, to_uint8(v * torch.arange(256, dtype=torch.float32)))
+
+
+def sharpness(x, sizes, v):
+    out = x.clone()
+    for i, (height, width) in enumerate(sizes):
+        if height < 3 or width < 3:
+            continue
+        region = x[i, :, :height, :width].to(torch.int16)
+        # PIL SMOOTH filter [[1, 1, 1], [1, 5, 1], [1, 1, 1]] / 13, rounded, on the interior pixels only
+        rows = region[:, :, :-2] + region[:, :, 1:-1] + region[:, :, 2:]
+        center = region[:, 1:-1, 1:-1]
+        smooth = ((rows[:, :-2] + rows[:, 1:-1] + rows[:, 2:] + 4 * center) * 2 + 13).div_(26, rounding_mode="floor").float()
+        out[i, :, 1:height - 1, 1:width - 1] = to_uint8((center.float() - smooth).mul_(v).add_(smooth))
+    return out
+
+
+def affine_matrix(name, v, width, height, sign):
+    """PIL inverse map (output -> input pixel coordinates) of a geometric op, as a 2x3 matrix"""
+    v = v * sign
+    if name == "Rotate":
+        angle = -math.radians(v)
+        cos, sin = math.cos(angle), math.sin(angle)
+        cx, cy = width / 2, height / 2
+        return [[cos, sin, cx - cos * cx - sin * cy], [-sin, cos, cy + sin * cx - cos * cy]]
+    if name == "ShearX":
+        return [[1, v, 0], [0, 1, 0]]
+    if name == "ShearY":
+        return [[1, 0, 0], [v, 1, 0]]
+    if name == "TranslateXabs":
+        return [[1, 0, v], [0, 1, 0]]
+    return [[1, 0, 0], [0, 1, v]]
+
+
+def warp(x, mask, matrices):
+    """Nearest neighbour resampling of the whole batch with per image PIL style affine maps, outside is black.
+    As in PIL, output pixel centers are mapped to the input and the input pixel containing them is taken."""
+    b, c, height, width = x.shape
+    xs = torch.arange(width, dtype=torch.float32, device=x.device) + 0.5
+    ys = torch.arange(height, dtype=torch.float32, device=x.device) + 0.5
+    m = matrices.view(b, 2, 3, 1, 1)
+    source_x = (m[:, 0, 0] * xs + m[:, 0, 1] * ys.view(-1, 1) + m[:, 0, 2]).floor_()
+    source_y = (m[:, 1, 0] * xs + m[:, 1, 1] * ys.view(-1, 1) + m[:, 1, 2]).floor_()
+    # the padded canvas is zero outside each image, so only the canvas bounds are checked
+    valid = (source_x >= 0) & (source_x < width) & (source_y >= 0) & (source_y < height) & mask.bool()
+    index = (source_y.clamp_(0, height - 1) * width + source_x.clamp_(0, width - 1)).long()
+    out = torch.gather(x.reshape(b, c, -1), 2, index.view(b, 1, -1).expand(b, c, -1)).view_as(x)
+    return out.masked_fill_(~valid.unsqueeze(1), 0)
+
+
+COLOR_OPS = {"AutoContrast": autocontrast, "Equalize": equalize, "Posterize": posterize, "Color": color,
+             "Contrast": contrast, "Brightness": brightness, "Sharpness": sharpness}
+
+
+class BatchRandAugment:
+    """dataset.RandAugment on a padded uint8 batch (B, C, H, W) and its pixel mask (B, H, W).
+
+    Every image draws n ops with replacement from the same op list with the same magnitudes and
+    random signs, but each op runs once for all the images that drew it: lookup tables for the
+    tone ops and a single affine gather per step for the geometric ones.
+    """
+    def __init__(self, n, m, generator=None):
+        self.n = n
+        self.m = m  # [0, 30]
+        self.generator = generator
+        self.ops = [(op.__name__, (float(self.m) / 30) * float(maxval - minval) + minval) for op, minval, maxval in augment_list()]
+
+    def __call__(self, pixels, pixel_mask):
+        b = pixels.size(0)
+        choices = torch.randint(len(self.ops), (b, self.n), generator=self.generator)
+        signs = torch.where(torch.rand((b, self.n), generator=self.generator) > 0.5, -1.0, 1.0)
+        sizes = list(zip(pixel_mask.amax(2).sum(1).tolist(), pixel_mask.amax(1).sum(1).tolist()))
+        pixels = pixels.clone()
+
+        for step in range(self.n):
+            warped, matrices = [], []
+            for i in range(b):
+                name, v = self.ops[choices[i, step]]
+                if name in GEOMETRIC_OPS:
+                    warped.append(i)
+                    matrices.append(affine_matrix(name, v, sizes[i][1], sizes[i][0], signs[i, step].item()))
+            if len(warped) > 0:
+                idx = torch.tensor(warped)
+                pixels[idx] = warp(pixels[idx], pixel_mask[idx], torch.tensor(matrices, dtype=torch.float32, device=pixels.device))
+
+            for op_id, (name, v) in enumerate(self.ops):
+                if name not in COLOR_OPS:
+                    continue
+                idx = (choices[:, step] == op_id).nonzero().view(-1)
+                if len(idx) > 0:
+                    selected = [sizes[i] for i in idx.tolist()]
+                    # lookup tables also map the black padding, it has to stay black for the next geometric op
+                    pixels[idx] = zero_padding(COLOR_OPS[name](pixels[idx], selected, v), selected)
+        return pixels
+
+
+def batch_augment_collate_fn(batch, processor, num_labels, augment, image_mean, image_std):
+    """collate_fn for items with uint8 pixel_values (CachedVQADataset with uint8=True): pads the
+    batch, augments it with augment (e.g. BatchRandAugment) and normalizes it"""
+    pixels, pixel_mask = pad_uint8([item['pixel_values'] for item in batch])
+    if augment is not None:
+        pixels = augment(pixels, pixel_mask)
+    pixel_values = (pixels.float() / 255 - image_mean) / image_std
+    out = collate_text(batch, processor, num_labels)
+    # padding is zero after normalization, as with the image processor
+    out['pixel_values'] = pixel_values * pixel_mask.unsqueeze(1)
+    out['pixel_mask'] = pixel_mask
+    return out
@@ -3,6 +3,9 @@ import warnings
 warnings.filterwarnings("ignore")
 
 import os
+import sys
+import json
+import hashlib
 import pandas as pd
 import torch
 from PIL import Image
@@ -10,6 +13,9 @@ import random
 import PIL, PIL.ImageOps, PIL.ImageEnhance, PIL.ImageDraw
 import numpy as np 
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.batching import pad_to_longest, token_lengths
+
 
 def ShearX(img, v):  # [-0.3, 0.3]
     assert -0.3 <= v <= 0.3
@@ -166,43 +172,73 @@ class RandAugment:
 def get_score(count: int) -> float:
     return min(1.0, count / 3)
 
+def build_soft_targets(data, label2id):
+    """Computes sparse soft targets for every row of data in one vectorized pass.
+
+    Returns CSR style arrays: the labels and scores of row i are 
+    indices[indptr[i]:indptr[i+1]] and scores[indptr[i]:indptr[i+1]].
+    """
+    answers = data["answers"].reset_index(drop=True).explode().dropna().str["answer"]
+    labels = answers.map(label2id).dropna().astype(np.int64)
+    counts = labels.groupby([labels.index, labels]).size()
+
+    rows = counts.index.get_level_values(0).to_numpy()
+    indices = counts.index.get_level_values(1).to_numpy().astype(np.int64)
+    scores = np.minimum(1.0, counts.to_numpy() / 3).astype(np.float32)
+    indptr = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(data)), out=indptr[1:])
+    return indptr, indices, scores
+
+
+def targets_fingerprint(data, label2id):
+    """Hash of label2id and of the answers of every row, the soft targets depend on nothing else"""
+    content = json.dumps([sorted(label2id.items()), data["answers"].tolist()], default=str)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def load_soft_targets(data, label2id, cache_path=None):
+    """Loads the soft targets from cache_path if it was built for the same data and label2id, else builds and caches them"""
+    fingerprint = targets_fingerprint(data, label2id) if cache_path is not None else None
+    if cache_path is not None and os.path.exists(cache_path):
+        cache = np.load(cache_path)
+        if "fingerprint" in cache.files and str(cache["fingerprint"]) == fingerprint:
+            print(f"Loaded Soft Targets from {cache_path}")
+            return cache["indptr"], cache["indices"], cache["scores"]
+        print(f"{cache_path} does not match the data or label2id, rebuilding")
+    indptr, indices, scores = build_soft_targets(data, label2id)
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        # written to a temporary file first so that a reader never sees a partial npz
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, indptr=indptr, indices=indices, scores=scores, fingerprint=fingerprint)
+        os.replace(tmp_path, cache_path)
+        print(f"Saved Soft Targets to {cache_path}")
+    return indptr, indices, scores
+
+
 def add_label_score(data, label2id):
-    label_list = []
-    score_list = []
-    for idx, annotation in data.iterrows():
-        answers_dict = annotation["answers"]
-        answer_count = {}
-        for answers in answers_dict:
-            answer = answers["answer"]
-            answer_count[answer] = answer_count.get(answer, 0) + 1
-
-        labels = []
-        scores = []
-        for answer_word in answer_count:
-            if answer_word in list(label2id.keys()):
-                labels.append(label2id[answer_word])
-                scores.append(get_score(answer_count[answer_word]))
-
-        label_list.append(labels)
-        score_list.append(scores)
-    data['labels'] = label_list
-    data['scores'] = score_list
+    indptr, indices, scores = build_soft_targets(data, label2id)
+    data['labels'] = [indices[start:end].tolist() for start, end in zip(indptr[:-1], indptr[1:])]
+    data['scores'] = [scores[start:end].tolist() for start, end in zip(indptr[:-1], indptr[1:])]
     return data
 
 
 class VQADataset(torch.utils.data.Dataset):
     """VQA (v2) dataset."""
 
-    def __init__(self, data, processor, label2id):
+    def __init__(self, data, processor, label2id, targets=None):
         print(f"Actual Data Size : {data.shape[0]}")
         #self.data = data[data.answerable == 1]
         self.data = data 
         #self.data = self.data.iloc[:128]
         print(f"Filtered Data Size : {self.data.shape[0]}")
         self.image_paths = self.data.image_path.tolist()
-        self.labels = self.data.labels.tolist()
-        self.scores = self.data.scores.tolist()
+        if targets is None:
+            targets = build_soft_targets(self.data, label2id)
+        self.indptr, self.labels, self.scores = targets
         self.questions = self.data.question.tolist()
+        self.lengths = token_lengths(processor.tokenizer, self.questions)
         self.processor = processor
         self.label2id = label2id
 
@@ -216,41 +252,57 @@ class VQADataset(torch.utils.data.Dataset):
         #image = augmenter(image)
         text = self.questions[idx]
 
-        encoding = self.processor(image, text, padding="max_length", truncation=True, return_tensors="pt")
+        # questions are padded per batch in collate_fn
+        encoding = self.processor(image, text, padding=False, truncation=True, return_tensors="pt")
         # remove batch dimension
         for k,v in encoding.items():
             encoding[k] = v.squeeze()
-        # add labels
-        labels = self.labels[idx]
-        scores = self.scores[idx]
-        # # based on: https://github.com/dandelin/ViLT/blob/762fd3975c180db6fc88f577cf39549983fa373a/vilt/modules/objectives.py#L301
-        targets = torch.zeros(len(self.label2id))
-        for label, score in zip(labels, scores):
-              targets[label] = score
-        encoding["labels"] = targets
+        # add sparse labels, densified per batch in collate_fn
+        start, end = self.indptr[idx], self.indptr[idx + 1]
+        encoding["labels"] = torch.from_numpy(self.labels[start:end])
+        encoding["scores"] = torch.from_numpy(self.scores[start:end])
         return encoding
 
 
-def collate_fn(batch, processor):
+def densify_targets(labels, scores, num_labels):
+    """Builds the (batch, num_labels) soft target matrix from per item sparse labels and scores"""
+    # based on: https://github.com/dandelin/ViLT/blob/762fd3975c180db6fc88f577cf39549983fa373a/vilt/modules/objectives.py#L301
+    targets = torch.zeros(len(labels), num_labels)
+    rows = torch.cat([torch.full((len(item),), idx, dtype=torch.long) for idx, item in enumerate(labels)])
+    targets[rows, torch.cat(labels)] = torch.cat(scores)
+    return targets
+
+
+def collate_text(batch, processor, num_labels):
+    """Questions padded to the longest one in the batch and dense soft targets"""
     input_ids = [item['input_ids'] for item in batch]
-    pixel_values = [item['pixel_values'] for item in batch]
     attention_mask = [item['attention_mask'] for item in batch]
     token_type_ids = [item['token_type_ids'] for item in batch]
     labels = [item['labels'] for item in batch]
+    scores = [item['scores'] for item in batch]
+
+    # pad text only up to the longest question in the batch
+    lengths = [int(mask.sum()) for mask in attention_mask]
+
+    out = {}
+    out['input_ids'] = pad_to_longest(input_ids, lengths, processor.tokenizer.pad_token_id)
+    out['attention_mask'] = pad_to_longest(attention_mask, lengths)
+    out['token_type_ids'] = pad_to_longest(token_type_ids, lengths)
+    out['labels'] = densify_targets(labels, scores, num_labels)
+    return out
+
+
+def collate_fn(batch, processor, num_labels):
+    pixel_values = [item['pixel_values'] for item in batch]
 
     # create padded pixel values and corresponding pixel mask
     encoding = processor.image_processor.pad(pixel_values, return_tensors="pt")
 
     # create new batch
-    batch = {}
-    batch['input_ids'] = torch.stack(input_ids)
-    batch['attention_mask'] = torch.stack(attention_mask)
-    batch['token_type_ids'] = torch.stack(token_type_ids)
-    batch['pixel_values'] = encoding['pixel_values']
-    batch['pixel_mask'] = encoding['pixel_mask']
-    batch['labels'] = torch.stack(labels)
-
-    return batch
+    out = collate_text(batch, processor, num_labels)
+    out['pixel_values'] = encoding['pixel_values']
+    out['pixel_mask'] = encoding['pixel_mask']
+    return out
 
 
 # lambda batch: my_collate(batch, arg="myarg")
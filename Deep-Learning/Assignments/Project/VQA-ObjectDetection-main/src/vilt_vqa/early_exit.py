@@ -0,0 +1,178 @@
+import os
+import sys
+import time
+import argparse
+import yaml
+import torch
+import pandas as pd
+from torch import nn
+from loguru import logger
+from torch.utils.data import DataLoader
+from transformers import ViltProcessor, ViltForQuestionAnswering
+from dataset import collate_fn
+from utils import Config
+from train import load_label_mappings, build_datasets
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.trainer import Trainer
+# the exit heads are defined once in webUI/network.py, which serves the heads trained here
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "webUI"))
+from network import ViltExitHeads
+
+
+torch.manual_seed(1234)
+
+
+class EarlyExitVilt(nn.Module):
+    """Fine-tuned ViLT with exit heads, only the heads are trained"""
+    def __init__(self, vilt, exit_layers):
+        super().__init__()
+        self.vilt = vilt
+        for param in self.vilt.parameters():
+            param.requires_grad = False
+        config = vilt.config
+        self.exit_heads = ViltExitHeads(config.hidden_size, config.num_labels, exit_layers)
+
+    def train(self, mode=True):
+        super().train(mode)
+        # the backbone stays frozen and without dropout
+        self.vilt.eval()
+        return self
+
+    def forward(self, input_ids, attention_mask, token_type_ids, pixel_values, pixel_mask):
+        """logits of every exit head, in exit_layers order"""
+        with torch.no_grad():
+            hidden, mask = self.exit_heads.embed(self.vilt, input_ids, attention_mask, token_type_ids, pixel_values, pixel_mask)
+            states = []
+            for depth, layer in enumerate(self.vilt.vilt.encoder.layer[:max(self.exit_heads.exit_layers)], start=1):
+                hidden = layer(hidden, mask)[0]
+                if depth in self.exit_heads.exit_layers:
+                    states.append(hidden)
+        return [self.exit_heads(index, state) for index, state in enumerate(states)]
+
+
+def exit_step(model, batch, device):
+    inputs = {k: v.to(device) for k, v in batch.items()}
+    labels = inputs.pop("labels")
+    all_logits = model(**inputs)
+    # same soft target loss as ViltForQuestionAnswering, summed over the exits
+    loss = sum(nn.functional.binary_cross_entropy_with_logits(logits, labels) * labels.shape[1] for logits in all_logits)
+    metrics = {}
+    for layer, logits in zip(model.exit_heads.exit_layers, all_logits):
+        preds = logits.argmax(-1)
+        metrics[f"accuracy_layer{layer:02d}"] = labels.gather(1, preds.unsqueeze(1)).clamp(max=1).sum()
+    return {"loss": loss, "num_samples": len(labels), "metrics": metrics}
+
+
+def load_vilt(model_path, label2id, id2label, device):
+    """ViLT checkpoint saved by train.py (whole model) or as a state dict (webUI model_store)"""
+    checkpoint = torch.load(model_path, map_location=device)
+    if isinstance(checkpoint, nn.Module):
+        model = checkpoint
+    else:
+        model = ViltForQuestionAnswering.from_pretrained("dandelin/vilt-b32-mlm", label2id=label2id, id2label=id2label)
+        model.load_state_dict(checkpoint.get("state_dict", checkpoint))
+    return model.to(device).eval()
+
+
+def load_exit_heads(heads_path, config, device):
+    checkpoint = torch.load(heads_path, map_location=device)
+    heads = ViltExitHeads(config.hidden_size, config.num_labels, checkpoint["exit_layers"])
+    heads.load_state_dict(checkpoint["state_dict"])
+    return heads.to(device).eval()
+
+
+def train_heads(cfg, args, vilt, train_dataset, val_dataset, collate, device):
+    model = EarlyExitVilt(vilt, args.exit_layers).to(device)
+    optimizer = torch.optim.AdamW(model.exit_heads.parameters(), lr=args.learning_rate)
+    trainer = Trainer(model, exit_step, optimizer=optimizer, device=device,
+                      precision=getattr(cfg, 'precision', 'fp32'))
+    train_loader = DataLoader(train_dataset, collate_fn=collate, batch_size=args.batch_size, shuffle=True,
+                              num_workers=args.num_workers, drop_last=True)
+    val_loader = DataLoader(val_dataset, collate_fn=collate, batch_size=args.batch_size, shuffle=False,
+                            num_workers=args.num_workers)
+
+    best_acc = -1
+    for epoch in range(args.epochs):
+        logger.info(f"Epoch [{epoch}/{args.epochs-1}]")
+        trainer.train_epoch(train_loader)
+        val_results = trainer.evaluate(val_loader)
+        accuracies = {name: value for name, value in val_results.items() if name.startswith("accuracy_layer")}
+        logger.info(" - ".join(f"{name[len('accuracy_'):]}: {value:.4f}" for name, value in sorted(accuracies.items())))
+        mean_acc = sum(accuracies.values()) / len(accuracies)
+        if mean_acc > best_acc:
+            best_acc = mean_acc
+            torch.save({"exit_layers": model.exit_heads.exit_layers,
+                        "state_dict": model.exit_heads.state_dict(),
+                        "best_epoch": epoch,
+                        "best_epoch_acc": val_results}, args.heads_path)
+            logger.info(f"Exit heads saved to {args.heads_path}")
+
+
+def tradeoff_curve(vilt, heads, data_loader, thresholds, device, max_batches=None):
+    """Accuracy, average executed layers and latency per question of every threshold.
+    The first row (threshold inf) never exits early and is the full model baseline."""
+    rows = []
+    for threshold in [float("inf")] + sorted(thresholds):
+        correct, layers, num_samples, elapsed = 0.0, 0, 0, 0.0
+        with torch.no_grad():
+            for step, batch in enumerate(data_loader):
+                if max_batches is not None and step >= max_batches:
+                    break
+                inputs = {k: v.to(device) for k, v in batch.items()}
+                labels = inputs.pop("labels")
+                start = time.perf_counter()
+                preds, _, executed = heads.predict(vilt, threshold, **inputs)
+                elapsed += time.perf_counter() - start
+                correct += labels.gather(1, preds.unsqueeze(1)).clamp(max=1).sum().item()
+                layers += executed.sum().item()
+                num_samples += len(labels)
+        rows.append({"threshold": threshold,
+                     "accuracy": correct / num_samples,
+                     "avg_layers": layers / num_samples,
+                     "ms_per_question": elapsed / num_samples * 1e3})
+        logger.info(f"threshold {threshold:.2f} - accuracy {rows[-1]['accuracy']:.4f} - "
+                    f"{rows[-1]['avg_layers']:.2f} layers - {rows[-1]['ms_per_question']:.1f}ms/question")
+    curve = pd.DataFrame(rows)
+    curve["speedup"] = curve["ms_per_question"].iloc[0] / curve["ms_per_question"]
+    return curve
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_path", type=str, help="vilt_vqa config.yaml with the data paths")
+    parser.add_argument("--mode", type=str, choices=["train", "curve"], default="train")
+    parser.add_argument("--model-path", type=str, help="fine-tuned ViLT checkpoint")
+    parser.add_argument("--heads-path", type=str, default="vilt_exit_heads.pth")
+    parser.add_argument("--exit-layers", type=int, nargs="+", default=[4, 6, 8, 10])
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--learning-rate", type=float, default=1e-3)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99])
+    parser.add_argument("--max-batches", type=int, default=None, help="limit the batches of the curve")
+    parser.add_argument("--output", type=str, default="early_exit_curve.csv")
+    parser.add_argument("--device", type=str, default="cuda:0")
+    args = parser.parse_args()
+
+    cfg = Config(yaml.full_load(open(args.config_path)))
+    # the exits are trained on the plain images
+    cfg.augment = False
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    assert args.model_path is not None and os.path.exists(args.model_path), f"{args.model_path} does not exists"
+
+    label2id, id2label = load_label_mappings(cfg.classmapping_dir)
+    processor = ViltProcessor.from_pretrained("dandelin/vilt-b32-mlm")
+    train_dataset, val_dataset = build_datasets(cfg, processor, label2id)
+    collate = lambda x : collate_fn(x, processor, len(label2id))
+    vilt = load_vilt(args.model_path, label2id, id2label, device)
+
+    if args.mode == "train":
+        train_heads(cfg, args, vilt, train_dataset, val_dataset, collate, device)
+    else:
+        heads = load_exit_heads(args.heads_path, vilt.config, device)
+        val_loader = DataLoader(val_dataset, collate_fn=collate, batch_size=args.batch_size, shuffle=False,
+                                num_workers=args.num_workers)
+        curve = tradeoff_curve(vilt, heads, val_loader, args.thresholds, device, max_batches=args.max_batches)
+        curve.to_csv(args.output, index=False)
+        logger.info(f"Trade-off curve written to {args.output}")
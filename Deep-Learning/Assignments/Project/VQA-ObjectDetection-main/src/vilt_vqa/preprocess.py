@@ -0,0 +1,176 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+import os
+import sys
+import json
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+from loguru import logger
+from tqdm import tqdm
+from torch.utils.data import Dataset, DataLoader
+from transformers import ViltProcessor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.text import normalize_questions
+
+TEXT_FILE = "text.npz"
+PIXEL_INDEX_FILE = "pixels_index.npz"
+META_FILE = "meta.json"
+
+
+class ResizedImageDataset(Dataset):
+    """Decodes and resizes images with the ViLT image processor, without rescaling or normalizing"""
+    def __init__(self, image_paths, image_processor):
+        self.image_paths = image_paths
+        self.image_processor = image_processor
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        image = Image.open(self.image_paths[idx]).convert('RGB')
+        pixels = self.image_processor(image,
+                                      do_rescale=False,
+                                      do_normalize=False,
+                                      do_pad=False,
+                                      return_tensors="np")["pixel_values"][0]
+        return pixels.astype(np.uint8)
+
+
+def build_cache(data, processor, cache_dir, shard_size=2000, num_workers=4):
+    """Tokenizes all questions and stores the resized uint8 pixels of every row in sharded files"""
+    os.makedirs(cache_dir, exist_ok=True)
+
+    logger.info(f"Tokenizing {len(data)} questions")
+    encoding = processor.tokenizer(data.question.tolist(),
+                                   padding="max_length",
+                                   truncation=True,
+                                   return_tensors="np")
+    np.savez(os.path.join(cache_dir, TEXT_FILE),
+             input_ids=encoding["input_ids"].astype(np.int32),
+             attention_mask=encoding["attention_mask"].astype(np.int8),
+             token_type_ids=encoding["token_type_ids"].astype(np.int8))
+
+    loader = DataLoader(ResizedImageDataset(data.image_path.tolist(), processor.image_processor),
+                        batch_size=None,
+                        shuffle=False,
+                        num_workers=num_workers)
+
+    shard_ids = np.zeros(len(data), dtype=np.int32)
+    offsets = np.zeros(len(data), dtype=np.int64)
+    shapes = np.zeros((len(data), 3), dtype=np.int32)
+    shard, shard_offset, shard_id = [], 0, 0
+
+    def flush(shard, shard_id):
+        np.save(os.path.join(cache_dir, f"pixels_{shard_id:05d}.npy"), np.concatenate(shard))
+
+    start_time = time.perf_counter()
+    for idx, pixels in enumerate(tqdm(loader)):
+        pixels = np.asarray(pixels)
+        shard_ids[idx] = shard_id
+        offsets[idx] = shard_offset
+        shapes[idx] = pixels.shape
+        shard.append(pixels.reshape(-1))
+        shard_offset += pixels.size
+        if len(shard) == shard_size:
+            flush(shard, shard_id)
+            shard, shard_offset, shard_id = [], 0, shard_id + 1
+    if len(shard) > 0:
+        flush(shard, shard_id)
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"Processed {len(data)} images in {elapsed:.1f}s ({len(data) / elapsed:.2f} images/s)")
+
+    np.savez(os.path.join(cache_dir, PIXEL_INDEX_FILE), shard_ids=shard_ids, offsets=offsets, shapes=shapes)
+    with open(os.path.join(cache_dir, META_FILE), "w") as f:
+        json.dump({"images": data.image.tolist(),
+                   "image_mean": processor.image_processor.image_mean,
+                   "image_std": processor.image_processor.image_std}, f)
+    logger.info(f"Cache written to {cache_dir}")
+
+
+class CachedVQADataset(torch.utils.data.Dataset):
+    """Serves pre-tokenized questions and pre-resized uint8 pixels written by build_cache.
+
+    augment is an optional callable on PIL images (e.g. RandAugment) applied on the fly before
+    normalization. Items have the same keys as VQADataset items. With uint8, pixel_values are the
+    cached uint8 pixels, to be augmented and normalized per batch by batch_augment_collate_fn.
+    """
+    def __init__(self, data, cache_dir, targets, augment=None, uint8=False):
+        with open(os.path.join(cache_dir, META_FILE), "r") as f:
+            meta = json.load(f)
+        assert meta["images"] == data.image.tolist(), f"{cache_dir} was built for different data"
+        print(f"Cached Data Size : {len(meta['images'])}")
+
+        text = np.load(os.path.join(cache_dir, TEXT_FILE))
+        self.input_ids = text["input_ids"]
+        self.attention_mask = text["attention_mask"]
+        self.token_type_ids = text["token_type_ids"]
+        self.lengths = self.attention_mask.sum(1)
+
+        pixel_index = np.load(os.path.join(cache_dir, PIXEL_INDEX_FILE))
+        self.shard_ids = pixel_index["shard_ids"]
+        self.offsets = pixel_index["offsets"]
+        self.shapes = pixel_index["shapes"]
+        self.cache_dir = cache_dir
+        self.shards = {}
+
+        self.image_mean = torch.tensor(meta["image_mean"]).view(-1, 1, 1)
+        self.image_std = torch.tensor(meta["image_std"]).view(-1, 1, 1)
+        self.indptr, self.labels, self.scores = targets
+        self.augment = augment
+        self.uint8 = uint8
+
+    def __len__(self):
+        return len(self.input_ids)
+
+    def get_pixels(self, idx):
+        """uint8 (C, H, W) array of the resized image"""
+        shard_id = int(self.shard_ids[idx])
+        if shard_id not in self.shards:
+            # opened lazily so that every dataloader worker maps its own copy
+            self.shards[shard_id] = np.load(os.path.join(self.cache_dir, f"pixels_{shard_id:05d}.npy"), mmap_mode="r")
+        size = int(np.prod(self.shapes[idx]))
+        offset = int(self.offsets[idx])
+        return self.shards[shard_id][offset:offset + size].reshape(self.shapes[idx])
+
+    def __getitem__(self, idx):
+        pixels = self.get_pixels(idx)
+        if self.augment is not None:
+            image = self.augment(Image.fromarray(pixels.transpose(1, 2, 0)))
+            pixels = np.asarray(image).transpose(2, 0, 1)
+        pixels = torch.from_numpy(np.ascontiguousarray(pixels))
+        if not self.uint8:
+            pixels = (pixels.float() / 255 - self.image_mean) / self.image_std
+
+        encoding = {
+            "input_ids": torch.from_numpy(self.input_ids[idx]).long(),
+            "attention_mask": torch.from_numpy(self.attention_mask[idx]).long(),
+            "token_type_ids": torch.from_numpy(self.token_type_ids[idx]).long(),
+            "pixel_values": pixels,
+        }
+        start, end = self.indptr[idx], self.indptr[idx + 1]
+        encoding["labels"] = torch.from_numpy(self.labels[start:end])
+        encoding["scores"] = torch.from_numpy(self.scores[start:end])
+        return encoding
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-path", type=str)
+    parser.add_argument("--cache-dir", type=str)
+    parser.add_argument("--shard-size", type=int, default=2000)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--normalize-questions", action="store_true", help="clean the questions as the web UI does before inference")
+    args = parser.parse_args()
+
+    assert os.path.exists(args.data_path), f"{args.data_path} does not exists"
+    data = pd.read_json(args.data_path)
+    if args.normalize_questions:
+        data = normalize_questions(data)
+    processor = ViltProcessor.from_pretrained("dandelin/vilt-b32-mlm")
+    build_cache(data, processor, args.cache_dir, shard_size=args.shard_size, num_workers=args.num_workers)
@@ -3,120 +3,146 @@ import argparse
 import torch 
 import pandas as pd
 from loguru import logger
-from tqdm import tqdm
 import csv
-from dataset import get_score, add_label_score, VQADataset, collate_fn
+import sys 
+from dataset import get_score, load_soft_targets, VQADataset, RandAugment, collate_fn
+from preprocess import CachedVQADataset
+from batch_augment import BatchRandAugment, batch_augment_collate_fn
 from transformers import ViltProcessor, ViltForQuestionAnswering
 from utils import EarlyStopping, get_optimizer, Config
-from torch.utils.data import DataLoader
-import sys 
+from torch.utils.data import DataLoader, DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 import yaml 
 from torch.utils.tensorboard import SummaryWriter
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.batching import LengthBucketBatchSampler
+from common.trainer import Trainer
+from common.distributed import setup_distributed, cleanup_distributed, broadcast_object, is_main_process, barrier
+from common.text import normalize_questions
+
 
 torch.manual_seed(1234)
 
-def train_model(data_loader, model, optimizer, scheduler, device):
-    total_samples = len(data_loader.dataset)
-    # Define loss
-    total_loss = 0
-    total_acc = 0
-    model.train()
-    for batch in tqdm(data_loader):
-        # get the inputs;
-        inputs = {k:v.to(device) for k,v in batch.items()}
-        # forward pass
-        outputs = model(**inputs)
-        loss = outputs.loss
-        # backward and optimize
-        optimizer.zero_grad(set_to_none=True)
-        loss.backward()
-        optimizer.step()
-        total_loss += loss.item()
-        preds = outputs.logits.argmax(-1)
-        scores, labels = batch["labels"].to(device).topk(10, -1)
-        
-        # Calculate accuracy
-        for idx in range(len(scores)):
-            total_acc += min(scores[idx][preds[idx] == labels[idx]].sum(),1)
-        #scheduler.step()
-        
-    # Loss over batches
-    train_loss = total_loss / total_samples
-    train_acc = total_acc / total_samples
-    return train_acc ,train_loss
-
-
-def val_model(data_loader, model, device):
-    total_samples = len(data_loader.dataset)
-    # Define loss and accuracy
-    total_loss = 0
-    total_acc = 0
-
-    model.eval()
-    with torch.no_grad():
-        for batch in tqdm(data_loader):
-            inputs = {k:v.to(device) for k,v in batch.items()}
-            outputs = model(**inputs)
-
-            # Calculate loss
-            loss = outputs.loss
-            total_loss += loss.item()
-
-            # Get top predict for each question
-            preds = outputs.logits.argmax(-1)
-            # Get ground truth answers for each questiojn
-            scores, labels = batch["labels"].to(device).topk(10, -1)
-            # Calculate accuracy
-            for idx in range(len(scores)):
-                total_acc += min(scores[idx][preds[idx] == labels[idx]].sum(),1)
-            
-    # Accuracy over batches
-    val_acc = total_acc / total_samples
-    # Loss over batches
-    val_loss = total_loss / total_samples
-
-    return val_acc, val_loss
-
-
-def main(cfg):
-    writer = SummaryWriter(cfg.checkpoint_dir)
-    os.makedirs(cfg.checkpoint_dir, exist_ok=True)
+def vqa_step(model, batch, device):
+    # get the inputs;
+    inputs = {k:v.to(device) for k,v in batch.items()}
+    # forward pass
+    outputs = model(**inputs)
+    # soft score of the top prediction for each question
+    preds = outputs.logits.argmax(-1)
+    accuracy = inputs["labels"].gather(1, preds.unsqueeze(1)).clamp(max=1).sum()
+    return {"loss": outputs.loss, "num_samples": len(preds), "metrics": {"accuracy": accuracy}}
+
 
-    with open(cfg.classmapping_dir, "r") as f:
+def load_label_mappings(classmapping_dir):
+    with open(classmapping_dir, "r") as f:
         next(f)  # Skip the header
         reader = csv.reader(f, skipinitialspace=True)
         class_mapping = dict(reader)
         label2id = {k: int(v) for k, v in class_mapping.items()}
         id2label = {v: k for k, v in label2id.items()}
+    return label2id, id2label
+
 
+def build_datasets(cfg, processor, label2id):
+    """train and val datasets, served from the preprocess.py cache when cfg.preprocess_cache_dir is set"""
     train_data = pd.read_json(cfg.train_data_path)
     val_data = pd.read_json(cfg.val_data_path)
+    if getattr(cfg, 'normalize_questions', False):
+        # the preprocess.py cache keeps its own tokens, build it with --normalize-questions too
+        train_data, val_data = normalize_questions(train_data), normalize_questions(val_data)
+
+    target_cache_dir = getattr(cfg, 'target_cache_dir', None)
+    if target_cache_dir and not is_main_process():
+        # rank 0 builds and writes the target caches, the other ranks load them once it is done
+        barrier()
+    train_targets = load_soft_targets(train_data, label2id, 
+                                      cache_path=os.path.join(target_cache_dir, 'train_targets.npz') if target_cache_dir else None)
+    val_targets = load_soft_targets(val_data, label2id, 
+                                    cache_path=os.path.join(target_cache_dir, 'val_targets.npz') if target_cache_dir else None)
+    if target_cache_dir and is_main_process():
+        barrier()
+
+    preprocess_cache_dir = getattr(cfg, 'preprocess_cache_dir', None)
+    if preprocess_cache_dir:
+        logger.info(f"Using Preprocessed Cache {preprocess_cache_dir}")
+        # with batch_augment the training pixels stay uint8 and are augmented per batch in the collate function
+        batch_augment = getattr(cfg, 'augment', False) and getattr(cfg, 'batch_augment', False)
+        augment = RandAugment(n=2, m=9) if getattr(cfg, 'augment', False) and not batch_augment else None
+        train_dataset = CachedVQADataset(train_data, os.path.join(preprocess_cache_dir, 'train'), train_targets,
+                                         augment=augment, uint8=batch_augment)
+        val_dataset = CachedVQADataset(val_data, os.path.join(preprocess_cache_dir, 'val'), val_targets)
+    else:
+        train_dataset = VQADataset(train_data, processor, label2id, targets=train_targets)
+        val_dataset = VQADataset(val_data, processor, label2id, targets=val_targets)
+    return train_dataset, val_dataset
 
-    train_data = add_label_score(train_data, label2id)
-    val_data = add_label_score(val_data, label2id)
 
-    processor = ViltProcessor.from_pretrained("dandelin/vilt-b32-mlm")
+def main(cfg, rank=0, world_size=1, local_rank=0):
+    # only rank 0 writes logs and checkpoints
+    writer = SummaryWriter(cfg.checkpoint_dir) if is_main_process() else None
+    os.makedirs(cfg.checkpoint_dir, exist_ok=True)
 
-    train_dataset = VQADataset(train_data, processor, label2id)
-    val_dataset = VQADataset(val_data, processor, label2id)
-
-
-    train_dataloader = DataLoader(train_dataset, 
-                                  collate_fn=lambda x : collate_fn(x, processor), 
-                                  batch_size=cfg.batch_size, 
-                                  shuffle=True, 
-                                  num_workers=2, 
-                                  pin_memory=True, 
-                                  drop_last=True)
-    val_dataloader = DataLoader(val_dataset, 
-                                collate_fn=lambda x : collate_fn(x, processor), 
-                                batch_size=cfg.batch_size, 
-                                shuffle=False, 
-                                num_workers=2, 
-                                pin_memory=True)
-
-    device=torch.device(cfg.device if torch.cuda.is_available() else 'cpu')
+    label2id, id2label = load_label_mappings(cfg.classmapping_dir)
+    processor = ViltProcessor.from_pretrained("dandelin/vilt-b32-mlm")
+    train_dataset, val_dataset = build_datasets(cfg, processor, label2id)
+
+    collate = lambda x : collate_fn(x, processor, len(label2id))
+    train_collate = collate
+    if getattr(train_dataset, 'uint8', False):
+        augment = BatchRandAugment(n=2, m=9)
+        train_collate = lambda x : batch_augment_collate_fn(x, processor, len(label2id), augment,
+                                                            train_dataset.image_mean, train_dataset.image_std)
+    num_workers = getattr(cfg, 'num_workers', 2)
+    if getattr(cfg, 'bucket_batching', False):
+        # batches of questions with similar token length, padded to the longest one
+        train_sampler = LengthBucketBatchSampler(train_dataset.lengths,
+                                                 batch_size=cfg.batch_size,
+                                                 bucket_size=cfg.bucket_size,
+                                                 shuffle=True,
+                                                 drop_last=True,
+                                                 num_replicas=world_size,
+                                                 rank=rank)
+        train_dataloader = DataLoader(train_dataset,
+                                      collate_fn=train_collate,
+                                      batch_sampler=train_sampler,
+                                      num_workers=num_workers,
+                                      pin_memory=True)
+        val_dataloader = DataLoader(val_dataset,
+                                    collate_fn=collate,
+                                    batch_sampler=LengthBucketBatchSampler(val_dataset.lengths,
+                                                                           batch_size=cfg.batch_size,
+                                                                           bucket_size=cfg.bucket_size,
+                                                                           shuffle=False,
+                                                                           num_replicas=world_size,
+                                                                           rank=rank,
+                                                                           pad=False),
+                                    num_workers=num_workers,
+                                    pin_memory=True)
+    else:
+        # every rank sees its own 1/world_size of the data
+        train_sampler = DistributedSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=True, drop_last=True)
+        train_dataloader = DataLoader(train_dataset, 
+                                      collate_fn=train_collate, 
+                                      batch_size=cfg.batch_size, 
+                                      sampler=train_sampler, 
+                                      num_workers=num_workers, 
+                                      pin_memory=True, 
+                                      drop_last=True)
+        val_dataloader = DataLoader(val_dataset, 
+                                    collate_fn=collate, 
+                                    batch_size=cfg.batch_size, 
+                                    # every rank its share of the samples without the padding of DistributedSampler,
+                                    # which would count some samples twice in the all-reduced accuracy
+                                    sampler=range(rank, len(val_dataset), world_size), 
+                                    num_workers=num_workers, 
+                                    pin_memory=True)
+
+    if world_size > 1:
+        device = torch.device(f"cuda:{local_rank}" if torch.cuda.is_available() else 'cpu')
+    else:
+        device=torch.device(cfg.device if torch.cuda.is_available() else 'cpu')
     model = ViltForQuestionAnswering.from_pretrained("dandelin/vilt-b32-mlm",
                                                     id2label=id2label,
                                                     label2id=label2id)
@@ -124,63 +150,88 @@ def main(cfg):
     model.to(device)
 
     optimizer, lr_scheduler = get_optimizer(model, cfg)
+    if world_size > 1:
+        # gradients are averaged across the processes on every optimizer step
+        train_model = DistributedDataParallel(model, device_ids=[local_rank] if device.type == 'cuda' else None)
+    else:
+        train_model = model
+    trainer = Trainer(train_model, 
+                      vqa_step, 
+                      optimizer=optimizer, 
+                      device=device,
+                      precision=getattr(cfg, 'precision', 'fp32'),
+                      grad_accum_steps=getattr(cfg, 'grad_accum_steps', 1))
 
 
     NUM_EPOCHS = cfg.num_epochs
     best_val_acc = 0.0
     for epoch in range(NUM_EPOCHS):
         logger.info(f"Epoch [{epoch}/{NUM_EPOCHS-1}]")
-        train_acc, train_loss = train_model(train_dataloader, model, optimizer, lr_scheduler, device)
-        val_acc, val_loss = val_model(val_dataloader, model, device)
-        
+        train_sampler.set_epoch(epoch)
+        train_results = trainer.train_epoch(train_dataloader)
+        val_results = trainer.evaluate(val_dataloader)
+        train_acc, train_loss = train_results["accuracy"], train_results["loss"]
+        val_acc, val_loss = val_results["accuracy"], val_results["loss"]
 
         # Display
         logger.info(f"Train loss: {train_loss:.5f} - Val loss: {val_loss:.5f}")
         logger.info(f"Train Accuracy : {train_acc:.5f} - Val accuracy: {val_acc:.5f}\n")
 
-        writer.add_scalar('Loss/Train', train_loss, epoch)
-        writer.add_scalar('Loss/Valid', val_loss, epoch)
-        writer.add_scalar('Accuracy/Train', train_acc, epoch)
-        writer.add_scalar('Accuracy/Valid', val_acc, epoch)
+        if is_main_process():
+            writer.add_scalar('Loss/Train', train_loss, epoch)
+            writer.add_scalar('Loss/Valid', val_loss, epoch)
+            writer.add_scalar('Accuracy/Train', train_acc, epoch)
+            writer.add_scalar('Accuracy/Valid', val_acc, epoch)
 
-        
+        # metrics are all-reduced, so every rank takes the same decisions
         if val_acc >  best_val_acc:
             logger.info(f"val_acc improved from {best_val_acc:.5f} to {val_acc:.5f}")
             best_val_acc = val_acc
-            checkpoint_name = f"{cfg.model_name}_{best_val_acc:.4f}.pth"
-            torch.save(model, os.path.join(cfg.checkpoint_dir, checkpoint_name))
-            logger.info(f"Model Saved as {checkpoint_name}")
+            if is_main_process():
+                checkpoint_name = f"{cfg.model_name}_{best_val_acc:.4f}.pth"
+                torch.save(model, os.path.join(cfg.checkpoint_dir, checkpoint_name))
+                logger.info(f"Model Saved as {checkpoint_name}")
         
         # Adjust learning rate
         lr_scheduler.step(val_loss)
 
-    checkpoint_name = f"{cfg.model_name}_{val_acc:.4f}.pth"
-    torch.save(model, os.path.join(cfg.checkpoint_dir, checkpoint_name))
-    logger.info(f"Model Saved as {checkpoint_name}")
-    writer.close()
+    if is_main_process():
+        checkpoint_name = f"{cfg.model_name}_{val_acc:.4f}.pth"
+        torch.save(model, os.path.join(cfg.checkpoint_dir, checkpoint_name))
+        logger.info(f"Model Saved as {checkpoint_name}")
+        writer.close()
 
 
 if __name__ == "__main__":
     config_path = sys.argv[1]
     config = yaml.full_load(open(config_path))
 
-
-    save_dir = config['save_dir']
-    os.makedirs(save_dir, exist_ok=True)
-    existing_runs = os.listdir(save_dir)
-    if len(existing_runs) == 0:
-        curr_run = 0 
-    else:
-        curr_run = max([int(run) for run in existing_runs]) + 1
-    run_dir = os.path.join(save_dir, str(curr_run))
-    os.makedirs(run_dir)
-    logger.info(f"Setting {run_dir} as the save dir for the model")
-    log_file_path = os.path.join(run_dir, 'trainingLogs.log')
-    logger.add(log_file_path)
+    # single process by default, torchrun sets WORLD_SIZE/RANK for distributed runs
+    rank, world_size, local_rank = setup_distributed(backend=config.get('distributed_backend', 'gloo'),
+                                                     threads_per_process=config.get('threads_per_process'))
+    if rank != 0:
+        logger.remove()
+
+    run_dir = None
+    if rank == 0:
+        save_dir = config['save_dir']
+        os.makedirs(save_dir, exist_ok=True)
+        existing_runs = os.listdir(save_dir)
+        if len(existing_runs) == 0:
+            curr_run = 0 
+        else:
+            curr_run = max([int(run) for run in existing_runs]) + 1
+        run_dir = os.path.join(save_dir, str(curr_run))
+        os.makedirs(run_dir)
+        logger.info(f"Setting {run_dir} as the save dir for the model")
+        log_file_path = os.path.join(run_dir, 'trainingLogs.log')
+        logger.add(log_file_path)
+    run_dir = broadcast_object(run_dir)
 
     config['checkpoint_dir'] = run_dir
 
     logger.info(config)
 
     config = Config(config)
-    main(config)
\ No newline at end of file
+    main(config, rank=rank, world_size=world_size, local_rank=local_rank)
+    cleanup_distributed()
@@ -0,0 +1,264 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+import io
+import gc
+import os
+import sys
+import json
+import argparse
+import resource
+import subprocess
+import time
+import pandas as pd
+import torch
+from loguru import logger
+from utils import Config, TextNormalizer, legacy_text_preprocess, text_preprocess, load_image
+from model.registry import get_registry, build_registry
+
+# benchmark name -> registry name
+MODELS = {"answerability": "answerability", "clip": "clip_vqa", "vilt": "vilt_vqa", "blip": "blip_vqa"}
+# models with a weights only export, benchmark name -> Config attribute
+EXPORTED_WEIGHTS = {"vilt": "vilt_weights_path", "blip": "blip_weights_path"}
+
+
+def load_samples(data_path, num_samples):
+    """image paths and cleaned questions of the first num_samples rows of a VizWiz style json"""
+    data = pd.read_json(data_path).head(num_samples)
+    return data.image_path.tolist(), [text_preprocess(question) for question in data.question]
+
+
+def weights_mb(model):
+    """Serialized size of the weights, includes the packed int8 weights of quantized layers"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+
+def accuracy(data, predictions):
+    """VQA accuracy min(#matching annotations / 3, 1) for answer predictors, hit rate on answerable for scores"""
+    if isinstance(predictions[0], tuple):
+        if "answers" not in data:
+            return None
+        scores = [min(sum(a["answer"] == answer for a in answers) / 3, 1)
+                  for (answer, _), answers in zip(predictions, data.answers)]
+    else:
+        if "answerable" not in data:
+            return None
+        scores = [(score >= Config.answerability_threshold) == bool(answerable)
+                  for score, answerable in zip(predictions, data.answerable)]
+    return sum(scores) / len(scores)
+
+
+def same_prediction(single, batched):
+    # answerability predictors return scores, VQA predictors (answer, score)
+    if isinstance(batched, tuple):
+        return single == batched[0]
+    return abs(single - batched) < 1e-3
+
+
+def benchmark_throughput(predictor, images, questions, batch_size, cache=None):
+    """single items then predict_batch, the embedding cache is cleared before each pass so that
+    the batched pass does not read the image features of the single item pass"""
+    if cache is not None:
+        cache.clear()
+    start_time = time.perf_counter()
+    single = [predictor.predict(image, question) for image, question in zip(images, questions)]
+    single_time = time.perf_counter() - start_time
+
+    if cache is not None:
+        cache.clear()
+    start_time = time.perf_counter()
+    batched = predictor.predict_batch(images, questions, batch_size=batch_size)
+    batch_time = time.perf_counter() - start_time
+
+    agreement = sum(same_prediction(s, b) for s, b in zip(single, batched)) / len(single)
+    return {"single_items_per_sec": len(single) / single_time,
+            "batch_items_per_sec": len(batched) / batch_time,
+            "speedup": single_time / batch_time,
+            "agreement": agreement}
+
+
+def benchmark_quantization(name, data, batch_size, device):
+    """fp32 against int8 dynamic quantization of the same predictor on a held-out slice"""
+    images, questions = data.image_path.tolist(), [text_preprocess(question) for question in data.question]
+    rows, predictions = {}, {}
+    for quantize in (False, True):
+        Config.quantize = quantize
+        registry = build_registry(device=device)
+        predictor = registry.get(MODELS[name])
+        # warm up so that lazy initialization is not timed
+        predictor.predict_batch(images[:batch_size], questions[:batch_size], batch_size=batch_size)
+        if "embedding_cache" in registry.loaded():
+            registry.get("embedding_cache").clear()
+
+        start_time = time.perf_counter()
+        predictions[quantize] = predictor.predict_batch(images, questions, batch_size=batch_size)
+        elapsed = time.perf_counter() - start_time
+
+        precision = "int8" if quantize else "fp32"
+        rows[precision] = {"accuracy": accuracy(data, predictions[quantize]),
+                           "ms_per_item": 1e3 * elapsed / len(questions),
+                           "weights_mb": weights_mb(predictor.model),
+                           "load_rss_mb": sum(stats["rss_mb"] for model, stats in registry.stats().items() if model != "process")}
+        del registry, predictor
+        gc.collect()
+    Config.quantize = False
+
+    fp32, int8 = predictions[False], predictions[True]
+    if isinstance(fp32[0], tuple):
+        agreement = [a[0] == b[0] for a, b in zip(fp32, int8)]
+    else:
+        agreement = [(a >= Config.answerability_threshold) == (b >= Config.answerability_threshold) for a, b in zip(fp32, int8)]
+    rows["int8"]["agreement_with_fp32"] = sum(agreement) / len(agreement)
+    rows["int8"]["speedup"] = rows["fp32"]["ms_per_item"] / rows["int8"]["ms_per_item"]
+    return rows
+
+
+def benchmark_blip(data, device):
+    """One question at a time as in the web UI: generate from scratch, with the vision encoder cache,
+    and with the cache plus decoding constrained to the answer space"""
+    images, questions = data.image_path.tolist(), [text_preprocess(question) for question in data.question]
+    registry = build_registry(device=device)
+    predictor = registry.get("blip_vqa")
+    cache = registry.get("embedding_cache")
+    loaded = [load_image(image) for image in images]
+    modes = {"generate": lambda image, question: predictor.predict_uncached(image, question),
+             "encoder_cache": lambda image, question: predictor.predict_batch([image], [question])[0],
+             "constrained": lambda image, question: predictor.predict_batch([image], [question], constrained=True)[0]}
+    rows = {}
+    for mode, predict in modes.items():
+        cache.clear()
+        # warm up so that lazy initialization (e.g. the answer trie) is not timed
+        predict(loaded[0], questions[0])
+        cache.clear()
+        before = cache.stats()
+        start_time = time.perf_counter()
+        predictions = [predict(image, question) for image, question in zip(loaded, questions)]
+        elapsed = time.perf_counter() - start_time
+        after = cache.stats()
+        hits, misses = after["hits"] - before["hits"], after["misses"] - before["misses"]
+        predictions = [prediction if isinstance(prediction, tuple) else (prediction, None) for prediction in predictions]
+        rows[mode] = {"accuracy": accuracy(data, predictions),
+                      "ms_per_item": 1e3 * elapsed / len(questions),
+                      "cache_hit_rate": hits / max(hits + misses, 1)}
+    for mode in rows:
+        rows[mode]["speedup"] = rows["generate"]["ms_per_item"] / rows[mode]["ms_per_item"]
+    return rows
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def load_once(name, checkpoint_format):
+    """Loads one predictor in this process, run in a fresh process by benchmark_cold_start"""
+    if checkpoint_format == "legacy":
+        setattr(Config, EXPORTED_WEIGHTS[name], None)
+    else:
+        path = getattr(Config, EXPORTED_WEIGHTS[name])
+        assert path is not None and os.path.exists(path), f"{path} not found, run export_weights.py first"
+    baseline_rss = peak_rss_mb()
+    start_time = time.perf_counter()
+    build_registry(device='cpu').get(MODELS[name])
+    return {"load_time_s": time.perf_counter() - start_time,
+            "peak_rss_mb": peak_rss_mb(),
+            "load_peak_rss_mb": peak_rss_mb() - baseline_rss}
+
+
+def benchmark_cold_start(name):
+    """Cold start of the pretrained + torch.load checkpoint against the exported weights.
+    Every load runs in its own process so that neither the page cache of the interpreter nor the
+    peak RSS of the other load is counted."""
+    rows = {}
+    for checkpoint_format in ("legacy", "exported"):
+        output = subprocess.run([sys.executable, __file__, "--mode", "load_once", "--models", name,
+                                 "--checkpoint-format", checkpoint_format],
+                                capture_output=True, text=True, check=True).stdout
+        rows[checkpoint_format] = json.loads(output.strip().splitlines()[-1])
+    rows["exported"]["speedup"] = rows["legacy"]["load_time_s"] / rows["exported"]["load_time_s"]
+    return rows
+
+
+def benchmark_text(questions, repeats=3):
+    """Per call cost of legacy_text_preprocess against TextNormalizer, uncached, cached and in bulk"""
+    def per_call_us(fn):
+        best = float("inf")
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            for question in questions:
+                fn(question)
+            best = min(best, time.perf_counter() - start_time)
+        return 1e6 * best / len(questions)
+
+    normalizer = TextNormalizer()
+    mismatches = sum(normalizer._normalize(q) != legacy_text_preprocess(q) for q in questions)
+    bulk = pd.Series(questions)
+    start_time = time.perf_counter()
+    normalizer.normalize_series(bulk)
+    bulk_us = 1e6 * (time.perf_counter() - start_time) / len(questions)
+
+    results = {"legacy": per_call_us(legacy_text_preprocess),
+               "single_pass": per_call_us(normalizer._normalize),
+               "memoized": per_call_us(normalizer),
+               "normalize_series": bulk_us}
+    return {name: {"us_per_call": value, "speedup": results["legacy"] / value} for name, value in results.items()}, mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-path", type=str, help="json with image_path and question columns")
+    parser.add_argument("--models", type=str, nargs="+", default=list(MODELS), choices=list(MODELS))
+    parser.add_argument("--num-samples", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--mode", type=str, default="throughput",
+                        choices=["throughput", "quantization", "text", "cold_start", "blip", "load_once"],
+                        help="throughput: single item vs predict_batch, quantization: fp32 vs int8 on cpu, "
+                             "text: text_preprocess cost before and after TextNormalizer, "
+                             "cold_start: load time and peak RSS of the checkpoint against the exported weights, "
+                             "blip: BLIP generation with the vision encoder cache and constrained decoding")
+    parser.add_argument("--checkpoint-format", type=str, default="exported", choices=["legacy", "exported"],
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode == "load_once":
+        print(json.dumps(load_once(args.models[0], args.checkpoint_format)))
+    elif args.mode == "cold_start":
+        results = {}
+        for name in args.models:
+            assert name in EXPORTED_WEIGHTS, f"{name} has no exported weights, choose from {list(EXPORTED_WEIGHTS)}"
+            for checkpoint_format, row in benchmark_cold_start(name).items():
+                results[(name, checkpoint_format)] = row
+            logger.info(f"{name}: done")
+        print(pd.DataFrame(results).T.round(3).to_string())
+    elif args.mode == "blip":
+        data = pd.read_json(args.data_path).head(args.num_samples)
+        print(pd.DataFrame(benchmark_blip(data, args.device)).T.round(3).to_string())
+    elif args.mode == "text":
+        # all the questions of the file, not only num_samples, normalization is cheap
+        questions = pd.read_json(args.data_path).question.tolist()
+        results, mismatches = benchmark_text(questions)
+        logger.info(f"{len(questions)} questions, {mismatches} differ from the legacy output")
+        print(pd.DataFrame(results).T.round(3).to_string())
+    elif args.mode == "quantization":
+        data = pd.read_json(args.data_path).head(args.num_samples)
+        results = {}
+        for name in args.models:
+            for precision, row in benchmark_quantization(name, data, args.batch_size, "cpu").items():
+                results[(name, precision)] = row
+            logger.info(f"{name}: done")
+        print(pd.DataFrame(results).T.round(3).to_string())
+    else:
+        images, questions = load_samples(args.data_path, args.num_samples)
+        logger.info(f"{len(questions)} questions on {len(set(images))} unique images")
+        registry = get_registry(device=args.device)
+
+        results = {}
+        for name in args.models:
+            predictor = registry.get(MODELS[name])
+            cache = registry.get("embedding_cache") if "embedding_cache" in registry.loaded() else None
+            results[name] = benchmark_throughput(predictor, images, questions, args.batch_size, cache=cache)
+            logger.info(f"{name}: {results[name]}")
+        print(pd.DataFrame(results).T.round(3).to_string())
@@ -0,0 +1,41 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+import argparse
+from collections import Counter
+import pandas as pd
+from loguru import logger
+from utils import Config
+from model.registry import build_registry
+from model.answer_index import AnswerIndex
+
+
+def extra_answers(data_path, min_count):
+    """final and human answers of a VizWiz style json seen at least min_count times"""
+    data = pd.read_json(data_path)
+    counts = Counter()
+    if "final_answer" in data:
+        counts.update(data.final_answer.dropna())
+    if "answers" in data:
+        counts.update(answer["answer"] for answers in data.answers for answer in answers)
+    return [answer for answer, count in counts.most_common() if count >= min_count and answer != ""]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-path", type=str, default=None, help="json whose answers outside the head are added for zero-shot")
+    parser.add_argument("--min-count", type=int, default=2)
+    parser.add_argument("--prompt", type=str, default="{}", help="e.g. 'a photo of {}'")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--output-path", type=str, default=Config.answer_index_path)
+    args = parser.parse_args()
+
+    # the index is built from the head answers, not loaded
+    Config.answer_index_path = None
+    registry = build_registry(device='cpu')
+    predictor = registry.get("clip_vqa")
+    extra = extra_answers(args.data_path, args.min_count) if args.data_path is not None else []
+    index = AnswerIndex.build(registry.get("clip_encoder"), predictor.encoder.categories_[0].tolist(),
+                              extra_answers=extra, prompt=args.prompt, batch_size=args.batch_size)
+    index.save(args.output_path)
+    logger.info(f"Answer index written to {args.output_path}")
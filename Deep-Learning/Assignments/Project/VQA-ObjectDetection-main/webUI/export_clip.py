@@ -0,0 +1,95 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+import json
+import argparse
+import torch
+import torch.nn as nn
+from loguru import logger
+from utils import Config
+from model.registry import build_registry
+
+# CLIP RN50 input normalization, same as clip.load preprocessing
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+class CLIPVQAGraph(nn.Module):
+    """CLIP encoders and both heads in one module so that they can be traced together.
+
+    encode_image is kept as its own method so that image features can still be cached,
+    answer maps image features and question tokens to answer probabilities and answerability.
+    """
+    def __init__(self, clip_model, vqa_head, ans_head):
+        super().__init__()
+        self.clip_model = clip_model
+        self.vqa_head = vqa_head
+        self.ans_head = ans_head
+
+    def encode_image(self, pixels):
+        return self.clip_model.encode_image(pixels).float()
+
+    def answer(self, image_features, tokens):
+        text_features = self.clip_model.encode_text(tokens).float()
+        x = torch.cat((image_features, text_features), 1)
+        probabilities = self.vqa_head(x).view(x.size(0), -1).softmax(-1)
+        answerability = torch.sigmoid(self.ans_head(x)).view(-1)
+        return probabilities, answerability
+
+    def forward(self, pixels, tokens):
+        return self.answer(self.encode_image(pixels), tokens)
+
+
+def example_inputs(clip_model, batch_size):
+    resolution = clip_model.visual.input_resolution
+    pixels = torch.randn(batch_size, 3, resolution, resolution)
+    tokens = torch.zeros(batch_size, clip_model.context_length, dtype=torch.long)
+    tokens[:, 0], tokens[:, 1], tokens[:, 2] = 49406, 320, 49407
+    return pixels, tokens
+
+
+def export(output_path, batch_size=2, check_batch_sizes=(1, 2, 5)):
+    # trace on cpu in fp32, the graph is meant for CPU serving
+    Config.quantize = False
+    registry = build_registry(device='cpu')
+    encoder = registry.get("clip_encoder")
+    vqa_predictor = registry.get("clip_vqa")
+    ad_predictor = registry.get("answerability")
+
+    clip_model = encoder.clip_model.float().eval()
+    graph = CLIPVQAGraph(clip_model, vqa_predictor.model, ad_predictor.model).eval()
+
+    resolution = clip_model.visual.input_resolution
+    pixels, tokens = example_inputs(clip_model, batch_size)
+    with torch.no_grad():
+        image_features = graph.encode_image(pixels)
+        traced = torch.jit.trace_module(graph, {"forward": (pixels, tokens),
+                                                "encode_image": (pixels,),
+                                                "answer": (image_features, tokens)})
+        traced = torch.jit.freeze(traced, preserved_attrs=["encode_image", "answer"])
+
+        # the frozen graph should match the eager modules, also at batch sizes other than the traced one
+        for check_batch_size in check_batch_sizes:
+            check_pixels, check_tokens = example_inputs(clip_model, check_batch_size)
+            expected = graph(check_pixels, check_tokens)
+            actual = traced.answer(traced.encode_image(check_pixels), check_tokens)
+            for e, a in zip(expected, actual):
+                assert e.shape == a.shape and torch.allclose(e, a, atol=1e-4), \
+                    f"traced graph does not match the eager model at batch size {check_batch_size}"
+
+    extra_files = {
+        "answers.json": json.dumps(vqa_predictor.encoder.categories_[0].tolist()),
+        "preprocess.json": json.dumps({"resolution": resolution,
+                                       "context_length": clip_model.context_length,
+                                       "mean": CLIP_MEAN,
+                                       "std": CLIP_STD}),
+    }
+    torch.jit.save(traced, output_path, _extra_files=extra_files)
+    logger.info(f"Exported CLIP graph to {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output-path", type=str, default=Config.clip_graph_path)
+    args = parser.parse_args()
+    export(args.output_path)
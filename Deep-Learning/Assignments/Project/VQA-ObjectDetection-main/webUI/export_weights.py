@@ -0,0 +1,34 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+import argparse
+from loguru import logger
+from utils import Config
+from model.registry import build_registry
+from model.checkpoint import export_weights
+
+# model -> registry name, Config attribute of the exported weights
+MODELS = {"vilt": ("vilt_vqa", "vilt_weights_path"), "blip": ("blip_vqa", "blip_weights_path")}
+
+
+def export(name, output_path=None):
+    registry_name, weights_attr = MODELS[name]
+    output_path = output_path or getattr(Config, weights_attr)
+    # the training checkpoint is loaded the slow way once, in fp32
+    Config.quantize = False
+    setattr(Config, weights_attr, None)
+    predictor = build_registry(device='cpu').get(registry_name)
+    assert predictor.model is not None, f"no {name} checkpoint to export"
+    export_weights(predictor.model, output_path)
+    setattr(Config, weights_attr, output_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=str, nargs="+", default=list(MODELS), choices=list(MODELS))
+    parser.add_argument("--output-path", type=str, default=None, help="only with a single model, defaults to the Config path")
+    args = parser.parse_args()
+    assert args.output_path is None or len(args.models) == 1, "--output-path needs a single model"
+    for name in args.models:
+        export(name, args.output_path)
+        logger.info(f"{name}: done")
@@ -4,13 +4,9 @@ import streamlit as st
 import altair as alt
 from PIL import Image
 from utils import *
-from model.clip_vqa_predictor import VQAWithCLIPModule
-from model.blip_vqa_predictor import VQAWithBLIPModule
-from model.vilt_vqa_predictor import VQAWithVILTModule
-from model.ans_detect_predictor import ADModule
+from model.registry import get_registry
 import torch
 import os
-from ultralytics import YOLO
 import shutil
 
 # set device to "cuda" to call the GPU
@@ -25,6 +21,9 @@ st.set_page_config(
 
 st.title('Visual Question Answering')
 
+# models are loaded lazily once per process and shared across sessions and reruns
+registry = get_registry(device=device)
+
 def main():
     st.sidebar.subheader("Input")
     models_list = ["CLIP", "VILT"]
@@ -32,6 +31,9 @@ def main():
    
     make_prediction(selected_model)
 
+    with st.sidebar.expander("Loaded Models"):
+        st.json({"models": registry.stats(), "cache": registry.get("embedding_cache").stats()})
+
 def make_prediction(selected_model):
     text_input = st.sidebar.text_input('Type a question', key="text_input")
     selected_img = st.sidebar.file_uploader("Upload an image", type=["png","jpg","jpeg"])
@@ -45,67 +47,49 @@ def make_prediction(selected_model):
         st.warning('Please upload an image.')
     else:
         st.header('Uploaded Image', divider='rainbow')
-        temp_directory = 'temp/'
-        # Convert uploaded image data into a PIL image object
-        pil_image = Image.open(selected_img)     
+        # Decode the upload once, the same image object is used for display, detection and prediction
+        request_image = RequestImage(selected_img)
         # Resize the image while maintaining the original aspect ratio
-        resized_img = resize_image(pil_image, target_height=500)
+        resized_img = request_image.resized(target_height=500)
         # Display the resized image
         st.image(resized_img, caption="Resized Image", use_column_width='auto')
-        
-        if isinstance(resized_img, list):  # Check if the function returned a list
-            resized_img = resized_img[0]  # Assuming you want the first image
-
-        # Save the resized image to use in prediction
-        resized_path = os.path.join(temp_directory, 'resized_image.jpg')
-        resized_img.save(resized_path)
  
-    ad_predictor = ADModule(device=device)
-
     selected_model = selected_model.lower()
 
     if selected_model == "vilt":
-        vqa_predictor = VQAWithVILTModule(device=device)
+        vqa_predictor = registry.get("vilt_vqa")
     else:
-        vqa_predictor = VQAWithCLIPModule(device=device) # Default to CLIP if model not selected
+        # CLIP is loaded once and shared by the answerability and answer heads
+        clip_encoder = registry.get("clip_encoder")
+        ad_predictor = registry.get("answerability")
+        vqa_predictor = registry.get("clip_vqa") # Default to CLIP if model not selected
 
     if selected_img is not None and (text_input is not None and text_input.strip()):
         if enable_object_detection:
             st.header('Image Annotation and Labeling', divider='rainbow')
-            model = YOLO('model_store/yolov8_best.pt')
-            # Path where the predicted results will be saved
-            labeled_path = os.path.join(temp_directory, 'yolov8_predictions.jpg')
-            # Perform prediction and save the prediction results temporarily
-            results = model.predict(resized_path, imgsz=640, conf=0.5, save=True)
-
-            if isinstance(results, list):  # Check if the function returned a list
-                results = results[0]  # Assuming you want the first image
-
-            # Now, save the image to your specified path
-            results.save(labeled_path)
-
-            # Convert uploaded image data into a PIL image object
-            pil_image = Image.open(labeled_path)  
-            st.image(pil_image, caption="Labled Image", use_column_width='auto')
+            model = registry.get("yolo")
+            # Perform prediction on the in-memory image and draw the boxes without touching the disk
+            # follow-up questions on the same photo reuse the cached detections
+            results = registry.get("embedding_cache").get_or_compute(
+                ("yolo", request_image.key, 500),
+                lambda: model.predict(resized_img, imgsz=640, conf=0.5, verbose=False)[0])
+            st.image(results.plot(), channels="BGR", caption="Labled Image", use_column_width='auto')
 
-        # Check if the file exists and delete it if it does
-        if os.path.exists(resized_path):
-            os.remove(resized_path)
-        if os.path.exists(labeled_path):
-            os.remove(labeled_path)
         with st.spinner("Thinking..."):
             if selected_model == "clip":
-                ad_ans = ad_predictor.predict(image_path = selected_img, question=text_preprocess(text_input))
+                # image and question are encoded a single time for both heads
+                features = clip_encoder.encode(image_path = request_image, question=text_preprocess(text_input))
+                ad_ans = ad_predictor.predict_features(features)
                 print(f'Answerability Detection Score: {ad_ans:.2f}')
-                if ad_ans < 0.65:
+                if ad_ans < Config.answerability_threshold:
                     vqa_ans = f'This question is unanswerable.'
                 else:
-                    vqa_ans = vqa_predictor.predict(image_path = selected_img, question=text_preprocess(text_input))
+                    vqa_ans = vqa_predictor.predict_features(features)
             
                 st.info("**Your Question**: " + text_input)
                 st.success('**Predicted Answer**: ' + vqa_ans.capitalize() + '. ' + f'The answerability score is {ad_ans:.2f}.')
             else:
-                vqa_ans = vqa_predictor.predict(image_path = selected_img, question=text_preprocess(text_input))
+                vqa_ans = vqa_predictor.predict(image_path = request_image, question=text_preprocess(text_input))
                 st.info("**Your Question**: " + text_input)
                 st.success('**Predicted Answer**: ' + vqa_ans.capitalize())
 
@@ -1,6 +1,6 @@
 import torch.nn as nn 
 from loguru import logger
-from utils import Config
+from utils import Config, quantize_model
 import os
 import torch
 import clip
@@ -8,39 +8,49 @@ from PIL import Image
 import numpy as np
 import pickle
 import torch.nn.functional as F
+from model.clip_encoder import CLIPEncoder
 
 class ADModule:
-    def __init__(self, device='cpu'):
+    def __init__(self, device='cpu', clip_encoder=None):
         self.device = device 
+        self.clip_encoder = clip_encoder
         self.load_model()
     
     def load_model(self):
         if Config.ans_model_path is not None and os.path.exists(Config.ans_model_path):
             logger.info("Loading Answerability Detection Pretrained Model")
-            self.clip_model, self.preprocesser = clip.load("RN50", device=self.device)
-            print("Clip Loaded")
+            if self.clip_encoder is None:
+                self.clip_encoder = CLIPEncoder("RN50", device=self.device)
 
             self.model = torch.load(Config.ans_model_path, map_location=torch.device(self.device)).to(torch.device(self.device))
             logger.info("Model Loaded Successfully")
             self.model.eval()  # Set model to evaluation mode
             self.model.to(self.device)
+            if Config.quantize:
+                self.model = quantize_model(self.model, self.device)
             print("Model Loaded")
         else:
             logger.info("Pretrained Answerability Detection Model Path is None or not found")
 
     def predict(self, image_path, question):        
         print(f"Cleaned question: {question}")
+        return self.predict_features(self.clip_encoder.encode(image_path, question))
 
-        image = Image.open(image_path)
-        image = self.preprocesser(image).unsqueeze(0).to(self.device)
-        question = clip.tokenize(question).to(self.device)
+    def predict_features(self, x):
+        """Answerability score from precomputed CLIP [image, text] features"""
         with torch.no_grad():
-            image_features = self.clip_model.encode_image(image)
-            text_features = self.clip_model.encode_text(question)
-            x = torch.cat((image_features, text_features), 1).to(torch.float32)
             # Visual Question Answerability
             sigmoid_activation = nn.Sigmoid()
             outputs = sigmoid_activation(self.model(x))
     
         # Answerability
         return outputs.item()
+
+    def predict_batch(self, images, questions, batch_size=64):
+        """Answerability scores of many (image, question) pairs"""
+        return self.predict_batch_features(self.clip_encoder.encode_batch(images, questions, batch_size=batch_size))
+
+    def predict_batch_features(self, x):
+        with torch.no_grad():
+            scores = torch.sigmoid(self.model(x)).view(-1)
+        return scores.tolist()
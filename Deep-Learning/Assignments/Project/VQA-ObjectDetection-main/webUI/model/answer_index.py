@@ -0,0 +1,76 @@
+import numpy as np
+import torch
+from loguru import logger
+
+
+class AnswerIndex:
+    """Answer vocabulary held in arrays: answers[i] is the string of id i and embeddings[i] its L2
+    normalized CLIP text embedding.
+
+    The first head_size answers are the classes of the trained CLIP head in the order of its logits, the
+    remaining ones are extra answers that only the zero-shot ranking can return.
+
+    ids returned by topk and zero_shot follow the head: id head_size is the unknown class column of the
+    head (OrdinalEncoder unknown_value), which decodes to None, and extra answer i is id head_size + 1 + i.
+    """
+    def __init__(self, answers, embeddings=None, head_size=None, prompt="{}", device='cpu'):
+        self.answers = np.asarray(answers, dtype=object)
+        self.head_size = len(self.answers) if head_size is None else head_size
+        self.unknown_id = self.head_size
+        self.prompt = prompt
+        # answers by id, with None at the unknown id
+        self.labels = np.concatenate([self.answers[:self.head_size], np.array([None], dtype=object), self.answers[self.head_size:]])
+        self.answer_to_id = {answer: idx for idx, answer in enumerate(self.labels.tolist()) if idx != self.unknown_id}
+        self.embeddings = None if embeddings is None else torch.as_tensor(embeddings, dtype=torch.float32).to(device)
+
+    def __len__(self):
+        return len(self.answers)
+
+    @classmethod
+    def build(cls, clip_encoder, head_answers, extra_answers=(), prompt="{}", batch_size=256):
+        """Encodes every answer once with the CLIP text encoder, extra answers already in the head are skipped"""
+        head_answers = list(head_answers)
+        known = set(head_answers)
+        answers = head_answers + [answer for answer in dict.fromkeys(extra_answers) if answer not in known]
+        embeddings = clip_encoder.encode_texts([prompt.format(answer) for answer in answers], batch_size=batch_size).float()
+        embeddings = embeddings / embeddings.norm(dim=-1, keepdim=True)
+        logger.info(f"Answer index of {len(answers)} answers, {len(head_answers)} in the head")
+        return cls(answers, embeddings.cpu(), head_size=len(head_answers), prompt=prompt, device=clip_encoder.device)
+
+    def save(self, path):
+        np.savez(path,
+                 answers=self.answers.astype(str),
+                 embeddings=self.embeddings.cpu().numpy(),
+                 head_size=self.head_size,
+                 prompt=self.prompt)
+
+    @classmethod
+    def load(cls, path, device='cpu'):
+        data = np.load(path)
+        return cls(data["answers"].tolist(), data["embeddings"], head_size=int(data["head_size"]),
+                   prompt=str(data["prompt"]), device=device)
+
+    def decode(self, ids):
+        """answer strings of an array of ids, None for the unknown id"""
+        return self.labels[np.asarray(ids)]
+
+    def topk(self, scores, k=5):
+        """(ids, scores) of the k best columns of every row of scores, best first.
+        argpartition selects the k candidates in linear time, only those k are sorted."""
+        scores = scores.detach().float().cpu().numpy() if isinstance(scores, torch.Tensor) else np.asarray(scores)
+        k = min(k, scores.shape[1])
+        ids = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, ids, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(ids, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def zero_shot(self, image_features, k=5, temperature=100.0):
+        """Ranks the whole vocabulary by the similarity of the image features to the answer embeddings,
+        as in CLIP zero-shot classification. Returns (ids, probabilities)."""
+        assert self.embeddings is not None, "answer index has no embeddings, run build_answer_index.py"
+        image_features = image_features.float()
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        probabilities = (temperature * image_features.to(self.embeddings.device) @ self.embeddings.T).softmax(-1)
+        rows, scores = self.topk(probabilities, k)
+        # rows of the extra answers come after the unknown id
+        return rows + (rows >= self.head_size), scores
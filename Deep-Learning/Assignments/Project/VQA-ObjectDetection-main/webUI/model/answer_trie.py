@@ -0,0 +1,49 @@
+class _Node:
+    __slots__ = ("children", "is_answer", "allowed")
+
+    def __init__(self):
+        self.children = {}
+        self.is_answer = False
+        self.allowed = None
+
+
+class AnswerTrie:
+    """Token trie of a fixed answer list, used to constrain generation to those answers.
+
+    allowed(prefix) lists the tokens that extend prefix towards an answer, plus eos once prefix is
+    a complete answer. It is meant for the prefix_allowed_tokens_fn argument of generate.
+    """
+    def __init__(self, token_sequences, eos_token_id, pad_token_id):
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self.root = _Node()
+        self.depth = 0
+        for tokens in token_sequences:
+            node = self.root
+            for token in tokens:
+                node = node.children.setdefault(token, _Node())
+            node.is_answer = True
+            self.depth = max(self.depth, len(tokens))
+
+    @classmethod
+    def from_answers(cls, tokenizer, answers, eos_token_id, pad_token_id):
+        answers = [answer for answer in dict.fromkeys(answers) if answer.strip() != ""]
+        token_sequences = tokenizer(answers, add_special_tokens=False)["input_ids"]
+        return cls(token_sequences, eos_token_id, pad_token_id)
+
+    def allowed(self, prefix):
+        node = self.root
+        for token in prefix:
+            if token == self.eos_token_id or token == self.pad_token_id:
+                # the answer is finished, generate only pads the row
+                return [self.pad_token_id]
+            node = node.children.get(token)
+            if node is None:
+                return [self.eos_token_id]
+        if node.allowed is None:
+            node.allowed = list(node.children) + ([self.eos_token_id] if node.is_answer else [])
+        return node.allowed
+
+    def prefix_allowed_tokens_fn(self, num_prompt_tokens=1):
+        """generate callback, the first num_prompt_tokens of every sequence (the bos token) are not part of the answer"""
+        return lambda batch_id, input_ids: self.allowed(input_ids[num_prompt_tokens:].tolist())
@@ -0,0 +1,136 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+
+class MicroBatcher:
+    """Groups concurrent requests for one model into micro batches.
+
+    A batch is dispatched once it holds max_batch_size requests or once its oldest request waited
+    max_latency_ms. predict_batch(images, questions) runs in a dedicated worker thread, so a slow
+    model only delays its own queue and the event loop keeps accepting requests. When a batch fails,
+    its requests are retried one by one so that only the offending ones get the error.
+    """
+    def __init__(self, name, predict_batch, max_batch_size=16, max_latency_ms=10):
+        assert max_batch_size >= 1, "max_batch_size should be at least 1"
+        self.name = name
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{name}-batcher")
+        self.queue = None
+        self.task = None
+        # requests taken from the queue whose futures are not resolved yet
+        self.pending = []
+        self.stopped = False
+
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_errors = 0
+        self.queue_time = 0.0
+        self.compute_time = 0.0
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stops the batcher, requests that are queued or being processed fail instead of waiting forever"""
+        self.stopped = True
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        requests = self.pending
+        while self.queue is not None and not self.queue.empty():
+            requests.append(self.queue.get_nowait())
+        for request in requests:
+            if not request[2].done():
+                request[2].set_exception(RuntimeError(f"{self.name} batcher stopped"))
+        self.pending = []
+        self.executor.shutdown(wait=False)
+
+    async def submit(self, image, question):
+        """Queues one (image, question) pair and waits for its prediction"""
+        if self.stopped:
+            raise RuntimeError(f"{self.name} batcher stopped")
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, question, future, time.perf_counter()))
+        return await future
+
+    async def collect(self):
+        # self.pending is filled in place, so stop() also sees the requests of a batch being collected
+        requests = self.pending
+        requests.append(await self.queue.get())
+        deadline = requests[0][3] + self.max_latency
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # take whatever else is already waiting without delaying the batch further
+        while len(requests) < self.max_batch_size and not self.queue.empty():
+            requests.append(self.queue.get_nowait())
+        return requests
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = await self.collect()
+            images = [request[0] for request in requests]
+            questions = [request[1] for request in requests]
+            start_time = time.perf_counter()
+            self.queue_time += sum(start_time - request[3] for request in requests)
+            try:
+                results = await self.predict(loop, images, questions)
+            except Exception as e:
+                logger.exception(f"{self.name} batch of {len(requests)} failed")
+                if len(requests) == 1:
+                    self.num_errors += 1
+                    results = [e]
+                else:
+                    # one bad request should not fail the others, run them one by one
+                    results = [await self.run_one(loop, request) for request in requests]
+            finally:
+                self.compute_time += time.perf_counter() - start_time
+                self.num_batches += 1
+                self.num_requests += len(requests)
+            for request, result in zip(requests, results):
+                if request[2].done():
+                    continue
+                if isinstance(result, Exception):
+                    request[2].set_exception(result)
+                else:
+                    request[2].set_result(result)
+            self.pending = []
+
+    async def predict(self, loop, images, questions):
+        """predict_batch in the worker thread, with one result per request"""
+        results = await loop.run_in_executor(self.executor, self.predict_batch, images, questions)
+        if len(results) != len(images):
+            raise RuntimeError(f"{self.name} predict_batch returned {len(results)} results for {len(images)} requests")
+        return results
+
+    async def run_one(self, loop, request):
+        """Prediction of a single request, or its exception"""
+        try:
+            return (await self.predict(loop, [request[0]], [request[1]]))[0]
+        except Exception as e:
+            logger.error(f"{self.name} request failed: {e!r}")
+            self.num_errors += 1
+            return e
+
+    def stats(self):
+        return {"requests": self.num_requests,
+                "batches": self.num_batches,
+                "errors": self.num_errors,
+                "queued": self.queue.qsize() if self.queue is not None else 0,
+                "avg_batch_size": self.num_requests / max(self.num_batches, 1),
+                "avg_queue_ms": 1e3 * self.queue_time / max(self.num_requests, 1),
+                "avg_batch_ms": 1e3 * self.compute_time / max(self.num_batches, 1)}
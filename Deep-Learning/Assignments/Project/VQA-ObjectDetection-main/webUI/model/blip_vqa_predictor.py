@@ -1,4 +1,4 @@
-from utils import Config
+from utils import Config, quantize_model, load_image, unique_image_chunks
 from transformers import ViltForQuestionAnswering, BlipProcessor, BlipForQuestionAnswering,BlipImageProcessor
 import torch
 from PIL import Image
@@ -7,13 +7,20 @@ import numpy as np
 import os
 import clip
 import pickle
+from model.checkpoint import load_weights
+from model.cache import image_key
+from model.answer_trie import AnswerTrie
+import csv
 
 class VQAWithBLIPModule:
-    def __init__(self, device='cpu'):
+    def __init__(self, device='cpu', cache=None):
         self.device = device 
+        # optional EmbeddingCache of the vision encoder outputs, shared by all questions on an image
+        self.cache = cache
         self.model = None
         self.text_processor = None
         self.image_processor = None
+        self.answer_trie = None
         self.max_length = 20
         self.image_height = 128
         self.image_width = 128
@@ -21,32 +28,56 @@ class VQAWithBLIPModule:
         self.load_blip_model()
 
     def load_blip_model(self):
-        if Config.blip_model_path is not None and os.path.exists(Config.blip_model_path):
+        use_weights = Config.blip_weights_path is not None and os.path.exists(Config.blip_weights_path)
+        if use_weights or (Config.blip_model_path is not None and os.path.exists(Config.blip_model_path)):
             logger.info("Loading BLIP Pretrained Model")
 
             self.text_processor = BlipProcessor.from_pretrained("Salesforce/blip-vqa-base")
             self.image_processor = BlipImageProcessor.from_pretrained("Salesforce/blip-vqa-base")
 
-            self.model = BlipForQuestionAnswering.from_pretrained("Salesforce/blip-vqa-base" )
-
-            if Config.blip_model_path is not None and os.path.exists(Config.blip_model_path):
-                logger.info("Loading Pretrained Model")
-                state_dict = torch.load(Config.blip_model_path, map_location=torch.device(self.device))
-                self.model.load_state_dict(state_dict['state_dict'])
+            if use_weights:
+                # no pretrained initialization, the exported weights are mapped in directly
+                logger.info(f"Loading Exported Weights {Config.blip_weights_path}")
+                self.model = load_weights(Config.blip_weights_path, BlipForQuestionAnswering)
             else:
-                logger.info("Pretrained Model Path is None or not found")
+                self.model = BlipForQuestionAnswering.from_pretrained("Salesforce/blip-vqa-base" )
+
+                if Config.blip_model_path is not None and os.path.exists(Config.blip_model_path):
+                    logger.info("Loading Pretrained Model")
+                    state_dict = torch.load(Config.blip_model_path, map_location=torch.device(self.device))
+                    self.model.load_state_dict(state_dict['state_dict'])
+                else:
+                    logger.info("Pretrained Model Path is None or not found")
 
             logger.info("Model Loaded Successfully")
             self.model.eval()
             self.model.to(self.device)
+            if Config.quantize:
+                self.model = quantize_model(self.model, self.device)
             print("Model Loaded")
         else:
             logger.info("Pretrained BLIP Model Path is None or not found")
 
+    def load_answer_trie(self):
+        """Token trie of the answer space in Config.classmapping_dir for constrained decoding"""
+        with open(Config.classmapping_dir, "r") as f:
+            next(f)  # Skip the header
+            answers = [row[0] for row in csv.reader(f, skipinitialspace=True)]
+        text_config = self.model.config.text_config
+        self.answer_trie = AnswerTrie.from_answers(self.text_processor.tokenizer, answers,
+                                                   eos_token_id=text_config.sep_token_id,
+                                                   pad_token_id=text_config.pad_token_id)
+        logger.info(f"Answer trie of {len(answers)} answers, up to {self.answer_trie.depth} tokens")
+
     def predict(self, image_path, question):
+        """Open ended answer, the image goes through the vision model only if it is not cached"""
         print(f"Cleaned question: {question}")
+        return self.predict_batch([load_image(image_path)], [question])[0][0]
 
-        image = Image.open(image_path)
+    def predict_uncached(self, image_path, question):
+        print(f"Cleaned question: {question}")
+
+        image = load_image(image_path)
         with torch.no_grad():
             image_encoding = self.image_processor(image,
                                     do_resize=True,
@@ -73,4 +104,82 @@ class VQAWithBLIPModule:
             answer = self.text_processor.decode(outputs[0], skip_special_tokens=True)
         
         # Answerability
-        return answer
\ No newline at end of file
+        return answer
+
+    def generate(self, image_embeds, input_ids, attention_mask, **generate_kwargs):
+        """BlipForQuestionAnswering.generate on precomputed image embeddings.
+        The decoder attends to the question attention mask as in training, so padding does not change answers"""
+        image_attention_mask = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=image_embeds.device)
+        question_embeds = self.model.text_encoder(input_ids=input_ids,
+                                                  attention_mask=attention_mask,
+                                                  encoder_hidden_states=image_embeds,
+                                                  encoder_attention_mask=image_attention_mask,
+                                                  return_dict=False)[0]
+        bos_ids = torch.full((question_embeds.size(0), 1), fill_value=self.model.decoder_start_token_id, device=question_embeds.device)
+        return self.model.text_decoder.generate(input_ids=bos_ids,
+                                                eos_token_id=self.model.config.text_config.sep_token_id,
+                                                pad_token_id=self.model.config.text_config.pad_token_id,
+                                                encoder_hidden_states=question_embeds,
+                                                encoder_attention_mask=attention_mask,
+                                                **generate_kwargs)
+
+    def encode_images(self, images, batch_size=32):
+        """Vision encoder outputs of PIL images, only the images missing from the cache go through the vision model"""
+        embeds = [None] * len(images)
+        keys = [("blip", image_key(image), self.image_height, self.image_width) for image in images] if self.cache is not None else None
+        if self.cache is not None:
+            embeds = [self.cache.get(key) for key in keys]
+        missing = [i for i, embed in enumerate(embeds) if embed is None]
+        with torch.no_grad():
+            for start in range(0, len(missing), batch_size):
+                batch = missing[start:start + batch_size]
+                pixel_values = self.image_processor([images[i] for i in batch],
+                                                    do_resize=True,
+                                                    size=(self.image_height, self.image_width),
+                                                    return_tensors="pt")["pixel_values"]
+                for i, embed in zip(batch, self.model.vision_model(pixel_values=pixel_values.to(self.device))[0]):
+                    embeds[i] = embed
+                    if self.cache is not None:
+                        # clone so that the cache does not keep the whole batch alive
+                        self.cache.put(keys[i], embed.clone())
+        return torch.stack(embeds)
+
+    def predict_batch(self, images, questions, batch_size=32, constrained=None):
+        """(answer, sequence probability) of many (image, question) pairs, each distinct image goes through the vision model once.
+
+        With constrained (default Config.blip_constrained_decoding) decoding can only produce answers of
+        the answer space, the probability is then normalized over those answers.
+        """
+        assert len(images) == len(questions), "images and questions should have the same length"
+        pad_token_id = self.model.config.text_config.pad_token_id
+        constrained = Config.blip_constrained_decoding if constrained is None else constrained
+        generate_kwargs = {}
+        if constrained:
+            if self.answer_trie is None:
+                self.load_answer_trie()
+            # answers are short, decoding stops after the longest one
+            generate_kwargs = {"prefix_allowed_tokens_fn": self.answer_trie.prefix_allowed_tokens_fn(),
+                               "max_new_tokens": self.answer_trie.depth + 1}
+
+        results = []
+        with torch.no_grad():
+            for start, batch_images, inverse in unique_image_chunks(images, batch_size):
+                image_embeds = self.encode_images(batch_images, batch_size=batch_size)
+                encoding = self.text_processor(text=questions[start:start + batch_size],
+                                               padding=True,
+                                               truncation=True,
+                                               max_length=self.max_length,
+                                               return_tensors="pt").to(self.device)
+                outputs = self.generate(image_embeds[inverse.to(self.device)],
+                                        encoding["input_ids"],
+                                        encoding["attention_mask"],
+                                        return_dict_in_generate=True,
+                                        output_scores=True,
+                                        **generate_kwargs)
+                token_scores = self.model.text_decoder.compute_transition_scores(outputs.sequences, outputs.scores, normalize_logits=True)
+                # tokens after the end of the answer are padding
+                generated = outputs.sequences[:, -token_scores.size(1):]
+                scores = token_scores.masked_fill(generated == pad_token_id, 0).sum(1).exp()
+                answers = self.text_processor.batch_decode(outputs.sequences, skip_special_tokens=True)
+                results.extend(zip(answers, scores.tolist()))
+        return results
@@ -0,0 +1,109 @@
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+# id(image) -> (weak reference to the image, hash). Not in image.info, which PIL copies to
+# resized and converted images, and PIL images are unhashable so no WeakKeyDictionary either.
+_image_keys = {}
+_image_keys_lock = threading.RLock()
+
+
+def image_key(image):
+    """Hash of the decoded pixels of a PIL image, memoized while the image is alive"""
+    with _image_keys_lock:
+        entry = _image_keys.get(id(image))
+    if entry is not None and entry[0]() is image:
+        return entry[1]
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}{image.size}".encode())
+    digest.update(image.tobytes())
+    key = digest.hexdigest()
+    image_id = id(image)
+    # the entry is dropped when the image is garbage collected, before its id can be reused
+    reference = weakref.ref(image, lambda _: _forget_image(image_id))
+    with _image_keys_lock:
+        _image_keys[image_id] = (reference, key)
+    return key
+
+
+def _forget_image(image_id):
+    with _image_keys_lock:
+        entry = _image_keys.get(image_id)
+        if entry is not None and entry[0]() is None:
+            del _image_keys[image_id]
+
+
+def nbytes(value):
+    """Approximate memory held by a cached value"""
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v) for v in value)
+    # ultralytics Results keep the source image and the predicted boxes
+    if hasattr(value, "orig_img"):
+        boxes = getattr(value, "boxes", None)
+        return nbytes(value.orig_img) + (nbytes(boxes.data) if boxes is not None else 0)
+    return 0
+
+
+class EmbeddingCache:
+    """Thread safe LRU cache of per image results (CLIP image features, YOLO detections, ...).
+
+    Keys are tuples starting with a namespace followed by image_key of the image, so the same photo
+    uploaded twice hits the cache. Least recently used entries are evicted above max_mb.
+    """
+    def __init__(self, max_mb=256):
+        self.max_bytes = int(max_mb * 2**20)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        size = nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {"entries": len(self.entries),
+                "size_mb": self.size / 2**20,
+                "max_mb": self.max_bytes / 2**20,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / max(self.hits + self.misses, 1)}
@@ -0,0 +1,89 @@
+import json
+import mmap
+import torch
+from loguru import logger
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+DTYPES = {"F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+          "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+          "U8": torch.uint8, "BOOL": torch.bool}
+
+
+def export_weights(model, path):
+    """Writes the weights of a Hugging Face model to a safetensors file, without optimizer state.
+
+    Tied tensors are stored once, non-persistent buffers (e.g. position_ids) are stored too so that
+    load_weights does not need to run the model initialization. The model config goes in the metadata.
+    """
+    state_dict = model.state_dict()
+    persistent = set(state_dict)
+    buffers = {name: buffer for name, buffer in model.named_buffers() if name not in persistent}
+
+    tensors, aliases, seen = {}, {}, {}
+    for name, tensor in list(state_dict.items()) + list(buffers.items()):
+        key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape), tensor.dtype)
+        if key in seen:
+            aliases[name] = seen[key]
+            continue
+        seen[key] = name
+        tensors[name] = tensor.detach().cpu().contiguous()
+
+    metadata = {"format": "pt",
+                "config": model.config.to_json_string(),
+                "aliases": json.dumps(aliases),
+                "buffers": json.dumps(list(buffers))}
+    save_file(tensors, path, metadata=metadata)
+    logger.info(f"Exported {len(tensors)} tensors ({len(aliases)} tied) to {path}")
+
+
+def mmap_tensors(path):
+    """Tensors of a safetensors file as views of a copy-on-write memory map of the file.
+
+    Pages are read on first access and stay shared with the page cache until a tensor is written to,
+    whatever the safetensors version (load_file copies the tensors in some of them).
+    """
+    with open(path, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_size))
+        # the tensors keep a reference to the map, it stays valid after the file is closed
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    header.pop("__metadata__", None)
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        dtype = DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if begin == end:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensors[name] = torch.frombuffer(buffer, dtype=dtype, count=(end - begin) // dtype.itemsize,
+                                         offset=data_start + begin).view(info["shape"])
+    return tensors
+
+
+def load_weights(path, model_class, device='cpu'):
+    """Builds model_class on the meta device and assigns the memory mapped tensors of path to it.
+
+    Unlike from_pretrained followed by load_state_dict, no weights are initialized or copied, the
+    parameters are the file pages themselves until they are written to (or moved to another device).
+    """
+    with safe_open(path, framework="pt") as f:
+        metadata = f.metadata()
+    config = model_class.config_class.from_dict(json.loads(metadata["config"]))
+    with torch.device("meta"):
+        model = model_class(config)
+
+    tensors = {name: tensor.to(device) for name, tensor in mmap_tensors(path).items()}
+    for alias, name in json.loads(metadata["aliases"]).items():
+        tensors[alias] = tensors[name]
+    buffers = {name: tensors.pop(name) for name in json.loads(metadata["buffers"])}
+
+    model.load_state_dict(tensors, strict=True, assign=True)
+    for name, buffer in buffers.items():
+        module_name, _, buffer_name = name.rpartition(".")
+        model.get_submodule(module_name)._buffers[buffer_name] = buffer
+
+    on_meta = [name for name, tensor in list(model.named_parameters()) + list(model.named_buffers()) if tensor.is_meta]
+    assert len(on_meta) == 0, f"{path} does not have {on_meta}"
+    return model.eval()
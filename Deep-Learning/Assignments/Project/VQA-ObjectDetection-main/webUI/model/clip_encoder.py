@@ -0,0 +1,59 @@
+import torch
+import clip
+from PIL import Image
+from loguru import logger
+from utils import load_image, unique_image_chunks
+from model.cache import image_key
+
+
+class CLIPEncoder:
+    """Loads CLIP once and computes the [image, text] features shared by the CLIP based heads"""
+    def __init__(self, model_name="RN50", device='cpu', cache=None):
+        self.device = device
+        # optional EmbeddingCache, repeated images then skip the vision backbone
+        self.cache = cache
+        self.model_name = model_name
+        logger.info(f"Loading CLIP {model_name}")
+        self.clip_model, self.preprocess = clip.load(model_name, device=self.device)
+        self.clip_model.eval()
+        print("CLIP Loaded")
+
+    def encode_images(self, images, batch_size=64):
+        """Image features of PIL images, only the images missing from the cache go through CLIP"""
+        features = [None] * len(images)
+        keys = [("clip", self.model_name, image_key(image)) for image in images] if self.cache is not None else None
+        if self.cache is not None:
+            features = [self.cache.get(key) for key in keys]
+        missing = [i for i, feature in enumerate(features) if feature is None]
+        with torch.no_grad():
+            for start in range(0, len(missing), batch_size):
+                batch = missing[start:start + batch_size]
+                pixels = torch.stack([self.preprocess(images[i]) for i in batch]).to(self.device)
+                for i, feature in zip(batch, self.clip_model.encode_image(pixels)):
+                    features[i] = feature
+                    if self.cache is not None:
+                        # clone so that the cache does not keep the whole batch alive
+                        self.cache.put(keys[i], feature.clone())
+        return torch.stack(features)
+
+    def encode_texts(self, questions, batch_size=64):
+        text_features = []
+        with torch.no_grad():
+            for start in range(0, len(questions), batch_size):
+                # questions longer than the 77 token context are cut, as for the training features
+                tokens = clip.tokenize(questions[start:start + batch_size], truncate=True).to(self.device)
+                text_features.append(self.clip_model.encode_text(tokens))
+        return torch.cat(text_features)
+
+    def encode(self, image_path, question):
+        image_features = self.encode_images([load_image(image_path)])
+        text_features = self.encode_texts([question])
+        return torch.cat((image_features, text_features), 1).to(torch.float32)
+
+    def encode_batch(self, images, questions, batch_size=64):
+        """Features of many (image, question) pairs, images are decoded per batch and each distinct image of a batch is encoded once"""
+        assert len(images) == len(questions), "images and questions should have the same length"
+        image_features = torch.cat([self.encode_images(batch_images, batch_size=batch_size)[inverse.to(self.device)]
+                                    for _, batch_images, inverse in unique_image_chunks(images, batch_size)])
+        text_features = self.encode_texts(questions, batch_size=batch_size)
+        return torch.cat((image_features, text_features), 1).to(torch.float32)
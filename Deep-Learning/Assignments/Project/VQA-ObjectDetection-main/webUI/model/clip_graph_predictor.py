@@ -0,0 +1,90 @@
+from utils import Config, load_image, unique_image_chunks
+from model.cache import image_key
+import torch
+import torchvision.transforms as T
+from transformers import CLIPTokenizer
+from loguru import logger
+import json
+import os
+
+
+class CLIPGraphModule:
+    """Runs the TorchScript graph written by export_clip.py: CLIP encoders, answer and answerability heads.
+
+    Neither clip nor the training modules are imported, text is tokenized with the HF CLIP tokenizer.
+    """
+    def __init__(self, device='cpu', num_threads=None, cache=None):
+        self.device = device
+        self.cache = cache
+        self.graph = None
+        if num_threads is not None:
+            # intra-op threads are process wide in torch
+            torch.set_num_threads(num_threads)
+
+        self.load_graph()
+
+    def load_graph(self):
+        if Config.clip_graph_path is not None and os.path.exists(Config.clip_graph_path):
+            logger.info("Loading CLIP graph")
+            extra_files = {"answers.json": "", "preprocess.json": ""}
+            self.graph = torch.jit.load(Config.clip_graph_path, map_location=self.device, _extra_files=extra_files)
+            self.graph.eval()
+            self.answers = json.loads(extra_files["answers.json"])
+            config = json.loads(extra_files["preprocess.json"])
+            self.context_length = config["context_length"]
+            self.preprocess = T.Compose([
+                T.Resize(config["resolution"], interpolation=T.InterpolationMode.BICUBIC),
+                T.CenterCrop(config["resolution"]),
+                T.ToTensor(),
+                T.Normalize(config["mean"], config["std"]),
+            ])
+            self.tokenizer = CLIPTokenizer.from_pretrained(Config.clip_tokenizer)
+            logger.info(f"Graph Loaded with {len(self.answers)} answers, {torch.get_num_threads()} threads")
+        else:
+            logger.info("CLIP graph path is None or not found, run export_clip.py first")
+
+    def tokenize(self, questions):
+        """Same ids as clip.tokenize, zero padded to the context length"""
+        ids = self.tokenizer(questions, truncation=True, max_length=self.context_length)["input_ids"]
+        tokens = torch.zeros(len(ids), self.context_length, dtype=torch.long)
+        for i, sequence in enumerate(ids):
+            tokens[i, :len(sequence)] = torch.tensor(sequence)
+        return tokens.to(self.device)
+
+    def encode_images(self, images, batch_size=64):
+        features = [None] * len(images)
+        keys = [("clip_graph", image_key(image)) for image in images] if self.cache is not None else None
+        if self.cache is not None:
+            features = [self.cache.get(key) for key in keys]
+        missing = [i for i, feature in enumerate(features) if feature is None]
+        with torch.no_grad():
+            for start in range(0, len(missing), batch_size):
+                batch = missing[start:start + batch_size]
+                pixels = torch.stack([self.preprocess(images[i]) for i in batch]).to(self.device)
+                for i, feature in zip(batch, self.graph.encode_image(pixels)):
+                    features[i] = feature
+                    if self.cache is not None:
+                        self.cache.put(keys[i], feature.clone())
+        return torch.stack(features)
+
+    def predict_batch(self, images, questions, batch_size=64):
+        """answer, probability and answerability of many (image, question) pairs"""
+        assert len(images) == len(questions), "images and questions should have the same length"
+        results = []
+        with torch.no_grad():
+            for start, batch_images, inverse in unique_image_chunks(images, batch_size):
+                image_features = self.encode_images(batch_images, batch_size=batch_size)[inverse.to(self.device)]
+                tokens = self.tokenize(questions[start:start + batch_size])
+                probabilities, answerability = self.graph.answer(image_features, tokens)
+                scores, predicted = probabilities.max(-1)
+                # the last column of the head is the unknown class of the answer encoder, it has no answer
+                results.extend({"answer": self.answers[idx] if idx < len(self.answers) else None,
+                                "score": score,
+                                "answerable": ans_score >= Config.answerability_threshold,
+                                "answerability": ans_score}
+                               for idx, score, ans_score in zip(predicted.tolist(), scores.tolist(), answerability.tolist()))
+        return results
+
+    def predict(self, image_path, question):
+        print(f"Cleaned question: {question}")
+        return self.predict_batch([load_image(image_path)], [question])[0]
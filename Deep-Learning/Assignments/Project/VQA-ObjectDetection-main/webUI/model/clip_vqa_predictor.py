@@ -1,4 +1,4 @@
-from utils import Config
+from utils import Config, quantize_model
 from transformers import ViltForQuestionAnswering, BlipProcessor, BlipForQuestionAnswering,BlipImageProcessor
 import torch
 from PIL import Image
@@ -7,13 +7,16 @@ import numpy as np
 import os
 import clip
 import pickle
+from model.clip_encoder import CLIPEncoder
+from model.answer_index import AnswerIndex
 
 class VQAWithCLIPModule:
-    def __init__(self, device='cpu'):
+    def __init__(self, device='cpu', clip_encoder=None):
         self.device = device
         self.model = None
-        self.preprocess = None
+        self.clip_encoder = clip_encoder
         self.encoder = None
+        self.index = None
 
         self.load_clip_model()
 
@@ -21,35 +24,69 @@ class VQAWithCLIPModule:
         if Config.clip_model_path is not None and os.path.exists(Config.clip_model_path):
             logger.info("Loading CLIP Pretrained Model")
 
-            self.clip_model, self.preprocess = clip.load("RN50", device=self.device)
-            print("CLIP Loaded")
+            if self.clip_encoder is None:
+                self.clip_encoder = CLIPEncoder("RN50", device=self.device)
 
             with open(Config.encoder_path, 'rb') as f:
                 encoder = pickle.load(f)
             self.encoder = encoder
+            self.load_answer_index()
 
             self.model = torch.load(Config.clip_model_path, map_location=torch.device(self.device)).to(torch.device(self.device))
             logger.info("Model Loaded Successfully")
             self.model.eval()
             self.model.to(self.device)
+            if Config.quantize:
+                self.model = quantize_model(self.model, self.device)
             print("Model Loaded")
         else:
             logger.info("Pretrained CLIP Model Path is None or not found")
 
+    def load_answer_index(self):
+        if Config.answer_index_path is not None and os.path.exists(Config.answer_index_path):
+            self.index = AnswerIndex.load(Config.answer_index_path, device=self.device)
+            assert self.index.answers[:self.index.head_size].tolist() == self.encoder.categories_[0].tolist(), \
+                f"{Config.answer_index_path} was built for another answer encoder"
+            logger.info(f"Answer index of {len(self.index)} answers loaded")
+        else:
+            # strings only, top-k without the zero-shot fallback
+            self.index = AnswerIndex(self.encoder.categories_[0].tolist())
+            logger.info("Answer index path is None or not found, zero-shot fallback disabled")
+
     def predict(self, image_path, question):
         print(f"Cleaned question: {question}")
+        return self.predict_features(self.clip_encoder.encode(image_path, question))
+
+    def predict_features(self, x):
+        """Answer from precomputed CLIP [image, text] features"""
+        return self.predict_batch_features(x)[0][0]
+
+    def predict_batch(self, images, questions, batch_size=64):
+        """(answer, probability) of many (image, question) pairs"""
+        return self.predict_batch_features(self.clip_encoder.encode_batch(images, questions, batch_size=batch_size))
 
-        image = Image.open(image_path)
-        image = self.preprocess(image).unsqueeze(0).to(self.device)
-        question = clip.tokenize(question).to(self.device)
+    def predict_batch_features(self, x):
+        return [answers[0] for answers in self.topk_features(x, k=1)]
+
+    def predict_topk(self, images, questions, k=5, batch_size=64):
+        """k best (answer, probability) of every (image, question) pair"""
+        return self.topk_features(self.clip_encoder.encode_batch(images, questions, batch_size=batch_size), k=k)
+
+    def topk_features(self, x, k=5):
+        """Top-k answers of the head, questions whose best head probability is below
+        Config.zero_shot_threshold are ranked zero-shot over the whole answer index instead"""
         with torch.no_grad():
-            image_features = self.clip_model.encode_image(image)
-            text_features = self.clip_model.encode_text(question)
-            x = torch.cat((image_features, text_features), 1).to(torch.float32)
-            # Visual Question Answering
-            outputs = self.model(x).squeeze(1)
-            _, predicted = outputs.max(1)
-            answer = self.encoder.inverse_transform(np.array(predicted.to('cpu')).reshape(-1,1))
-            
-            # Answerability
-            return answer.item()
+            probabilities = self.model(x).view(len(x), -1).softmax(-1)
+        ids, scores = self.index.topk(probabilities, k)
+
+        if Config.zero_shot_threshold is not None and self.index.embeddings is not None:
+            fallback = np.flatnonzero(scores[:, 0] < Config.zero_shot_threshold)
+            if len(fallback) > 0:
+                # x is [image, text], the image half is the CLIP image embedding
+                image_features = x[torch.as_tensor(fallback, device=x.device), :x.shape[1] // 2]
+                zs_ids, zs_scores = self.index.zero_shot(image_features, k)
+                ids, scores = ids.copy(), scores.copy()
+                ids[fallback], scores[fallback] = zs_ids, zs_scores
+
+        answers = self.index.decode(ids)
+        return [list(zip(row_answers.tolist(), row_scores.tolist())) for row_answers, row_scores in zip(answers, scores)]
@@ -0,0 +1,113 @@
+import os
+import time
+import threading
+import psutil
+from loguru import logger
+from utils import Config
+
+
+class ModelRegistry:
+    """Process wide store of the webUI models.
+
+    Every model is built by its factory the first time it is requested and then shared by all the
+    sessions of the process. Load time and the resident memory added by each load are recorded.
+    """
+    def __init__(self, device='cpu'):
+        self.device = device
+        self._factories = {}
+        self._requires = {}
+        self._models = {}
+        self._stats = {}
+        # re-entrant since factories fetch the models they depend on
+        self._lock = threading.RLock()
+
+    def register(self, name, factory, requires=()):
+        """factory(registry) builds the model, requires lists models that must be loaded before it"""
+        self._factories[name] = factory
+        self._requires[name] = tuple(requires)
+
+    def get(self, name):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        assert name in self._factories, f"{name} is not registered, available models {list(self._factories)}"
+        with self._lock:
+            if name not in self._models:
+                # dependencies first so that the stats of a model only cover its own weights
+                for dependency in self._requires[name]:
+                    self.get(dependency)
+                process = psutil.Process(os.getpid())
+                rss_before = process.memory_info().rss
+                start_time = time.perf_counter()
+                self._models[name] = self._factories[name](self)
+                self._stats[name] = {"load_time_s": time.perf_counter() - start_time,
+                                     "rss_mb": (process.memory_info().rss - rss_before) / 2**20}
+                logger.info(f"Loaded {name} in {self._stats[name]['load_time_s']:.2f}s (+{self._stats[name]['rss_mb']:.0f}MB RSS)")
+        return self._models[name]
+
+    def loaded(self):
+        return list(self._models)
+
+    def stats(self):
+        """Load time and resident memory per loaded model, plus the current process RSS"""
+        stats = {name: dict(values) for name, values in self._stats.items()}
+        stats["process"] = {"rss_mb": psutil.Process(os.getpid()).memory_info().rss / 2**20}
+        return stats
+
+
+def _embedding_cache(registry):
+    from model.cache import EmbeddingCache
+    return EmbeddingCache(max_mb=Config.embedding_cache_mb)
+
+def _clip_encoder(registry):
+    from model.clip_encoder import CLIPEncoder
+    return CLIPEncoder("RN50", device=registry.device, cache=registry.get("embedding_cache"))
+
+def _answerability(registry):
+    from model.ans_detect_predictor import ADModule
+    return ADModule(device=registry.device, clip_encoder=registry.get("clip_encoder"))
+
+def _clip_vqa(registry):
+    from model.clip_vqa_predictor import VQAWithCLIPModule
+    return VQAWithCLIPModule(device=registry.device, clip_encoder=registry.get("clip_encoder"))
+
+def _clip_graph(registry):
+    from model.clip_graph_predictor import CLIPGraphModule
+    return CLIPGraphModule(device=registry.device, num_threads=Config.graph_num_threads, cache=registry.get("embedding_cache"))
+
+def _vilt_vqa(registry):
+    from model.vilt_vqa_predictor import VQAWithVILTModule
+    return VQAWithVILTModule(device=registry.device)
+
+def _blip_vqa(registry):
+    from model.blip_vqa_predictor import VQAWithBLIPModule
+    return VQAWithBLIPModule(device=registry.device, cache=registry.get("embedding_cache"))
+
+def _yolo(registry):
+    from ultralytics import YOLO
+    return YOLO(Config.yolo_model_path)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def build_registry(device='cpu'):
+    """New registry with all the webUI models registered"""
+    registry = ModelRegistry(device=device)
+    registry.register("embedding_cache", _embedding_cache)
+    registry.register("clip_encoder", _clip_encoder, requires=("embedding_cache",))
+    registry.register("answerability", _answerability, requires=("clip_encoder",))
+    registry.register("clip_vqa", _clip_vqa, requires=("clip_encoder",))
+    registry.register("clip_graph", _clip_graph, requires=("embedding_cache",))
+    registry.register("vilt_vqa", _vilt_vqa)
+    registry.register("blip_vqa", _blip_vqa, requires=("embedding_cache",))
+    registry.register("yolo", _yolo)
+    return registry
+
+def get_registry(device='cpu'):
+    """Registry shared by the whole process, created on first call"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = build_registry(device=device)
+    return _registry
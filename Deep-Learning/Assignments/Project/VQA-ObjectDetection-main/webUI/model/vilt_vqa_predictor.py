@@ -1,5 +1,7 @@
-from utils import Config
+from utils import Config, quantize_model, load_image, unique_image_chunks
 from transformers import ViltProcessor, ViltForQuestionAnswering
+from network import ViltExitHeads
+from model.checkpoint import load_weights
 import torch
 from PIL import Image
 from loguru import logger
@@ -13,6 +15,7 @@ class VQAWithVILTModule:
         self.model = None
         self.preprocess = None
         self.encoder = None
+        self.exit_heads = None
 
         self.load_vilt_model()
 
@@ -26,7 +29,8 @@ class VQAWithVILTModule:
             return label2id, id2label
 
     def load_vilt_model(self):
-        if Config.vilt_model_path is not None and os.path.exists(Config.vilt_model_path):
+        use_weights = Config.vilt_weights_path is not None and os.path.exists(Config.vilt_weights_path)
+        if use_weights or (Config.vilt_model_path is not None and os.path.exists(Config.vilt_model_path)):
             logger.info("Loading VILT Pretrained Model")
 
             self.processor = ViltProcessor.from_pretrained("dandelin/vilt-b32-mlm")
@@ -34,7 +38,11 @@ class VQAWithVILTModule:
             # self.label2id = None
             self.model = None
 
-            if Config.vilt_model_path is not None and os.path.exists(Config.vilt_model_path):
+            if use_weights:
+                # no pretrained initialization, the exported weights are mapped in directly
+                logger.info(f"Loading Exported Weights {Config.vilt_weights_path}")
+                self.model = load_weights(Config.vilt_weights_path, ViltForQuestionAnswering)
+            elif Config.vilt_model_path is not None and os.path.exists(Config.vilt_model_path):
                 logger.info("Loading Pretrained Model")
                 
                 label2id, id2label = self.load_mappings()
@@ -50,27 +58,47 @@ class VQAWithVILTModule:
             logger.info("Model Loaded Successfully")
             self.model.eval()
             self.model.to(self.device)
+            if Config.quantize:
+                self.model = quantize_model(self.model, self.device)
+            self.load_exit_heads()
             print("Model Loaded")
         else:
             logger.info("Pretrained VILT Model Path is None or not found")
 
+    def load_exit_heads(self):
+        if Config.vilt_early_exit_path is not None and os.path.exists(Config.vilt_early_exit_path):
+            checkpoint = torch.load(Config.vilt_early_exit_path, map_location=torch.device(self.device))
+            config = self.model.config
+            self.exit_heads = ViltExitHeads(config.hidden_size, config.num_labels, checkpoint["exit_layers"])
+            self.exit_heads.load_state_dict(checkpoint["state_dict"])
+            self.exit_heads.to(self.device).eval()
+            logger.info(f"Early exit after layers {checkpoint['exit_layers']} at threshold {Config.vilt_exit_threshold}")
+
+    def scores(self, encoding):
+        """sigmoid score and id of the top answer, stopping at the first confident exit head when they are loaded"""
+        with torch.no_grad():
+            if self.exit_heads is not None:
+                inputs = {k: encoding[k] for k in ["input_ids", "attention_mask", "token_type_ids", "pixel_values", "pixel_mask"]}
+                predicted, scores, _ = self.exit_heads.predict(self.model, Config.vilt_exit_threshold, **inputs)
+                return scores, predicted
+            return torch.sigmoid(self.model(**encoding).logits).max(-1)
+
     def predict(self, image_path, question):
         print(f"Cleaned question: {question}")
 
-        image = Image.open(image_path)
+        image = load_image(image_path)
         encoding = self.processor(image, question, padding="max_length", truncation=True, return_tensors="pt")
         pixel_mask = self.processor.image_processor.pad(encoding['pixel_values'], return_tensors="pt")['pixel_mask']
         encoding['pixel_mask'] = pixel_mask
         encoding.to(self.device)
 
         with torch.no_grad():   
-            outputs = self.model(**encoding)
             # logits = torch.sigmoid(outputs.logits)
             # logits = logits.detach().cpu().numpy()[0]
             # sorted_indices = np.argsort(logits)[::-1] 
             # answer = self.id2label[sorted_indices[0]]
-            logits = outputs.logits
-            idx = logits.argmax(-1).item()
+            _, predicted = self.scores(encoding)
+            idx = predicted.item()
             print('!!!!')
             print(idx)
             answer = self.model.config.id2label[idx]
@@ -78,3 +106,21 @@ class VQAWithVILTModule:
             # Answerability
             return answer
 
+
+    def predict_batch(self, images, questions, batch_size=32):
+        """(answer, sigmoid score) of many (image, question) pairs.
+        Images are decoded and resized per batch, once per distinct image of the batch, questions are padded per batch"""
+        assert len(images) == len(questions), "images and questions should have the same length"
+        results = []
+        for start, batch_images, inverse in unique_image_chunks(images, batch_size):
+            pixels = [self.processor.image_processor(image, return_tensors="np")["pixel_values"][0] for image in batch_images]
+            batch_pixels = [pixels[i] for i in inverse.tolist()]
+            encoding = self.processor.image_processor.pad(batch_pixels, return_pixel_mask=True, return_tensors="pt")
+            encoding.update(self.processor.tokenizer(questions[start:start + batch_size],
+                                                     padding=True,
+                                                     truncation=True,
+                                                     return_tensors="pt"))
+            encoding = {k: v.to(self.device) for k, v in encoding.items()}
+            scores, predicted = self.scores(encoding)
+            results.extend((self.model.config.id2label[idx], score) for idx, score in zip(predicted.tolist(), scores.tolist()))
+        return results
@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -39,4 +40,65 @@ class AnsModelV1(nn.Module):
         x = self.activation(x)
         x = self.dropout(x)
         x = self.fc2(x)
-        return x
\ No newline at end of file
+        return x
+
+
+# also imported by src/vilt_vqa/early_exit.py to train the heads, keep it free of webUI dependencies
+class ViltExitHeads(nn.Module):
+    """Lightweight answer classifiers on the [CLS] token after some intermediate encoder layers.
+
+    exit_layers are 1-based layer counts, e.g. 4 is a head on the output of the 4th layer.
+    The last layer keeps the fine-tuned ViLT pooler and classifier.
+    """
+    def __init__(self, hidden_size, num_labels, exit_layers):
+        super().__init__()
+        self.exit_layers = list(exit_layers)
+        self.heads = nn.ModuleList(nn.Sequential(nn.LayerNorm(hidden_size), nn.Linear(hidden_size, num_labels))
+                                   for _ in self.exit_layers)
+
+    def forward(self, index, hidden_states):
+        return self.heads[index](hidden_states[:, 0])
+
+    @staticmethod
+    def embed(vilt, input_ids, attention_mask, token_type_ids, pixel_values, pixel_mask):
+        """Embeddings and extended attention mask of the text and image tokens, as in ViltModel.forward"""
+        embeddings, mask = vilt.vilt.embeddings(input_ids, attention_mask, token_type_ids, pixel_values, pixel_mask, None, None)
+        return embeddings, vilt.vilt.get_extended_attention_mask(mask, input_ids.size())
+
+    @staticmethod
+    def final_logits(vilt, hidden_states):
+        return vilt.classifier(vilt.vilt.pooler(vilt.vilt.layernorm(hidden_states)))
+
+    def predict(self, vilt, threshold, input_ids, attention_mask, token_type_ids, pixel_values, pixel_mask):
+        """Runs the encoder layer by layer and stops a question at the first exit whose top answer
+        sigmoid score reaches threshold. Finished questions are removed from the batch, so the
+        remaining layers only run on the hard ones.
+
+        Returns the predicted ids, their scores and the number of layers executed per question.
+        """
+        hidden, mask = self.embed(vilt, input_ids, attention_mask, token_type_ids, pixel_values, pixel_mask)
+        batch_size = hidden.size(0)
+        preds = torch.zeros(batch_size, dtype=torch.long, device=hidden.device)
+        scores = torch.zeros(batch_size, device=hidden.device)
+        layers = torch.zeros(batch_size, dtype=torch.long, device=hidden.device)
+        active = torch.arange(batch_size, device=hidden.device)
+        exits = {layer: index for index, layer in enumerate(self.exit_layers)}
+        num_layers = len(vilt.vilt.encoder.layer)
+
+        for depth, layer in enumerate(vilt.vilt.encoder.layer, start=1):
+            hidden = layer(hidden, mask)[0]
+            if depth == num_layers:
+                logits = self.final_logits(vilt, hidden)
+            elif depth in exits:
+                logits = self(exits[depth], hidden)
+            else:
+                continue
+            score, pred = torch.sigmoid(logits.float()).max(-1)
+            done = score >= threshold if depth < num_layers else torch.ones_like(score, dtype=torch.bool)
+            finished = active[done]
+            preds[finished], scores[finished], layers[finished] = pred[done], score[done], depth
+            if done.all():
+                break
+            keep = ~done
+            active, hidden, mask = active[keep], hidden[keep], mask[keep]
+        return preds, scores, layers
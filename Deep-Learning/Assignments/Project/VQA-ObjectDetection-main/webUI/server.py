@@ -0,0 +1,116 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+import io
+import asyncio
+import argparse
+from contextlib import asynccontextmanager
+import torch
+import uvicorn
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from PIL import Image, UnidentifiedImageError
+from loguru import logger
+from utils import Config, text_preprocess
+from model.registry import get_registry
+from model.batching import MicroBatcher
+
+
+def clip_pipeline(registry):
+    """CLIP features are computed once per batch and shared by the answerability and answer heads"""
+    encoder = registry.get("clip_encoder")
+    ad_predictor = registry.get("answerability")
+    vqa_predictor = registry.get("clip_vqa")
+
+    def predict_batch(images, questions):
+        x = encoder.encode_batch(images, questions)
+        answerability = ad_predictor.predict_batch_features(x)
+        answers = vqa_predictor.predict_batch_features(x)
+        return [{"answer": answer if score >= Config.answerability_threshold else None,
+                 "score": probability,
+                 "answerable": score >= Config.answerability_threshold,
+                 "answerability": score}
+                for (answer, probability), score in zip(answers, answerability)]
+    return predict_batch
+
+def vqa_pipeline(name):
+    def build(registry):
+        predictor = registry.get(name)
+        def predict_batch(images, questions):
+            return [{"answer": answer, "score": score} for answer, score in predictor.predict_batch(images, questions)]
+        return predict_batch
+    return build
+
+def clip_graph_pipeline(registry):
+    return registry.get("clip_graph").predict_batch
+
+def decode_image(data):
+    return Image.open(io.BytesIO(data)).convert('RGB')
+
+PIPELINES = {"clip": clip_pipeline,
+             "clip_graph": clip_graph_pipeline,
+             "vilt": vqa_pipeline("vilt_vqa"),
+             "blip": vqa_pipeline("blip_vqa")}
+
+
+def create_app(models=("clip",), device='cpu', max_batch_size=16, max_latency_ms=10):
+    registry = get_registry(device=device)
+    batchers = {}
+
+    @asynccontextmanager
+    async def lifespan(app):
+        for name in models:
+            # models are loaded before serving so that the first requests do not pay for it
+            predict_batch = await asyncio.to_thread(PIPELINES[name], registry)
+            batchers[name] = MicroBatcher(name, predict_batch, max_batch_size=max_batch_size, max_latency_ms=max_latency_ms)
+            batchers[name].start()
+        logger.info(f"Serving {list(batchers)}")
+        yield
+        for batcher in batchers.values():
+            await batcher.stop()
+
+    app = FastAPI(title="Visual Question Answering", lifespan=lifespan)
+
+    @app.post("/predict")
+    async def predict(image: UploadFile = File(...), question: str = Form(...), model: str = Form("clip")):
+        if model not in batchers:
+            raise HTTPException(status_code=404, detail=f"model should be one of {list(batchers)}")
+        question = text_preprocess(question).strip()
+        if not question:
+            raise HTTPException(status_code=400, detail="question is empty")
+        data = await image.read()
+        try:
+            # decoding is cpu bound, keep it off the event loop
+            pil_image = await asyncio.get_running_loop().run_in_executor(None, decode_image, data)
+        except UnidentifiedImageError:
+            raise HTTPException(status_code=400, detail="image could not be decoded")
+        result = await batchers[model].submit(pil_image, question)
+        return {"model": model, "question": question, **result}
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok", "models": list(batchers), "device": device}
+
+    @app.get("/stats")
+    async def stats():
+        return {"batchers": {name: batcher.stats() for name, batcher in batchers.items()},
+                "models": registry.stats(),
+                "cache": registry.get("embedding_cache").stats()}
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=str, nargs="+", default=["clip"], choices=list(PIPELINES))
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-latency-ms", type=float, default=10)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    app = create_app(models=args.models,
+                     device=args.device,
+                     max_batch_size=args.max_batch_size,
+                     max_latency_ms=args.max_latency_ms)
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,88 @@
+import re
+from functools import lru_cache
+
+# Also imported by src/common/text.py for data prep, only re and functools are imported so that it
+# can be used without the UI dependencies.
+
+def decontractions(phrase):
+    phrase = re.sub(r"won\'t", "will not", phrase)
+    phrase = re.sub(r"can\'t", "can not", phrase)
+    phrase = re.sub(r"won\’t", "will not", phrase)
+    phrase = re.sub(r"can\’t", "can not", phrase)
+    phrase = re.sub(r"he\'s", "he is", phrase)
+    phrase = re.sub(r"she\'s", "she is", phrase)
+    phrase = re.sub(r"it\'s", "it is", phrase)
+    phrase = re.sub(r"he\’s", "he is", phrase)
+    phrase = re.sub(r"she\’s", "she is", phrase)
+    phrase = re.sub(r"it\’s", "it is", phrase)
+    # general
+    phrase = re.sub(r"n\'t", " not", phrase)
+    phrase = re.sub(r"\'re", " are", phrase)
+    phrase = re.sub(r"\'d", " would", phrase)
+    phrase = re.sub(r"\'ll", " will", phrase)
+    phrase = re.sub(r"\'t", " not", phrase)
+    phrase = re.sub(r"\'ve", " have", phrase)
+    phrase = re.sub(r"\'m", " am", phrase)
+    phrase = re.sub(r"n\’t", " not", phrase)
+    phrase = re.sub(r"\’re", " are", phrase)
+    phrase = re.sub(r"\’d", " would", phrase)
+    phrase = re.sub(r"\’ll", " will", phrase)
+    phrase = re.sub(r"\’t", " not", phrase)
+    phrase = re.sub(r"\’ve", " have", phrase)
+    phrase = re.sub(r"\’m", " am", phrase)
+    return phrase
+
+def legacy_text_preprocess(text):
+    """Reference implementation of text_preprocess, kept for benchmark.py"""
+    text = text.lower()
+    text = decontractions(text) # replace contractions into natural form
+    text = re.sub('[-,:]', ' ', text) # replace the character "-" "," with space
+    text = re.sub("(?!<=\d)(\.)(?!\d)", '', text) # remove the character ".", except from floating numbers
+    text = re.sub('[^A-Za-z0-9. ]+', '', text) # remove all punctuation, except A-Za-z0-9 
+    text = re.sub(' +', ' ', text) # remove extra space
+    return text
+
+# same table and priority as decontractions
+CONTRACTIONS = [
+    ("won't", "will not"), ("can't", "can not"), ("won’t", "will not"), ("can’t", "can not"),
+    ("he's", "he is"), ("she's", "she is"), ("it's", "it is"),
+    ("he’s", "he is"), ("she’s", "she is"), ("it’s", "it is"),
+    ("n't", " not"), ("'re", " are"), ("'d", " would"), ("'ll", " will"), ("'t", " not"), ("'ve", " have"), ("'m", " am"),
+    ("n’t", " not"), ("’re", " are"), ("’d", " would"), ("’ll", " will"), ("’t", " not"), ("’ve", " have"), ("’m", " am"),
+]
+
+class TextNormalizer:
+    """Single pass version of legacy_text_preprocess with memoization.
+
+    Contractions are one alternation regex with a dict lookup. The cleanup is a second regex whose
+    matches are runs of characters that the legacy passes drop or turn into spaces: a run becomes
+    one space if it holds a space, "-", "," or ":", and is removed otherwise.
+    """
+    def __init__(self, cache_size=4096):
+        self.contractions = dict(CONTRACTIONS)
+        self.contraction_pattern = re.compile("|".join(re.escape(k) for k, _ in CONTRACTIONS))
+        self.cleanup_pattern = re.compile(r"(?:[-,: ]|\.(?!\d)|[^A-Za-z0-9. ])+")
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+
+    def _replace_run(self, match):
+        run = match.group()
+        return ' ' if (' ' in run or '-' in run or ',' in run or ':' in run) else ''
+
+    def _normalize(self, text):
+        text = self.contraction_pattern.sub(lambda match: self.contractions[match.group()], text.lower())
+        return self.cleanup_pattern.sub(self._replace_run, text)
+
+    def __call__(self, text):
+        return self.normalize(text)
+
+    def normalize_series(self, texts):
+        """Normalizes a pandas Series (or any list) of texts, each distinct text is processed once"""
+        if not hasattr(texts, "map"):
+            return [self.normalize(text) for text in texts]
+        mapping = {text: self._normalize(text) for text in texts.unique()}
+        return texts.map(mapping)
+
+text_normalizer = TextNormalizer()
+
+def text_preprocess(text):
+    return text_normalizer(text)
@@ -1,10 +1,13 @@
-import re
 from PIL import Image
 import streamlit as st
 import torch
 import io
 import scipy
 import base64
+from loguru import logger
+from functools import cached_property
+# text normalization lives in the dependency light text module, re-exported for the existing imports
+from text import decontractions, legacy_text_preprocess, TextNormalizer, text_normalizer, text_preprocess
 
 
 class Config:
@@ -15,43 +18,79 @@ class Config:
     encoder_path = "model_store/encoder.pkl"
     ans_model_path = "model_store/ans_model.pth"
     classmapping_dir = "model_store/class_mapping.csv"
+    yolo_model_path = "model_store/yolov8_best.pt"
+    # weights only safetensors exports of the ViLT and BLIP checkpoints, see export_weights.py
+    vilt_weights_path = "model_store/vilt_vqa.safetensors"
+    blip_weights_path = "model_store/blip_vqa.safetensors"
+    # restrict BLIP answers to the answer space of classmapping_dir
+    blip_constrained_decoding = False
+    # CLIP answers are only given above this answerability score
+    answerability_threshold = 0.65
+    # memory bound of the image feature / detection cache shared by all sessions
+    embedding_cache_mb = 256
+    # int8 dynamic quantization of the Linear layers for CPU serving
+    quantize = False
+    # TorchScript export of CLIP and both heads, see export_clip.py
+    clip_graph_path = "model_store/clip_vqa_graph.pt"
+    clip_tokenizer = "openai/clip-vit-base-patch32"
+    graph_num_threads = 4
+    # CLIP text embeddings of the answer vocabulary, see build_answer_index.py
+    answer_index_path = "model_store/answer_index.npz"
+    # CLIP head answers below this probability are replaced by zero-shot ranking, None keeps the head answers
+    zero_shot_threshold = None
+    # ViLT exit heads trained with src/vilt_vqa/early_exit.py, None runs all the layers
+    vilt_early_exit_path = None
+    vilt_exit_threshold = 0.9
 
-def decontractions(phrase):
-    phrase = re.sub(r"won\'t", "will not", phrase)
-    phrase = re.sub(r"can\'t", "can not", phrase)
-    phrase = re.sub(r"won\’t", "will not", phrase)
-    phrase = re.sub(r"can\’t", "can not", phrase)
-    phrase = re.sub(r"he\'s", "he is", phrase)
-    phrase = re.sub(r"she\'s", "she is", phrase)
-    phrase = re.sub(r"it\'s", "it is", phrase)
-    phrase = re.sub(r"he\’s", "he is", phrase)
-    phrase = re.sub(r"she\’s", "she is", phrase)
-    phrase = re.sub(r"it\’s", "it is", phrase)
-    # general
-    phrase = re.sub(r"n\'t", " not", phrase)
-    phrase = re.sub(r"\'re", " are", phrase)
-    phrase = re.sub(r"\'d", " would", phrase)
-    phrase = re.sub(r"\'ll", " will", phrase)
-    phrase = re.sub(r"\'t", " not", phrase)
-    phrase = re.sub(r"\'ve", " have", phrase)
-    phrase = re.sub(r"\'m", " am", phrase)
-    phrase = re.sub(r"n\’t", " not", phrase)
-    phrase = re.sub(r"\’re", " are", phrase)
-    phrase = re.sub(r"\’d", " would", phrase)
-    phrase = re.sub(r"\’ll", " will", phrase)
-    phrase = re.sub(r"\’t", " not", phrase)
-    phrase = re.sub(r"\’ve", " have", phrase)
-    phrase = re.sub(r"\’m", " am", phrase)
-    return phrase
-
-def text_preprocess(text):
-    text = text.lower()
-    text = decontractions(text) # replace contractions into natural form
-    text = re.sub('[-,:]', ' ', text) # replace the character "-" "," with space
-    text = re.sub("(?!<=\d)(\.)(?!\d)", '', text) # remove the character ".", except from floating numbers
-    text = re.sub('[^A-Za-z0-9. ]+', '', text) # remove all punctuation, except A-Za-z0-9 
-    text = re.sub(' +', ' ', text) # remove extra space
-    return text
+def quantize_model(model, device='cpu'):
+    """Dynamic int8 quantization of the Linear layers, only supported on CPU"""
+    if torch.device(device).type != 'cpu':
+        logger.warning(f"Dynamic quantization runs on CPU only, keeping fp32 on {device}")
+        return model
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_image(image):
+    """RGB PIL image from a path, an uploaded file, a RequestImage or a PIL image"""
+    if isinstance(image, RequestImage):
+        return image.pil
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    return image if image.mode == 'RGB' else image.convert('RGB')
+
+class RequestImage:
+    """Uploaded image decoded once per request and shared by the resizer, YOLO and the predictors"""
+    def __init__(self, source):
+        self.pil = load_image(source)
+        self._resized = {}
+
+    @cached_property
+    def key(self):
+        from model.cache import image_key
+        return image_key(self.pil)
+
+    def resized(self, target_height):
+        if target_height not in self._resized:
+            self._resized[target_height] = resize_image(self.pil, target_height)
+        return self._resized[target_height]
+
+def load_unique_images(images):
+    """Opens every distinct image (path, file or PIL image) once.
+    Returns the RGB images and, for each input, the index of its image in that list"""
+    positions, unique, inverse = {}, [], []
+    for image in images:
+        key = image if isinstance(image, str) else id(image)
+        if key not in positions:
+            positions[key] = len(unique)
+            unique.append(load_image(image))
+        inverse.append(positions[key])
+    return unique, torch.tensor(inverse)
+
+def unique_image_chunks(images, batch_size):
+    """load_unique_images of every batch_size slice of images, so that only one slice of decoded
+    images is held at a time. Yields (start, unique images, inverse) with inverse relative to the slice"""
+    for start in range(0, len(images), batch_size):
+        unique, inverse = load_unique_images(images[start:start + batch_size])
+        yield start, unique, inverse
 
 def resize_image(image, target_height):
     width_percent = target_height / float(image.size[1])
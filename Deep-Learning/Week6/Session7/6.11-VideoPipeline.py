@@ -0,0 +1,292 @@
+import cv2
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+from ultralytics import YOLO
+from ultralytics.utils.plotting import Annotator
+
+# Same detection as 6.6-VideoCapture.py, but capture, preprocessing, inference and annotation
+# run in their own threads connected by bounded queues, so a slow model no longer blocks capture.
+#
+#   python 6.11-VideoPipeline.py --source 0                              # webcam, stale frames dropped
+#   python 6.11-VideoPipeline.py --source video.mp4 --batch-size 8 --no-show --output out.mp4
+
+STOP = None  # end of stream marker passed down the pipeline
+STAGES = ["capture", "preprocess", "queue", "inference", "annotate"]
+
+
+class Frame:
+    def __init__(self, index, image):
+        self.index = index
+        self.image = image
+        self.input = None
+        self.result = None
+        self.times = {"start": time.perf_counter()}
+
+    def mark(self, stage):
+        self.times[stage] = time.perf_counter()
+
+
+class Stats:
+    """Per stage latency and end-to-end throughput of the frames that made it through the pipeline.
+
+    The latency of a stage is the time since the previous stage finished, so it includes the wait in its input queue.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {stage: [] for stage in STAGES + ["total"]}
+        self.dropped = 0
+        self.frames = 0
+        self.start = None
+        self.end = None
+
+    def drop(self):
+        with self.lock:
+            self.dropped += 1
+
+    def add(self, frame):
+        with self.lock:
+            times = frame.times
+            previous = times["start"]
+            for stage in STAGES:
+                self.latencies[stage].append(times[stage] - previous)
+                previous = times[stage]
+            self.latencies["total"].append(times["annotate"] - times["start"])
+            self.frames += 1
+            if self.start is None:
+                self.start = times["start"]
+            self.end = times["annotate"]
+
+    def fps(self):
+        if self.frames < 2:
+            return 0.0
+        return self.frames / (self.end - self.start)
+
+    def report(self):
+        print(f"{self.frames} frames, {self.dropped} dropped, {self.fps():.1f} FPS")
+        for stage, values in self.latencies.items():
+            if len(values) > 0:
+                values = np.array(values) * 1e3
+                print(f"  {stage:<10} mean {values.mean():7.1f}ms  p95 {np.percentile(values, 95):7.1f}ms")
+
+
+def put(q, item, drop_stale, stats):
+    """With drop_stale the oldest queued frame is discarded instead of waiting for space"""
+    while True:
+        try:
+            q.put(item, block=not drop_stale)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+                stats.drop()
+            except queue.Empty:
+                pass
+
+
+class Stage(threading.Thread):
+    """Pipeline thread running body(stage, *args), which reads with stage.get() and writes to stage.out_q.
+
+    STOP is always forwarded downstream, also when the body raises, so that the next stages and the
+    main thread finish. The error is kept for the main thread and the input queue is drained until
+    STOP so that the previous stages are not blocked on a full queue.
+    """
+    def __init__(self, name, body, in_q, out_q, stop_event, *args):
+        super().__init__(name=name, daemon=True)
+        self.body = body
+        self.in_q = in_q
+        self.out_q = out_q
+        self.stop_event = stop_event
+        self.args = args
+        self.error = None
+        self.stopped = in_q is None
+
+    def get(self, **kwargs):
+        item = self.in_q.get(**kwargs)
+        if item is STOP:
+            self.stopped = True
+        return item
+
+    def run(self):
+        try:
+            self.body(self, *self.args)
+        except Exception as e:
+            self.error = e
+            self.stop_event.set()
+            while not self.stopped:
+                self.get()
+        finally:
+            self.out_q.put(STOP)
+
+
+def capture(stage, cap, drop_stale, stats, max_frames):
+    index = 0
+    while not stage.stop_event.is_set() and (max_frames is None or index < max_frames):
+        ok, image = cap.read()
+        if not ok:
+            break
+        frame = Frame(index, image)
+        frame.mark("capture")
+        put(stage.out_q, frame, drop_stale, stats)
+        index += 1
+
+
+def preprocess(stage, width, drop_stale, stats):
+    while True:
+        frame = stage.get()
+        if frame is STOP:
+            return
+        image = frame.image
+        if width is not None and image.shape[1] != width:
+            height = int(image.shape[0] * width / image.shape[1])
+            image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+            frame.image = image
+        # ultralytics takes BGR numpy arrays, letterboxing is done by the model
+        frame.input = image
+        frame.mark("preprocess")
+        put(stage.out_q, frame, drop_stale, stats)
+
+
+def inference(stage, model, batch_size, max_wait_ms, max_age_ms, stats, imgsz):
+    """Predicts on batches of up to batch_size frames, waiting at most max_wait_ms to fill a batch"""
+    done = False
+    while not done:
+        batch = [stage.get()]
+        deadline = time.perf_counter() + max_wait_ms / 1e3
+        while batch[-1] is not STOP and len(batch) < batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(stage.get(timeout=timeout))
+            except queue.Empty:
+                break
+        if batch[-1] is STOP:
+            batch.pop()
+            done = True
+
+        now = time.perf_counter()
+        if max_age_ms is not None:
+            # frames that waited too long are not worth the compute on a live source
+            fresh = [frame for frame in batch if (now - frame.times["start"]) * 1e3 <= max_age_ms]
+            for _ in range(len(batch) - len(fresh)):
+                stats.drop()
+            batch = fresh
+        if len(batch) > 0:
+            for frame in batch:
+                frame.mark("queue")
+            results = model.predict([frame.input for frame in batch], imgsz=imgsz, verbose=False)
+            for frame, result in zip(batch, results):
+                frame.result = result
+                frame.mark("inference")
+                stage.out_q.put(frame)
+
+
+def annotate(stage, names, stats):
+    while True:
+        frame = stage.get()
+        if frame is STOP:
+            return
+        annotator = Annotator(frame.image)
+        boxes = frame.result.boxes
+        for b, c in zip(boxes.xyxy.cpu().numpy(), boxes.cls.cpu().numpy()):
+            annotator.box_label(b, names[int(c)])
+        frame.image = annotator.result()
+        frame.mark("annotate")
+        stats.add(frame)
+        stage.out_q.put(frame)
+
+
+def open_source(source, width, height):
+    # a number is a camera index, anything else a video file or stream url
+    is_camera = source.isdigit()
+    cap = cv2.VideoCapture(int(source) if is_camera else source)
+    assert cap.isOpened(), f"could not open {source}"
+    if is_camera:
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    return cap, is_camera
+
+
+def run(args):
+    model = YOLO(args.model)
+    cap, is_camera = open_source(args.source, args.width, args.height)
+    # cameras produce frames in real time, so late frames are dropped; files are processed completely
+    drop_stale = is_camera if args.drop_stale is None else args.drop_stale
+    max_age_ms = args.max_age_ms if drop_stale else None
+
+    stats = Stats()
+    stop_event = threading.Event()
+    capture_q = queue.Queue(maxsize=args.queue_size)
+    input_q = queue.Queue(maxsize=args.queue_size)
+    result_q = queue.Queue(maxsize=args.queue_size)
+    output_q = queue.Queue(maxsize=args.queue_size)
+
+    threads = [
+        Stage("capture", capture, None, capture_q, stop_event, cap, drop_stale, stats, args.max_frames),
+        Stage("preprocess", preprocess, capture_q, input_q, stop_event, args.width, drop_stale, stats),
+        Stage("inference", inference, input_q, result_q, stop_event, model, args.batch_size, args.max_wait_ms,
+              max_age_ms, stats, args.imgsz),
+        Stage("annotate", annotate, result_q, output_q, stop_event, model.names, stats),
+    ]
+    for thread in threads:
+        thread.start()
+
+    writer = None
+    last_report = time.perf_counter()
+    # display and writing stay on the main thread, cv2.imshow is not thread safe
+    while True:
+        frame = output_q.get()
+        if frame is STOP:
+            break
+        if args.output is not None:
+            if writer is None:
+                fps = cap.get(cv2.CAP_PROP_FPS) or 30
+                h, w = frame.image.shape[:2]
+                writer = cv2.VideoWriter(args.output, cv2.VideoWriter_fourcc(*"mp4v"), fps, (w, h))
+            writer.write(frame.image)
+        if args.show:
+            cv2.putText(frame.image, f"{stats.fps():.1f} FPS", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+            cv2.imshow('YOLO V8 Detection', frame.image)
+            if cv2.waitKey(1) & 0xFF == ord(' '):
+                stop_event.set()
+        if time.perf_counter() - last_report > args.report_every:
+            print(f"{stats.frames} frames - {stats.fps():.1f} FPS - {stats.dropped} dropped")
+            last_report = time.perf_counter()
+
+    for thread in threads:
+        thread.join()
+    cap.release()
+    if writer is not None:
+        writer.release()
+    if args.show:
+        cv2.destroyAllWindows()
+    stats.report()
+
+    # errors of the worker threads are raised here, the pipeline has already been shut down
+    errors = [thread for thread in threads if thread.error is not None]
+    if len(errors) > 0:
+        raise RuntimeError(f"{errors[0].name} stage failed: {errors[0].error!r}") from errors[0].error
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", type=str, default="0", help="camera index, video file or stream url")
+    parser.add_argument("--model", type=str, default="yolov8n.pt")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--max-age-ms", type=float, default=200, help="frames older than this are dropped when dropping stale frames")
+    parser.add_argument("--queue-size", type=int, default=8)
+    parser.add_argument("--drop-stale", action=argparse.BooleanOptionalAction, default=None,
+                        help="defaults to on for cameras and off for video files")
+    parser.add_argument("--max-frames", type=int, default=None)
+    parser.add_argument("--output", type=str, default=None, help="write the annotated video to this path")
+    parser.add_argument("--show", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--report-every", type=float, default=5.0, help="seconds between progress lines")
+    run(parser.parse_args())